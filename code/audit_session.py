@@ -0,0 +1,398 @@
+"""
+Resumable, multi-round SUITE audit of a single contest.
+
+`AuditSession` owns the audit parameters, the samples, the observed tallies
+and the per-pair results, and checkpoints every round to an audit store
+(see `audit_store`). A session can be reopened after a crash with
+`AuditSession.resume` without recomputing anything.
+"""
+
+from __future__ import division, print_function
+from collections import OrderedDict
+import numpy as np
+
+from audit_store import create_audit_store, read_audit_store, \
+        append_audit_round, update_audit_metadata, load_audit_round, \
+        load_audit_samples
+from suite_tools import find_winners_losers, audit_pair, \
+        estimate_n, estimate_escalation_n
+
+
+def _pairs_to_list(pair_dict):
+    """
+    JSON-friendly form of a dict keyed by (winner, loser)
+    """
+    return [[k[0], k[1]] + list(v) for k, v in pair_dict.items()]
+
+
+def _pairs_from_list(pair_list):
+    return OrderedDict(((v[0], v[1]), tuple(v[2:])) for v in pair_list)
+
+
+class AuditSession(object):
+    """
+    A multi-round SUITE audit of one contest, checkpointed to an audit store.
+
+    A round consists of
+        1. `estimate_sample_size` to find how many ballots to draw,
+        2. drawing and auditing the ballots (outside this object),
+        3. `advance` with the new ballots and the updated tallies.
+
+    Only pairs that are not yet confirmed are re-evaluated in `advance`.
+    The search for each pair starts from the lambda that maximized its
+    combined P-value in the previous round. The SPRT P-value is only
+    evaluated at the lambdas where the ballot comparison P-value leaves room
+    to beat the largest combined P-value found near that lambda, so a
+    maximum that stays put needs few SPRTs. The risk is the same as that of
+    `suite_tools.audit_contest`.
+
+    Parameters
+    ----------
+    dirname : str
+        directory for the audit store. Must not already contain a store.
+    candidates : dict
+        keys are the candidate name, values are a list with
+        [reported votes in CVR stratum, reported votes in no-CVR stratum]
+    stratum_sizes : list
+        [total ballots in CVR stratum, total ballots in no-CVR stratum]
+    num_winners : int
+        number of winners in the contest
+    risk_limit : float
+        risk limit. Default 0.05
+    gamma : float
+        gamma from Lindeman and Stark (2012). Default 1.03905
+    lambda_step : float
+        stepsize for the discrete bounds on Fisher's combining function.
+        Default 0.05
+    o1_rate, o2_rate, u1_rate, u2_rate : float
+        expected discrepancy rates in the CVR stratum, used to plan the
+        first round. Default 0
+    n_ratio : float
+        fraction of the sample allocated to the CVR stratum.
+        If None, allocate in proportion to ballots cast in each stratum
+    seed : int
+        Optional, seed for the PRNG used to draw the sample. Only recorded.
+    """
+
+    def __init__(self, dirname, candidates, stratum_sizes, num_winners,
+                 risk_limit=0.05, gamma=1.03905, lambda_step=0.05,
+                 o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0, n_ratio=None,
+                 seed=None, _header=None):
+        self.dirname = dirname
+        self.stratum_sizes = [int(s) for s in stratum_sizes]
+        self.num_winners = num_winners
+        self.risk_limit = risk_limit
+        self.gamma = gamma
+        self.lambda_step = lambda_step
+        self.o1_rate = o1_rate
+        self.o2_rate = o2_rate
+        self.u1_rate = u1_rate
+        self.u2_rate = u2_rate
+        if n_ratio is None:
+            n_ratio = stratum_sizes[0]/np.sum(stratum_sizes)
+        self.n_ratio = n_ratio
+        self.seed = seed
+
+        # find_winners_losers appends to the vote lists, so work on a copy
+        votes = OrderedDict((k, [v[0], v[1]]) for k, v in candidates.items())
+        (self.candidates, self.margins, self.winners, self.losers) = \
+            find_winners_losers(votes, num_winners)
+        self.pairs = list(self.margins.keys())
+
+        # audit state
+        self.round = 0
+        self.n1 = 0
+        self.n2 = 0
+        self.cvr_sample = np.zeros(0, dtype=np.int64)
+        self.nocvr_sample = np.zeros(0, dtype=np.int64)
+        self.o1 = self.o2 = self.u1 = self.u2 = 0
+        self.observed_poll = dict((k, 0) for k in self.candidates.keys())
+
+        # per-pair cache: risk, maximizing lambda, confirmed
+        self.audit_pvalues = OrderedDict((k, 1.0) for k in self.pairs)
+        self.lambdas = OrderedDict((k, np.nan) for k in self.pairs)
+        self.confirmed = OrderedDict((k, False) for k in self.pairs)
+        self.sample_size_plan = None
+
+        if _header is None:
+            create_audit_store(dirname, risk_limit, self.stratum_sizes,
+                               num_winners, seed, gamma, lambda_step,
+                               o1_rate, o2_rate, u1_rate, u2_rate, n_ratio,
+                               self.candidates)
+
+
+    @classmethod
+    def resume(cls, dirname):
+        """
+        Reopen the session stored in `dirname` at its latest checkpoint.
+        """
+        header = read_audit_store(dirname)
+        param = header["parameters"]
+        candidates = OrderedDict(zip(header["candidates"],
+                                     header["reported_votes"]))
+        session = cls(dirname, candidates, param["stratum_sizes"],
+                      param["num_winners"], risk_limit=param["risk_limit"],
+                      gamma=param["gamma"], lambda_step=param["lambda_step"],
+                      o1_rate=param["o1_rate"], o2_rate=param["o2_rate"],
+                      u1_rate=param["u1_rate"], u2_rate=param["u2_rate"],
+                      n_ratio=param["n_ratio"], seed=param["seed"],
+                      _header=header)
+
+        plan_metadata = header.get("metadata", {})
+        if header["rounds"]:
+            last = load_audit_round(dirname, header=header)
+            session.round = last["round"]
+            session.n1 = last["n1"]
+            session.n2 = last["n2"]
+            (session.cvr_sample, session.nocvr_sample) = \
+                load_audit_samples(dirname, header=header)
+            (session.o1, session.o2, session.u1, session.u2) = \
+                (last["o1"], last["o2"], last["u1"], last["u2"])
+            session.observed_poll = last["observed_poll"]
+            pair_lambdas = last["arrays"]["lambdas"]
+            pair_confirmed = last["arrays"]["confirmed"]
+            for i, k in enumerate(last["audit_pvalues"].keys()):
+                session.audit_pvalues[k] = last["audit_pvalues"][k]
+                session.lambdas[k] = float(pair_lambdas[i])
+                session.confirmed[k] = bool(pair_confirmed[i])
+            plan_metadata = last["metadata"]
+        if "sample_size_plan" in plan_metadata:
+            session.sample_size_plan = \
+                _pairs_from_list(plan_metadata["sample_size_plan"])
+        return session
+
+
+    @property
+    def pairs_not_yet_confirmed(self):
+        return [k for k in self.pairs if not self.confirmed[k]]
+
+
+    @property
+    def finished(self):
+        return all(self.confirmed.values())
+
+
+    def estimate_sample_size(self, verbose=False, cache=None):
+        """
+        Estimate the cumulative sample sizes needed to confirm every pair
+        that is not yet confirmed. Before the first round this uses
+        `estimate_n` with the planned discrepancy rates; afterwards it uses
+        `estimate_escalation_n` with the observed tallies. The per-pair
+        estimates are checkpointed, so they are not recomputed on resume.
+
+        Parameters
+        ----------
+        verbose : bool
+            print the steps of the searches? Default False
+        cache : plan_cache.PlanCache
+            persistent cache of the searches, as in `estimate_n`.
+            Default None.
+
+        Returns
+        -------
+        tuple : (n1, n2), cumulative sample sizes for the CVR and no-CVR
+        strata, the largest over pairs not yet confirmed
+        """
+        if self.sample_size_plan is None:
+            plan = OrderedDict()
+            for k in self.pairs_not_yet_confirmed:
+                N_w1, N_w2 = self.candidates[k[0]][0:2]
+                N_l1, N_l2 = self.candidates[k[1]][0:2]
+                if self.round == 0:
+                    plan[k] = estimate_n(N_w1=N_w1, N_w2=N_w2, \
+                                N_l1=N_l1, N_l2=N_l2, \
+                                N1=self.stratum_sizes[0], \
+                                N2=self.stratum_sizes[1], \
+                                o1_rate=self.o1_rate, o2_rate=self.o2_rate, \
+                                u1_rate=self.u1_rate, u2_rate=self.u2_rate, \
+                                n_ratio=self.n_ratio, \
+                                risk_limit=self.risk_limit, gamma=self.gamma, \
+                                stepsize=self.lambda_step, verbose=verbose, \
+                                cache=cache)
+                else:
+                    plan[k] = estimate_escalation_n(N_w1=N_w1, N_w2=N_w2, \
+                                N_l1=N_l1, N_l2=N_l2, \
+                                N1=self.stratum_sizes[0], \
+                                N2=self.stratum_sizes[1], \
+                                n1=self.n1, n2=self.n2, \
+                                o1_obs=self.o1, o2_obs=self.o2, \
+                                u1_obs=self.u1, u2_obs=self.u2, \
+                                n2l_obs=self.observed_poll[k[1]], \
+                                n2w_obs=self.observed_poll[k[0]], \
+                                n_ratio=self.n_ratio, \
+                                risk_limit=self.risk_limit, gamma=self.gamma, \
+                                stepsize=self.lambda_step, verbose=verbose, \
+                                cache=cache)
+                plan[k] = (int(plan[k][0]), int(plan[k][1]))
+            self.sample_size_plan = plan
+            update_audit_metadata(self.dirname,
+                                  {"sample_size_plan" : _pairs_to_list(plan)},
+                                  round_num=self.round)
+        if not self.sample_size_plan:
+            return (self.n1, self.n2)
+        return (max(self.n1, max(v[0] for v in self.sample_size_plan.values())),
+                max(self.n2, max(v[1] for v in self.sample_size_plan.values())))
+
+
+    def _pair_risk(self, k):
+        """
+        Risk for pair k given the current state, searched outward from the
+        lambda that maximized the combined P-value in the previous round.
+        """
+        lam = self.lambdas[k]
+        return audit_pair(self.candidates, k[0], k[1], self.stratum_sizes, \
+                          self.n1, self.n2, self.o1, self.o2, self.u1, \
+                          self.u2, self.observed_poll, self.risk_limit, \
+                          self.gamma, self.lambda_step, \
+                          lambda_guess=None if np.isnan(lam) else lam)
+
+
+    def advance(self, cvr_sample, nocvr_sample, o1, o2, u1, u2, \
+                observed_poll, metadata=None):
+        """
+        Record a round of the audit, compute the risk of every pair not yet
+        confirmed and checkpoint the round to the store.
+
+        Parameters
+        ----------
+        cvr_sample : array-like
+            ballots drawn in the CVR stratum *in this round*
+        nocvr_sample : array-like
+            ballots drawn in the no-CVR stratum *in this round*
+        o1, o2, u1, u2 : int
+            cumulative discrepancy counts in the CVR stratum sample
+        observed_poll : dict
+            cumulative votes for each candidate in the no-CVR stratum sample
+        metadata : dict
+            Optional, JSON-serializable information to store with the round
+
+        Returns
+        -------
+        dict : attained risk for each (winner, loser) pair in the contest
+        """
+        cvr_sample = np.asarray(cvr_sample, dtype=np.int64)
+        nocvr_sample = np.asarray(nocvr_sample, dtype=np.int64)
+        assert np.sum(list(observed_poll.values())) <= \
+            self.n2 + len(nocvr_sample), "Too many ballots input"
+
+        self.cvr_sample = np.concatenate([self.cvr_sample, cvr_sample])
+        self.nocvr_sample = np.concatenate([self.nocvr_sample, nocvr_sample])
+        self.n1 = len(self.cvr_sample)
+        self.n2 = len(self.nocvr_sample)
+        (self.o1, self.o2, self.u1, self.u2) = (o1, o2, u1, u2)
+        self.observed_poll = dict((k, observed_poll.get(k, 0)) \
+                                  for k in self.candidates.keys())
+        self.round += 1
+
+        for k in self.pairs_not_yet_confirmed:
+            res = self._pair_risk(k)
+            self.audit_pvalues[k] = float(res['max_pvalue'])
+            self.lambdas[k] = float(res['allocation lambda'])
+            self.confirmed[k] = bool(res['max_pvalue'] <= self.risk_limit)
+        self.sample_size_plan = None
+
+        append_audit_round(self.dirname, cvr_sample, nocvr_sample, \
+                           o1, o2, u1, u2, self.observed_poll, \
+                           self.audit_pvalues, metadata=metadata, \
+                           arrays={"lambdas" : list(self.lambdas.values()),
+                                   "confirmed" : list(self.confirmed.values())})
+        return OrderedDict(self.audit_pvalues)
+
+
+################################################################################
+############################## Unit tests ######################################
+################################################################################
+
+def test_audit_session_resume():
+    import shutil
+    import tempfile
+    import suite_tools
+
+    candidates = {"a" : [5300, 510], "b" : [4700, 490], "c" : [1000, 100]}
+    stratum_sizes = [12000, 1200]
+    dirname = tempfile.mkdtemp()
+    try:
+        session = AuditSession(dirname, candidates, stratum_sizes, 1,
+                               risk_limit=0.1)
+        (n1, n2) = session.estimate_sample_size()
+        assert n1 > 0 and n2 > 0
+
+        # a small first round does not confirm (a, b)
+        poll = {"a" : 26, "b" : 22, "c" : 2}
+        pvalues = session.advance(np.arange(100), np.arange(50),
+                                  0, 0, 0, 0, poll)
+        assert session.confirmed[("a", "c")]
+        assert not session.confirmed[("a", "b")]
+        expected = suite_tools.audit_contest(session.candidates,
+                        session.winners, session.losers, stratum_sizes,
+                        100, 50, 0, 0, 0, 0, poll, risk_limit=0.1,
+                        gamma=1.03905, stepsize=0.05)
+        for k in expected:
+            np.testing.assert_almost_equal(pvalues[k], expected[k])
+
+        plan = session.estimate_sample_size()
+        assert plan[0] >= 100 and plan[1] >= 50 and sum(plan) > 150
+
+        # resume from disk: nothing is recomputed and the plan is reused
+        resumed = AuditSession.resume(dirname)
+        assert resumed.round == 1 and resumed.n1 == 100 and resumed.n2 == 50
+        assert resumed.confirmed == session.confirmed
+        assert resumed.audit_pvalues == session.audit_pvalues
+        assert resumed.sample_size_plan == session.sample_size_plan
+        assert resumed.estimate_sample_size() == plan
+
+        # a large second round confirms the remaining pair
+        poll = {"a" : 450, "b" : 430, "c" : 90}
+        pvalues = resumed.advance(np.arange(100, 2000), np.arange(50, 1050),
+                                  0, 0, 0, 0, poll)
+        assert resumed.finished
+        np.testing.assert_array_equal(resumed.nocvr_sample,
+                                      np.arange(0, 1050))
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_audit_session_rounds():
+    import shutil
+    import tempfile
+    import suite_tools
+
+    # the risks of later rounds, in which the maximizing lambda moves, match
+    # audit_contest on the cumulative data
+    candidates = {"a" : [5300, 510], "b" : [4700, 490], "c" : [1000, 100]}
+    stratum_sizes = [12000, 1200]
+    rounds = [(np.arange(100), np.arange(50), (0, 0, 0, 0),
+               {"a" : 26, "b" : 22, "c" : 2}),
+              (np.arange(100, 300), np.arange(50, 100), (3, 2, 0, 0),
+               {"a" : 60, "b" : 36, "c" : 4}),
+              (np.arange(300, 700), np.arange(100, 300), (4, 2, 1, 0),
+               {"a" : 160, "b" : 120, "c" : 20})]
+    dirname = tempfile.mkdtemp()
+    try:
+        session = AuditSession(dirname, candidates, stratum_sizes, 1,
+                               risk_limit=0.1)
+        for (cvr, nocvr, discrepancies, poll) in rounds:
+            pairs = list(session.pairs_not_yet_confirmed)
+            pvalues = session.advance(cvr, nocvr, *discrepancies,
+                                      observed_poll=poll)
+            for k in pairs:
+                expected = suite_tools.audit_pair(session.candidates, k[0],
+                                k[1], stratum_sizes, session.n1, session.n2,
+                                *discrepancies, observed_poll=poll,
+                                risk_limit=0.1, gamma=1.03905, stepsize=0.05)
+                assert pvalues[k] == expected['max_pvalue']
+                assert session.lambdas[k] == expected['allocation lambda']
+        expected = suite_tools.audit_contest(session.candidates,
+                        session.winners, session.losers, stratum_sizes,
+                        session.n1, session.n2, *discrepancies,
+                        observed_poll=poll, risk_limit=0.1,
+                        gamma=1.03905, stepsize=0.05)
+        assert pvalues[("a", "b")] == expected[("a", "b")]
+        assert session.audit_pvalues == \
+            AuditSession.resume(dirname).audit_pvalues
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == "__main__":
+    test_audit_session_resume()
+    test_audit_session_rounds()
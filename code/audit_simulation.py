@@ -0,0 +1,300 @@
+"""
+Simulation of complete multi-round SUITE audits of one contest.
+
+Each simulated audit draws the initial sample from `estimate_n_pairs`,
+audits it, and escalates until every (winner, loser) pair is confirmed or
+the ballots are counted by hand, as an `AuditSession` would. All audits
+still in progress are advanced together, one round at a time, and blocks
+of audits can run in parallel.
+"""
+
+from __future__ import division, print_function
+from collections import OrderedDict
+import math
+import multiprocessing
+import numpy as np
+
+from fishers_combination import maximize_fisher_combined_pvalue_batch
+import logfactorial
+from planning import _hypergeometric
+from suite_tools import find_winners_losers, estimate_n_pairs, \
+        expected_escalation_pvalues
+
+# Escalation factors tried for the next round's total sample size
+ESCALATION_FACTORS = (1.1, 1.2, 1.35, 1.5, 1.75, 2, 2.5, 3, 4, 6, 10)
+
+
+def _simulate_block(args):
+    """
+    Simulate the audits of one block of replications. See `simulate_audits`.
+    """
+    (setup, reps, seed_sequence) = args
+    prng = np.random.default_rng(seed_sequence)
+    (N1, N2) = setup['stratum_sizes']
+    rates = list(setup['true_rates'])
+    pairs = setup['pairs']
+    votes1 = setup['votes1']
+    votes2 = setup['votes2']
+    risk_limit = setup['risk_limit']
+    num_cand = len(votes1)
+
+    n1 = np.zeros(reps)
+    n2 = np.zeros(reps)
+    discrepancies = np.zeros((reps, 4))
+    poll = np.zeros((reps, num_cand))
+    # unsampled no-CVR ballots for each candidate, and for no one
+    remaining = np.tile(np.append(setup['true_votes2'], \
+                        N2 - np.sum(setup['true_votes2'])), (reps, 1))
+    rounds = np.zeros(reps, dtype=int)
+    full_count = np.zeros(reps, dtype=bool)
+    active = np.arange(reps)
+    target1 = np.full(reps, float(setup['initial_n'][0]))
+    target2 = np.full(reps, float(setup['initial_n'][1]))
+
+    w = np.array([p[0] for p in pairs])
+    l = np.array([p[1] for p in pairs])
+    while len(active) > 0:
+        # draw the new ballots of this round
+        new1 = (target1[active] - n1[active]).astype(int)
+        discrepancies[active] += prng.multinomial(new1, \
+                                     rates + [1 - sum(rates)])[:, 0:4]
+        to_draw = (target2[active] - n2[active]).astype(int)
+        for c in range(num_cand):
+            rest = remaining[active, c+1:].sum(axis=1)
+            drawn = _hypergeometric(prng, remaining[active, c], rest, to_draw)
+            poll[active, c] += drawn
+            remaining[active, c] -= drawn
+            to_draw = to_draw - drawn
+        remaining[active, num_cand] -= to_draw
+        n1[active] = target1[active]
+        n2[active] = target2[active]
+        rounds[active] += 1
+
+        # risk of every pair, for all audits in progress at once. A pair
+        # whose no-CVR sample has more votes for a candidate than reported
+        # cannot be confirmed (the SPRT alternative is impossible).
+        a = active[:, None]
+        consistent = (poll[a, w] <= votes2[w]) & (poll[a, l] <= votes2[l]) & \
+                     (n2[a] - poll[a, w] - poll[a, l] <= \
+                      N2 - votes2[w] - votes2[l])
+        keep = lambda x: np.where(consistent, x, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            risks = maximize_fisher_combined_pvalue_batch(\
+                votes1[w], votes1[l], N1, votes2[w], votes2[l], N2, \
+                n1[a], discrepancies[a, 0], discrepancies[a, 1], \
+                discrepancies[a, 2], discrepancies[a, 3], keep(n2[a]), \
+                keep(poll[a, w]), keep(poll[a, l]), gamma=setup['gamma'], \
+                stepsize=setup['stepsize'], alpha=risk_limit)['max_pvalue']
+        risks = np.where(consistent, risks, 1)
+        confirmed = np.all(risks <= risk_limit, axis=1)
+        exhausted = (n1[active] >= N1) & (n2[active] >= N2)
+        out_of_rounds = rounds[active] >= setup['max_rounds']
+        full_count[active[~confirmed & (exhausted | out_of_rounds)]] = True
+        active = active[~confirmed & ~exhausted & ~out_of_rounds]
+        if len(active) == 0:
+            break
+
+        # escalate to the smallest size at which every pair is expected
+        # to be confirmed, or count by hand
+        n_now = n1[active] + n2[active]
+        sizes = np.minimum(np.ceil(n_now[:, None]*\
+                                   np.array(ESCALATION_FACTORS)), N1 + N2)
+        a = active[:, None, None]
+        pvalues = expected_escalation_pvalues(sizes[:, None, :], \
+            votes1[w][:, None], votes2[w][:, None], votes1[l][:, None], \
+            votes2[l][:, None], N1, N2, n1[a], n2[a], \
+            discrepancies[a, 0], discrepancies[a, 1], discrepancies[a, 2], \
+            discrepancies[a, 3], poll[a, l[:, None]], poll[a, w[:, None]], \
+            setup['n_ratio'], risk_limit, setup['gamma'], setup['stepsize'])
+        enough = np.all(pvalues <= risk_limit, axis=1)
+        first = np.where(np.any(enough, axis=1), np.argmax(enough, axis=1), -1)
+        next_n = np.where(first >= 0, sizes[np.arange(len(active)), first], \
+                          N1 + N2)
+        next1 = np.minimum(np.maximum(np.ceil(setup['n_ratio']*next_n), \
+                                      n1[active]), N1)
+        next2 = np.minimum(np.maximum(next_n - next1, n2[active]), N2)
+        hand_count = next_n >= N1 + N2
+        full_count[active[hand_count]] = True
+        target1[active] = next1
+        target2[active] = next2
+        active = active[~hand_count]
+
+    ballots = np.where(full_count, N1 + N2, n1 + n2)
+    return (ballots, n1, n2, rounds, full_count)
+
+
+def simulate_audits(candidates, stratum_sizes, num_winners, \
+                    true_votes2=None, true_rates=None, \
+                    o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0, \
+                    n_ratio=None, risk_limit=0.05, gamma=1.03905, \
+                    stepsize=0.05, reps=1000, max_rounds=10, \
+                    block_size=250, seed=None, processes=1, \
+                    logfactorial_size=None):
+    """
+    Simulate complete SUITE audits of a contest, to estimate the workload.
+
+    Every audit starts with the sample sizes from `estimate_n_pairs` (the
+    same for all audits). After each round the risk of every pair is
+    computed; if any pair is not confirmed, the next total sample size is
+    the smallest of the current size times ESCALATION_FACTORS at which every
+    pair is expected to be confirmed according to
+    `expected_escalation_pvalues`, split between the strata by n_ratio.
+    If none is, or after `max_rounds` rounds, the ballots are counted by
+    hand.
+
+    Discrepancies in the CVR stratum occur independently at the true rates;
+    no-CVR ballots are drawn without replacement from the true votes.
+
+    Parameters
+    ----------
+    candidates : dict
+        keys are the candidate names, values are a list with
+        [reported votes in CVR stratum, reported votes in no-CVR stratum]
+    stratum_sizes : list
+        [total ballots in CVR stratum, total ballots in no-CVR stratum]
+    num_winners : int
+        number of winners in the contest
+    true_votes2 : dict
+        true votes for each candidate in the no-CVR stratum. Optional;
+        default is the reported votes.
+    true_rates : tuple
+        true rates of 1-vote overstatements, 2-vote overstatements,
+        1-vote understatements and 2-vote understatements in the CVR
+        stratum. Optional; default is the planning rates below.
+    o1_rate, o2_rate, u1_rate, u2_rate, n_ratio, risk_limit, gamma, stepsize :
+        audit parameters, as in `suite_tools.estimate_n`
+    reps : int
+        number of audits to simulate. Default 1000
+    max_rounds : int
+        number of rounds after which the ballots are counted by hand.
+        Default 10
+    block_size : int
+        number of audits per block. Blocks have independent random streams
+        derived from `seed`, so results do not depend on `processes`.
+    seed : int
+        seed for the pseudorandom number generator. Optional
+    processes : int
+        number of worker processes for the blocks. Default 1; None uses all
+        CPUs
+    logfactorial_size : int
+        if given and processes > 1, `logfactorial.create(logfactorial_size)`
+        is called before the workers start, so that they share one table of
+        log factorials; e.g. N1+N2. The table stays attached. Optional
+    Returns
+    -------
+    dict with
+
+    ballots : array
+        ballots audited in each simulated audit, N1+N2 if counted by hand
+    n1, n2 : array
+        sample sizes in each stratum when the audit ended
+    rounds : array
+        number of sampling rounds of each audit
+    full_count : array
+        whether each audit went to a full hand count
+    mean_ballots : float
+        expected number of ballots audited
+    full_count_probability : float
+        fraction of audits that went to a full hand count
+    initial_n : tuple
+        sample sizes of the first round
+    """
+    assert risk_limit > 0 and risk_limit < 1, "risk limit must be in (0, 1)"
+    (N1, N2) = stratum_sizes
+    n_ratio = n_ratio if n_ratio else N1/(N1+N2)
+    candidates = OrderedDict((k, list(v[0:2])) for k, v in candidates.items())
+    (candidates, margins, winners, losers) = \
+        find_winners_losers(candidates, num_winners)
+    names = list(candidates.keys())
+    if true_votes2 is None:
+        true_votes2 = dict((k, v[1]) for k, v in candidates.items())
+    if true_rates is None:
+        true_rates = (o1_rate, o2_rate, u1_rate, u2_rate)
+    assert sum(true_votes2.values()) <= N2, "more true votes than ballots"
+    assert sum(true_rates) <= 1, "discrepancy rates must sum to at most 1"
+
+    plan = estimate_n_pairs(candidates, margins, stratum_sizes, \
+                            o1_rate=o1_rate, o2_rate=o2_rate, \
+                            u1_rate=u1_rate, u2_rate=u2_rate, \
+                            n_ratio=n_ratio, risk_limit=risk_limit, \
+                            gamma=gamma, stepsize=stepsize, \
+                            method='secant')['sample_sizes']
+    initial_n = (min(N1, max(v[0] for v in plan.values())), \
+                 min(N2, max(v[1] for v in plan.values())))
+
+    setup = {'stratum_sizes' : (N1, N2),
+             'true_rates' : true_rates,
+             'true_votes2' : np.array([true_votes2.get(k, 0) for k in names]),
+             'votes1' : np.array([candidates[k][0] for k in names], dtype=float),
+             'votes2' : np.array([candidates[k][1] for k in names], dtype=float),
+             'pairs' : [(names.index(w), names.index(l)) for (w, l) in \
+                        margins.keys()],
+             'initial_n' : initial_n,
+             'n_ratio' : n_ratio,
+             'risk_limit' : risk_limit,
+             'gamma' : gamma,
+             'stepsize' : stepsize,
+             'max_rounds' : max_rounds}
+    blocks = [len(b) for b in np.array_split(np.arange(reps), \
+                                             max(1, math.ceil(reps/block_size)))]
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+    tasks = [(setup, b, s) for b, s in zip(blocks, seeds)]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+    if processes > 1:
+        if logfactorial_size is not None:
+            logfactorial.create(logfactorial_size)
+        pool = multiprocessing.Pool(processes, \
+                                    **logfactorial.pool_arguments())
+        try:
+            results = pool.map(_simulate_block, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_simulate_block(t) for t in tasks]
+    (ballots, n1, n2, rounds, full_count) = \
+        [np.concatenate(r) for r in zip(*results)]
+    return {'ballots' : ballots,
+            'n1' : n1,
+            'n2' : n2,
+            'rounds' : rounds,
+            'full_count' : full_count,
+            'mean_ballots' : np.mean(ballots),
+            'full_count_probability' : np.mean(full_count),
+            'initial_n' : initial_n
+            }
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_simulate_audits():
+    candidates = {"a" : [5300, 510], "b" : [4700, 490], "c" : [200, 30]}
+    res = simulate_audits(candidates, [11000, 1100], 1, o1_rate=0.001, \
+                          reps=200, block_size=50, seed=20180514)
+    assert len(res['ballots']) == 200
+    assert np.all(res['ballots'] >= sum(res['initial_n']))
+    assert np.all(res['rounds'] >= 1)
+    assert np.all(res['ballots'][res['full_count']] == 12100)
+    # the reported outcome is right, so most audits stop in the first rounds
+    assert res['full_count_probability'] < 0.2
+    assert np.median(res['rounds']) <= 2
+
+    # same results with several processes
+    res2 = simulate_audits(candidates, [11000, 1100], 1, o1_rate=0.001, \
+                           reps=200, block_size=50, seed=20180514, processes=2)
+    np.testing.assert_array_equal(res['ballots'], res2['ballots'])
+
+    # the reported winner actually lost: audits should count by hand
+    res = simulate_audits(candidates, [11000, 1100], 1, \
+                          true_votes2={"a" : 200, "b" : 800, "c" : 30}, \
+                          reps=50, seed=1)
+    assert res['full_count_probability'] > 0.9
+
+
+if __name__ == "__main__":
+    test_simulate_audits()
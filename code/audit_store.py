@@ -0,0 +1,399 @@
+"""
+Append-only binary storage for the state of a SUITE audit.
+
+An audit store is a directory with a small JSON header and one uncompressed
+``.npz`` file per round. The header holds the audit parameters, the candidate
+names and reported votes, and one short entry per round. Each round file holds
+the ballots drawn in that round, the cumulative discrepancy tallies, the
+cumulative polling tallies and the (winner, loser) risks as numeric columns,
+so reloading an audit never parses sample lists out of JSON.
+
+Writes are atomic: the round file is written first and the header is replaced
+afterwards, so an interrupted write leaves the store at the previous round.
+"""
+
+from __future__ import division, print_function
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+HEADER_FILE = "header.json"
+STORE_VERSION = 1
+
+
+################################################################################
+############################### Helpers ########################################
+################################################################################
+
+def _atomic_write(path, write_fun, mode='w'):
+    """
+    Write a file by writing a temporary file in the same directory and
+    renaming it over `path`.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write_fun(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _write_header(dirname, header):
+    _atomic_write(os.path.join(dirname, HEADER_FILE),
+                  lambda f: json.dump(header, f, indent=1))
+
+
+def _round_filename(round_num):
+    return "round_%04d.npz" % round_num
+
+
+################################################################################
+############################## Store API #######################################
+################################################################################
+
+def create_audit_store(dirname, \
+                       risk_limit, stratum_sizes, num_winners, seed, gamma, \
+                       lambda_step, o1_rate, o2_rate, \
+                       u1_rate, u2_rate, n_ratio, candidates):
+    """
+    Create a new audit store in the directory `dirname`.
+
+    Parameters
+    ----------
+    dirname : str
+        directory to hold the store. It is created if it does not exist
+        and must not already contain a store.
+    risk_limit, stratum_sizes, num_winners, seed, gamma, lambda_step, \
+    o1_rate, o2_rate, u1_rate, u2_rate, n_ratio :
+        audit parameters, as in `suite_tools.write_audit_parameters`
+    candidates : dict
+        keys are the candidate name, values are a list with
+        [reported votes in CVR stratum, reported votes in no-CVR stratum, ...]
+
+    Returns
+    -------
+    dict : the store header
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if os.path.exists(os.path.join(dirname, HEADER_FILE)):
+        raise ValueError('an audit store already exists in %s' % dirname)
+
+    header = {"version" : STORE_VERSION,
+              "parameters" : {"risk_limit" : risk_limit,
+                              "stratum_sizes" : [int(s) for s in stratum_sizes],
+                              "num_winners" : num_winners,
+                              "seed" : seed,
+                              "gamma" : gamma,
+                              "lambda_step" : lambda_step,
+                              "o1_rate" : o1_rate,
+                              "o2_rate" : o2_rate,
+                              "u1_rate" : u1_rate,
+                              "u2_rate" : u2_rate,
+                              "n_ratio" : n_ratio
+                              },
+              "candidates" : list(candidates.keys()),
+              "reported_votes" : [[int(v[0]), int(v[1])] \
+                                  for v in candidates.values()],
+              "metadata" : {},
+              "rounds" : []
+              }
+    _write_header(dirname, header)
+    return header
+
+
+def read_audit_store(dirname):
+    """
+    Read the header of an audit store. This does not touch the round files.
+
+    Returns
+    -------
+    dict with
+
+    version : int
+        store format version
+    parameters : dict
+        audit parameters
+    candidates : list
+        candidate names, in the order used to index the round files
+    reported_votes : list
+        [CVR votes, no-CVR votes] for each candidate
+    metadata : dict
+        store-level metadata, see `update_audit_metadata`
+    rounds : list
+        one dict per round with keys round, file, n1, n2, new_n1, new_n2
+        and metadata
+    """
+    with open(os.path.join(dirname, HEADER_FILE), 'r') as f:
+        header = json.load(f)
+    if header["version"] > STORE_VERSION:
+        raise ValueError('audit store version %i is newer than this code' \
+                         % header["version"])
+    return header
+
+
+def append_audit_round(dirname, cvr_sample, nocvr_sample, \
+                       o1, o2, u1, u2, observed_poll, \
+                       audit_pvalues, metadata=None, arrays=None):
+    """
+    Append one round of the audit to the store.
+
+    Parameters
+    ----------
+    dirname : str
+        directory holding the store
+    cvr_sample : array-like
+        ballots drawn in the CVR stratum *in this round*
+    nocvr_sample : array-like
+        ballots drawn in the no-CVR stratum *in this round*
+    o1, o2, u1, u2 : int
+        cumulative discrepancy counts in the CVR stratum sample
+    observed_poll : dict
+        cumulative votes for each candidate in the no-CVR stratum sample
+    audit_pvalues : dict
+        attained risk keyed by (winner, loser). May cover only some pairs.
+    metadata : dict
+        Optional, JSON-serializable information about the round
+        (dates, operator notes, ...). Stored in the header.
+    arrays : dict
+        Optional, additional named numeric arrays to store with the round
+
+    Returns
+    -------
+    dict : the header entry for the new round
+    """
+    header = read_audit_store(dirname)
+    names = header["candidates"]
+    index = dict((name, i) for i, name in enumerate(names))
+    rounds = header["rounds"]
+    round_num = len(rounds) + 1
+
+    cvr_sample = np.asarray(cvr_sample, dtype=np.int64)
+    nocvr_sample = np.asarray(nocvr_sample, dtype=np.int64)
+    prev_n1 = rounds[-1]["n1"] if rounds else 0
+    prev_n2 = rounds[-1]["n2"] if rounds else 0
+
+    poll_counts = np.zeros(len(names), dtype=np.int64)
+    for name, votes in observed_poll.items():
+        poll_counts[index[name]] = votes
+
+    pairs = list(audit_pvalues.keys())
+    columns = {"cvr_sample" : cvr_sample,
+               "nocvr_sample" : nocvr_sample,
+               "tallies" : np.array([o1, o2, u1, u2], dtype=np.int64),
+               "poll_counts" : poll_counts,
+               "pair_winner" : np.array([index[k[0]] for k in pairs],
+                                        dtype=np.int32),
+               "pair_loser" : np.array([index[k[1]] for k in pairs],
+                                       dtype=np.int32),
+               "pair_pvalue" : np.array([audit_pvalues[k] for k in pairs],
+                                        dtype=np.float64)
+               }
+    if arrays is not None:
+        # prefixed, so that any name is allowed
+        for key, value in arrays.items():
+            columns["extra_" + key] = np.asarray(value)
+
+    filename = _round_filename(round_num)
+    _atomic_write(os.path.join(dirname, filename),
+                  lambda f: np.savez(f, **columns), mode='wb')
+
+    entry = {"round" : round_num,
+             "file" : filename,
+             "n1" : prev_n1 + len(cvr_sample),
+             "n2" : prev_n2 + len(nocvr_sample),
+             "new_n1" : len(cvr_sample),
+             "new_n2" : len(nocvr_sample),
+             "metadata" : metadata if metadata is not None else {}
+             }
+    rounds.append(entry)
+    _write_header(dirname, header)
+    return entry
+
+
+def update_audit_metadata(dirname, metadata, round_num=None):
+    """
+    Merge `metadata` into the metadata of a round, or into the store-level
+    metadata if the store has no rounds yet or `round_num` is 0.
+    Only the header is rewritten; the round files are never modified.
+
+    Parameters
+    ----------
+    dirname : str
+        directory holding the store
+    metadata : dict
+        JSON-serializable entries to add or replace
+    round_num : int
+        Optional, 1-based round number. Default is the latest round.
+
+    Returns
+    -------
+    dict : the updated metadata
+    """
+    header = read_audit_store(dirname)
+    if round_num is None:
+        round_num = len(header["rounds"])
+    if round_num == 0:
+        target = header.setdefault("metadata", {})
+    elif 1 <= round_num <= len(header["rounds"]):
+        target = header["rounds"][round_num - 1]["metadata"]
+    else:
+        raise ValueError('round %s is not in the audit store, which has '
+                         'rounds 1 to %d' % (round_num, len(header["rounds"])))
+    target.update(metadata)
+    _write_header(dirname, header)
+    return target
+
+
+def load_audit_round(dirname, round_num=None, header=None):
+    """
+    Load one round from the store.
+
+    Parameters
+    ----------
+    dirname : str
+        directory holding the store
+    round_num : int
+        Optional, 1-based round number. Default is the latest round.
+    header : dict
+        Optional, the header from `read_audit_store`, to avoid rereading it
+
+    Returns
+    -------
+    dict with the header entry fields (round, n1, n2, new_n1, new_n2,
+    metadata) and
+
+    cvr_sample, nocvr_sample : numpy arrays
+        ballots drawn in this round
+    o1, o2, u1, u2 : int
+        cumulative discrepancy counts
+    observed_poll : dict
+        cumulative polling tallies keyed by candidate name
+    audit_pvalues : dict
+        risks keyed by (winner, loser)
+    arrays : dict
+        additional arrays stored with the round
+    """
+    if header is None:
+        header = read_audit_store(dirname)
+    if not header["rounds"]:
+        raise ValueError('the audit store has no rounds')
+    if round_num is None:
+        round_num = len(header["rounds"])
+    if not 1 <= round_num <= len(header["rounds"]):
+        raise ValueError('round %s is not in the audit store, which has '
+                         'rounds 1 to %d' % (round_num, len(header["rounds"])))
+    entry = header["rounds"][round_num - 1]
+    names = header["candidates"]
+
+    with np.load(os.path.join(dirname, entry["file"])) as data:
+        tallies = data["tallies"]
+        poll_counts = data["poll_counts"]
+        audit_pvalues = {}
+        for w, l, p in zip(data["pair_winner"], data["pair_loser"],
+                           data["pair_pvalue"]):
+            audit_pvalues[(names[w], names[l])] = float(p)
+        res = dict(entry)
+        res.update({"cvr_sample" : data["cvr_sample"],
+                    "nocvr_sample" : data["nocvr_sample"],
+                    "o1" : int(tallies[0]),
+                    "o2" : int(tallies[1]),
+                    "u1" : int(tallies[2]),
+                    "u2" : int(tallies[3]),
+                    "observed_poll" : dict(zip(names,
+                                               [int(v) for v in poll_counts])),
+                    "audit_pvalues" : audit_pvalues,
+                    "arrays" : dict((key[len("extra_"):], data[key]) \
+                                    for key in data.files \
+                                    if key.startswith("extra_"))
+                    })
+    return res
+
+
+def load_audit_samples(dirname, round_num=None, header=None):
+    """
+    Concatenate the samples drawn in rounds 1, ..., `round_num`.
+
+    Returns
+    -------
+    tuple : (cvr_sample, nocvr_sample), numpy arrays in the order drawn
+    """
+    if header is None:
+        header = read_audit_store(dirname)
+    if round_num is None:
+        round_num = len(header["rounds"])
+    cvr = [np.zeros(0, dtype=np.int64)]
+    nocvr = [np.zeros(0, dtype=np.int64)]
+    for entry in header["rounds"][:round_num]:
+        with np.load(os.path.join(dirname, entry["file"])) as data:
+            cvr.append(data["cvr_sample"])
+            nocvr.append(data["nocvr_sample"])
+    return (np.concatenate(cvr), np.concatenate(nocvr))
+
+
+################################################################################
+############################## Unit tests ######################################
+################################################################################
+
+def test_audit_store_roundtrip():
+    candidates = {"a" : [300, 30], "b" : [200, 20], "c" : [10, 1]}
+    dirname = tempfile.mkdtemp()
+    try:
+        create_audit_store(dirname, 0.05, [1000, 100], 1, 12345678901234567890,
+                           1.03905, 0.05, 0.001, 0, 0, 0, 0.9, candidates)
+
+        append_audit_round(dirname, np.array([5, 17, 900]), np.array([3, 44]),
+                           1, 0, 0, 0, {"a" : 1, "b" : 1, "c" : 0},
+                           {("a", "b") : 0.4, ("a", "c") : 0.02},
+                           metadata={"date" : "2018-11-20"})
+        append_audit_round(dirname, np.array([6, 7]), np.array([50]),
+                           1, 0, 1, 0, {"a" : 2, "b" : 1, "c" : 0},
+                           {("a", "b") : 0.03},
+                           arrays={"lambdas" : np.array([0.25]),
+                                   "tallies" : np.array([7])})
+
+        header = read_audit_store(dirname)
+        assert header["parameters"]["seed"] == 12345678901234567890
+        assert [r["n1"] for r in header["rounds"]] == [3, 5]
+        assert [r["n2"] for r in header["rounds"]] == [2, 3]
+
+        first = load_audit_round(dirname, 1)
+        assert first["audit_pvalues"] == {("a", "b") : 0.4, ("a", "c") : 0.02}
+        assert first["metadata"] == {"date" : "2018-11-20"}
+        last = load_audit_round(dirname)
+        assert (last["o1"], last["o2"], last["u1"], last["u2"]) == (1, 0, 1, 0)
+        assert last["observed_poll"] == {"a" : 2, "b" : 1, "c" : 0}
+        np.testing.assert_array_equal(last["arrays"]["lambdas"], [0.25])
+        np.testing.assert_array_equal(last["arrays"]["tallies"], [7])
+        for round_num in (0, -1, 3):
+            try:
+                load_audit_round(dirname, round_num)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('round %d was loaded' % round_num)
+
+        cvr, nocvr = load_audit_samples(dirname)
+        np.testing.assert_array_equal(cvr, [5, 17, 900, 6, 7])
+        np.testing.assert_array_equal(nocvr, [3, 44, 50])
+        cvr, nocvr = load_audit_samples(dirname, round_num=1)
+        np.testing.assert_array_equal(nocvr, [3, 44])
+
+        update_audit_metadata(dirname, {"note" : "escalate"})
+        update_audit_metadata(dirname, {"plan" : [10, 2]}, round_num=0)
+        header = read_audit_store(dirname)
+        assert header["rounds"][-1]["metadata"] == {"note" : "escalate"}
+        assert header["metadata"] == {"plan" : [10, 2]}
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == "__main__":
+    test_audit_store_roundtrip()
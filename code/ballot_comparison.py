@@ -3,7 +3,8 @@ import math
 import numpy as np
 import numpy.random
 import scipy as sp
-import scipy.stats
+
+import instrumentation
 
 
 def ballot_comparison_pvalue(n, gamma, o1, u1, o2, u2, reported_margin, N, null_lambda=1):
@@ -37,7 +38,7 @@ def ballot_comparison_pvalue(n, gamma, o1, u1, o2, u2, reported_margin, N, null_
 
     Returns
     -------
-    pvalue
+    pvalue : float, or array if any argument is an array
     """
     U_s = 2*N/reported_margin
     log_pvalue = n*np.log(1 - null_lambda/(gamma*U_s)) - \
@@ -46,7 +47,8 @@ def ballot_comparison_pvalue(n, gamma, o1, u1, o2, u2, reported_margin, N, null_
                     u1*np.log(1 + 1/(2*gamma)) - \
                     u2*np.log(1 + 1/gamma)
     pvalue = np.exp(log_pvalue)
-    return np.min([pvalue, 1])
+    instrumentation.count('pvalues:ballot_comparison', np.size(pvalue))
+    return np.minimum(pvalue, 1)
 
 
 def findNmin_ballot_comparison(alpha, gamma, o1, u1, o2, u2,
@@ -0,0 +1,506 @@
+"""
+Benchmarks of the hot paths of SUITE: the ballot polling and ballot
+comparison P-values, the maximization of Fisher's combined P-value, sample
+size estimation, auditing a whole contest, parsing ballot manifests and the
+simulators.
+
+Each benchmark is run at one of several scales: 'test' (seconds, for the
+unit tests), 'quick' (the default) and 'full' (populations of up to 10^7
+ballots, samples of up to 10^4 ballots and contests with 50 pairs). For each
+benchmark we record the best wall time over repeated runs, the number of
+evaluations of the underlying P-value functions and the peak memory
+allocated. Results are appended to a history file, one JSON line per
+benchmark, and can be compared with a stored baseline to flag regressions.
+
+Run from this directory, e.g.
+
+    python benchmarks.py --scale quick --baseline benchmark-baseline.json
+"""
+
+from __future__ import division, print_function
+from collections import OrderedDict
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import ballot_comparison
+import fishers_combination
+import hypergeometric
+import pvalue_cache
+import sprt
+import suite_tools
+from hypergeometric import trihypergeometric_optim, hypergeometric_optim, \
+        simulate_ballot_polling_power
+from fishers_combination import simulate_fisher_combined_audit
+from sprt import ballot_polling_sprt, simulate_sprt_stopping_times
+from suite_tools import estimate_n, estimate_escalation_n, audit_pair, \
+        audit_contest, find_winners_losers, parse_manifest
+
+
+SCALES = ('test', 'quick', 'full')
+
+# Functions whose calls are counted, wherever they are called from
+COUNTED = ((ballot_comparison, 'ballot_comparison_pvalue'),
+           (sprt, 'ballot_polling_sprt'),
+           (fishers_combination, 'fisher_combined_pvalue'),
+           (hypergeometric, 'trihypergeometric_optim'),
+           (hypergeometric, 'hypergeometric_optim'))
+
+
+################################################################################
+############################### Workloads ######################################
+################################################################################
+
+def _polling_sample(n, share_w, share_l, seed=12345):
+    """
+    A shuffled polling sample of n ballots: 1 for w, 0 for l, np.nan for the
+    rest.
+    """
+    w = int(round(n*share_w))
+    l = int(round(n*share_l))
+    sample = np.array([1]*w + [0]*l + [np.nan]*(n - w - l))
+    np.random.default_rng(seed).shuffle(sample)
+    return sample
+
+
+def _contest(num_winners, num_losers, N1, N2):
+    """
+    A contest whose winners get 30% more votes than its losers, with votes
+    split between the strata in proportion to their sizes. Returns the
+    arguments of `audit_contest` that describe it.
+    """
+    k = num_winners + num_losers
+    shares = np.array([1.3]*num_winners + [1.0]*num_losers)
+    shares = 0.9*shares/np.sum(shares)
+    candidates = OrderedDict(('c%02d' % i, [int(shares[i]*N1), \
+                                            int(shares[i]*N2)]) \
+                             for i in range(k))
+    return find_winners_losers(candidates, num_winners)
+
+
+def _sprt_case(scale):
+    (N, n) = {'test' : (10**4, 200), 'quick' : (10**6, 2000), \
+              'full' : (10**7, 10**4)}[scale]
+    sample = _polling_sample(n, 0.52, 0.46)
+    return lambda: ballot_polling_sprt(sample, N, 0.05, Vw=int(0.52*N), \
+                                       Vl=int(0.46*N))
+
+
+def _trihypergeometric_case(scale):
+    (N, n) = {'test' : (10**3, 50), 'quick' : (10**5, 500), \
+              'full' : (10**7, 2000)}[scale]
+    sample = _polling_sample(n, 0.45, 0.35)
+    return lambda: trihypergeometric_optim(sample, N, null_margin=0)
+
+
+def _hypergeometric_case(scale):
+    (N, n) = {'test' : (10**3, 50), 'quick' : (10**4, 500), \
+              'full' : (10**5, 2000)}[scale]
+    sample = _polling_sample(n, 0.45, 0.35)
+    return lambda: hypergeometric_optim(sample, N, null_margin=0)
+
+
+def _fisher_case(scale):
+    (N1, N2, n1, n2) = {'test' : (10**4, 10**3, 200, 100), \
+                        'quick' : (10**6, 10**5, 1000, 500), \
+                        'full' : (9*10**6, 10**6, 5000, 2000)}[scale]
+    (candidates, margins, winners, losers) = _contest(1, 1, N1, N2)
+    observed_poll = {winners[0] : int(0.5*n2), losers[0] : int(0.39*n2)}
+    return lambda: audit_pair(candidates, winners[0], losers[0], [N1, N2], \
+                              n1, n2, 1, 0, 0, 0, observed_poll, \
+                              risk_limit=0.05, gamma=1.03905, stepsize=0.05)
+
+
+def _estimate_n_case(scale):
+    (N1, N2) = {'test' : (10**4, 10**3), 'quick' : (10**6, 10**5), \
+                'full' : (9*10**6, 10**6)}[scale]
+    (candidates, margins, winners, losers) = _contest(1, 1, N1, N2)
+    (w, l) = (candidates[winners[0]], candidates[losers[0]])
+    return lambda: estimate_n(N_w1=w[0], N_w2=w[1], N_l1=l[0], N_l2=l[1], \
+                              N1=N1, N2=N2, o1_rate=0.001, risk_limit=0.05)
+
+
+def _estimate_escalation_n_case(scale):
+    (N1, N2, n1, n2) = {'test' : (10**4, 10**3, 200, 50), \
+                        'quick' : (10**6, 10**5, 500, 200), \
+                        'full' : (9*10**6, 10**6, 2000, 800)}[scale]
+    (candidates, margins, winners, losers) = _contest(1, 1, N1, N2)
+    (w, l) = (candidates[winners[0]], candidates[losers[0]])
+    return lambda: estimate_escalation_n(N_w1=w[0], N_w2=w[1], N_l1=l[0], \
+                       N_l2=l[1], N1=N1, N2=N2, n1=n1, n2=n2, o1_obs=2, \
+                       o2_obs=0, u1_obs=0, u2_obs=0, n2l_obs=int(0.45*n2), \
+                       n2w_obs=int(0.48*n2), o1_rate=0.001, risk_limit=0.05)
+
+
+def _audit_contest_case(scale):
+    (num_winners, num_losers, N1, N2, n1, n2) = \
+        {'test' : (1, 2, 10**4, 10**3, 200, 100), \
+         'quick' : (2, 3, 10**6, 10**5, 1000, 500), \
+         'full' : (5, 10, 9*10**6, 10**6, 5000, 2000)}[scale]
+    (candidates, margins, winners, losers) = _contest(num_winners, \
+                                                      num_losers, N1, N2)
+    observed_poll = dict((c, int(round(candidates[c][1]/N2*n2))) \
+                         for c in candidates)
+    return lambda: audit_contest(candidates, winners, losers, [N1, N2], \
+                                 n1, n2, 1, 0, 0, 0, observed_poll, \
+                                 risk_limit=0.05, gamma=1.03905, \
+                                 stepsize=0.05)
+
+
+def _manifest_case(scale):
+    (batches, size) = {'test' : (100, 100), 'quick' : (10**4, 100), \
+                       'full' : (10**4, 1000)}[scale]
+    manifest = []
+    for b in range(batches):
+        if b % 3 == 0:
+            manifest.append('b%d, %d' % (b, size))
+        elif b % 3 == 1:
+            manifest.append('b%d, %d:%d' % (b, 1000, 1000 + size - 1))
+        else:
+            manifest.append('b%d, (%s)' % (b, ' '.join(str(2*i) for i in \
+                                                        range(size))))
+    return lambda: parse_manifest(manifest)
+
+
+def _simulate_polling_case(scale):
+    (N, n, reps) = {'test' : (10**3, 50, 20), 'quick' : (10**4, 200, 200), \
+                    'full' : (10**5, 1000, 1000)}[scale]
+    return lambda: simulate_ballot_polling_power(int(0.45*N), int(0.35*N), N, \
+                       0, n, 0.05, reps=reps, verbose=False)
+
+
+def _simulate_fisher_case(scale):
+    (N1, N2, n1, n2, reps) = {'test' : (10**4, 10**3, 200, 100, 3), \
+                              'quick' : (10**5, 10**4, 500, 200, 10), \
+                              'full' : (10**6, 10**5, 1000, 500, 50)}[scale]
+    (candidates, margins, winners, losers) = _contest(1, 1, N1, N2)
+    (w, l) = (candidates[winners[0]], candidates[losers[0]])
+    return lambda: simulate_fisher_combined_audit(w[0], l[0], N1, w[1], l[1], \
+                       N2, n1, n2, 0.05, reps=reps)
+
+
+def _simulate_sprt_case(scale):
+    (N, reps, max_n) = {'test' : (10**4, 100, 1000), \
+                        'quick' : (10**5, 1000, 5000), \
+                        'full' : (10**7, 10**4, 10**4)}[scale]
+    (Nw, Nl) = (int(0.52*N), int(0.46*N))
+    return lambda: simulate_sprt_stopping_times(N, Nw, Nl, Nw, Nl, \
+                       reps=reps, max_n=max_n, seed=1)
+
+
+BENCHMARKS = OrderedDict([
+    ('ballot_polling_sprt', _sprt_case),
+    ('trihypergeometric_optim', _trihypergeometric_case),
+    ('hypergeometric_optim', _hypergeometric_case),
+    ('maximize_fisher_combined_pvalue', _fisher_case),
+    ('estimate_n', _estimate_n_case),
+    ('estimate_escalation_n', _estimate_escalation_n_case),
+    ('audit_contest', _audit_contest_case),
+    ('parse_manifest', _manifest_case),
+    ('simulate_ballot_polling_power', _simulate_polling_case),
+    ('simulate_fisher_combined_audit', _simulate_fisher_case),
+    ('simulate_sprt_stopping_times', _simulate_sprt_case),
+    ])
+
+
+################################################################################
+############################### Measuring ######################################
+################################################################################
+
+def _count_calls(fun):
+    """
+    Run fun, counting the calls to the functions in COUNTED. Every module of
+    this package that refers to one of them, e.g. through
+    `from sprt import ballot_polling_sprt`, is patched for the duration.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    modules = [m for m in list(sys.modules.values()) \
+               if getattr(m, '__file__', None) and \
+               os.path.dirname(os.path.abspath(m.__file__)) == here]
+    counts = OrderedDict((name, 0) for (module, name) in COUNTED)
+    def make_counter(name, original):
+        def counter(*args, **kwargs):
+            counts[name] += 1
+            return original(*args, **kwargs)
+        return counter
+    patched = []
+    for (module, name) in COUNTED:
+        original = getattr(module, name)
+        counter = make_counter(name, original)
+        for m in modules:
+            if getattr(m, name, None) is original:
+                setattr(m, name, counter)
+                patched.append((m, name, original))
+    try:
+        fun()
+    finally:
+        for (m, name, original) in patched:
+            setattr(m, name, original)
+    return counts
+
+
+def _peak_memory(fun):
+    """
+    Peak memory, in bytes, allocated while running fun.
+    """
+    tracemalloc.start()
+    try:
+        fun()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_benchmark(name, scale='quick', repeat=3):
+    """
+    Time one benchmark, count its evaluations and measure its peak memory.
+
+    Parameters
+    ----------
+    name : str
+        a key of BENCHMARKS
+    scale : str
+        one of SCALES. Default is 'quick'.
+    repeat : int
+        number of timed runs; the best is reported. Default is 3.
+    Returns
+    -------
+    dict : 'benchmark', 'scale', 'time' (best, in seconds), 'times',
+    'evaluations' (calls of each function in COUNTED) and 'peak_memory'
+    (in bytes)
+    """
+    assert name in BENCHMARKS, 'unknown benchmark %s' % name
+    assert scale in SCALES, 'scale must be one of %s' % (SCALES,)
+    assert repeat >= 1
+    benchmark = BENCHMARKS[name](scale)
+    def fun():
+        # every run starts without memoized P-values
+        pvalue_cache.PVALUE_CACHE.clear()
+        benchmark()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    evaluations = _count_calls(fun)
+    return {'benchmark' : name,
+            'scale' : scale,
+            'time' : min(times),
+            'times' : times,
+            'evaluations' : dict((k, v) for (k, v) in evaluations.items() \
+                                 if v > 0),
+            'peak_memory' : _peak_memory(fun)
+            }
+
+
+def _environment():
+    return {'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'machine' : platform.machine(),
+            'node' : platform.node()}
+
+
+def run_benchmarks(names=None, scale='quick', repeat=3, history=None, \
+                   verbose=False):
+    """
+    Run benchmarks, appending their results to a history file.
+
+    Parameters
+    ----------
+    names : list
+        keys of BENCHMARKS to run. Default is all of them.
+    scale, repeat :
+        as in `run_benchmark`
+    history : str
+        name of a file to which each result is appended as a JSON line,
+        together with the time, machine and versions. Optional.
+    verbose : bool
+        print each result? Default is False.
+    Returns
+    -------
+    list of dicts : the results of `run_benchmark`
+    """
+    if names is None:
+        names = list(BENCHMARKS.keys())
+    environment = _environment()
+    results = []
+    for name in names:
+        res = run_benchmark(name, scale=scale, repeat=repeat)
+        results.append(res)
+        if history is not None:
+            entry = dict(res)
+            entry.update(environment)
+            with open(history, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+        if verbose:
+            print('%-32s %-6s %10.4f s %12d bytes %s' % (name, scale, \
+                  res['time'], res['peak_memory'], \
+                  json.dumps(res['evaluations'], sort_keys=True)))
+    return results
+
+
+################################################################################
+############################### Baselines ######################################
+################################################################################
+
+def _key(result):
+    return '%s|%s' % (result['benchmark'], result['scale'])
+
+
+def load_baseline(filename):
+    """
+    Baseline results by 'benchmark|scale', or an empty dict if the file
+    does not exist.
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_baseline(results, filename):
+    """
+    Store results as the baseline, replacing earlier baselines of the same
+    benchmarks and scales and keeping the others.
+    """
+    baseline = load_baseline(filename)
+    for res in results:
+        baseline[_key(res)] = res
+    with open(filename, 'w') as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+
+
+def compare_to_baseline(results, baseline, time_tolerance=0.25, \
+                        memory_tolerance=0.25):
+    """
+    Find regressions against a baseline.
+
+    A benchmark regresses if its time or peak memory grows by more than the
+    tolerance, as a fraction of the baseline, or if it evaluates any counted
+    function more often. Benchmarks without a baseline are skipped.
+
+    Parameters
+    ----------
+    results : list
+        results of `run_benchmarks`
+    baseline : dict
+        from `load_baseline`
+    time_tolerance : float
+        allowed relative increase in time. Default is 0.25.
+    memory_tolerance : float
+        allowed relative increase in peak memory. Default is 0.25.
+    Returns
+    -------
+    list of dicts : 'benchmark', 'scale', 'metric', 'baseline' and 'value'
+    of each regression
+    """
+    regressions = []
+    for res in results:
+        base = baseline.get(_key(res))
+        if base is None:
+            continue
+        checks = [('time', res['time'], base['time'], time_tolerance),
+                  ('peak_memory', res['peak_memory'], base['peak_memory'], \
+                   memory_tolerance)]
+        for name in sorted(set(res['evaluations']) | \
+                           set(base['evaluations'])):
+            checks.append(('evaluations:' + name, \
+                           res['evaluations'].get(name, 0), \
+                           base['evaluations'].get(name, 0), 0))
+        for (metric, value, reference, tolerance) in checks:
+            if value > reference*(1 + tolerance):
+                regressions.append({'benchmark' : res['benchmark'],
+                                    'scale' : res['scale'],
+                                    'metric' : metric,
+                                    'baseline' : reference,
+                                    'value' : value})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark SUITE.')
+    parser.add_argument('names', nargs='*', metavar='benchmark', \
+                        help='benchmarks to run (default: all of %s)' % \
+                        ', '.join(BENCHMARKS.keys()))
+    parser.add_argument('--scale', choices=SCALES, default='quick')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--history', default='benchmark-history.jsonl', \
+                        help='file to which results are appended')
+    parser.add_argument('--baseline', default=None, \
+                        help='baseline file to compare the results with')
+    parser.add_argument('--save-baseline', action='store_true', \
+                        help='store the results in the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25, \
+                        help='allowed relative increase in time and memory')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.names or None, scale=args.scale, \
+                             repeat=args.repeat, history=args.history, \
+                             verbose=True)
+    if args.baseline is None:
+        return 0
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        return 0
+    regressions = compare_to_baseline(results, load_baseline(args.baseline), \
+                                      time_tolerance=args.tolerance, \
+                                      memory_tolerance=args.tolerance)
+    for r in regressions:
+        print('REGRESSION %s (%s): %s %s -> %s' % (r['benchmark'], \
+              r['scale'], r['metric'], r['baseline'], r['value']))
+    return 1 if regressions else 0
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_benchmarks():
+    import shutil
+    import tempfile
+    dirname = tempfile.mkdtemp()
+    try:
+        history = os.path.join(dirname, 'history.jsonl')
+        results = run_benchmarks(['ballot_polling_sprt', 'audit_contest', \
+                                  'parse_manifest'], scale='test', repeat=1, \
+                                 history=history)
+        assert [r['benchmark'] for r in results] == \
+            ['ballot_polling_sprt', 'audit_contest', 'parse_manifest']
+        assert results[0]['evaluations'] == {'ballot_polling_sprt' : 1}
+        contest = results[1]['evaluations']
+        assert contest['ballot_polling_sprt'] > 0
+        assert contest['ballot_comparison_pvalue'] > 0
+        assert results[2]['evaluations'] == {}
+        assert all(r['time'] > 0 and r['peak_memory'] > 0 for r in results)
+        with open(history) as f:
+            entries = [json.loads(line) for line in f]
+        assert [e['benchmark'] for e in entries] == \
+            [r['benchmark'] for r in results]
+        assert 'numpy' in entries[0]
+
+        # the counters are removed afterwards
+        assert suite_tools.ballot_polling_sprt is sprt.ballot_polling_sprt
+
+        filename = os.path.join(dirname, 'baseline.json')
+        save_baseline(results, filename)
+        baseline = load_baseline(filename)
+        assert compare_to_baseline(results, baseline) == []
+        slower = dict(results[1], time=2*results[1]['time'])
+        slower['evaluations'] = dict(contest, ballot_polling_sprt=\
+                                     contest['ballot_polling_sprt'] + 1)
+        regressions = compare_to_baseline([slower], baseline)
+        assert [r['metric'] for r in regressions] == \
+            ['time', 'evaluations:ballot_polling_sprt']
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
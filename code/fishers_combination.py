@@ -1,12 +1,11 @@
 import numpy as np
 import scipy as sp
-import scipy.stats
-import scipy.optimize
+import scipy.special
+import instrumentation
 from ballot_comparison import ballot_comparison_pvalue
-from hypergeometric import trihypergeometric_optim
-from sprt import ballot_polling_sprt
-import matplotlib.pyplot as plt
-import numpy.testing
+from hypergeometric import trihypergeometric_optim, polling_sample_logpmf, \
+    _polling_sample_grid
+from sprt import ballot_polling_sprt, ballot_polling_sprt_pvalues
 
 def fisher_combined_pvalue(pvalues):
     """
@@ -25,7 +24,23 @@ def fisher_combined_pvalue(pvalues):
     if np.any(np.array(pvalues)==0):
         return 0
     obs = -2*np.sum(np.log(pvalues))
-    return 1-scipy.stats.chi2.cdf(obs, df=2*len(pvalues))
+    return 1-_chi2_cdf(obs, df=2*len(pvalues))
+
+
+def _chi2_cdf(x, df):
+    """
+    CDF of the chi-squared distribution. Same as scipy.stats.chi2.cdf, which
+    is slow to import.
+    """
+    return scipy.special.chdtr(df, x)
+
+
+def _chi2_ppf(q, df):
+    """
+    Quantile function of the chi-squared distribution. Same as
+    scipy.stats.chi2.ppf, which is slow to import.
+    """
+    return 2*scipy.special.gammaincinv(df/2, q)
 
 
 def create_modulus(n1, n2, n_w2, n_l2, N1, V_wl, gamma):
@@ -56,8 +71,10 @@ def create_modulus(n1, n2, n_w2, n_l2, N1, V_wl, gamma):
             2*Un*np.log(1 + 3*V_wl*delta) + 2*n1*np.log(1 + V_wl*delta/(2*N1*gamma))
 
 
+@instrumentation.timed('maximize_fisher_combined_pvalue')
 def maximize_fisher_combined_pvalue(N_w1, N_l1, N1, N_w2, N_l2, N2,
-    pvalue_funs, stepsize=0.05, modulus=None, alpha=0.05, feasible_lambda_range=None):
+    pvalue_funs, stepsize=0.05, modulus=None, alpha=0.05, feasible_lambda_range=None,
+    lambda_guess=None):
     """
     Grid search to find the maximum P-value.
 
@@ -92,6 +109,13 @@ def maximize_fisher_combined_pvalue(N_w1, N_l1, N1, N_w2, N_l2, N2,
     feasible_lambda_range : array-like
         lower and upper limits to search over lambda. 
         Optional, but a smaller interval will speed up the search.
+    lambda_guess : float
+        Optional, a lambda near which the maximum is expected, e.g. the
+        maximizer for the data of the previous round. The grid is searched
+        outward from it, and the second P-value function, which should be
+        the expensive one, is skipped at lambdas where even a second P-value
+        of 1 could not beat the largest combined P-value found so far. The
+        result is the same as without a guess.
 
     Returns
     -------
@@ -121,20 +145,28 @@ def maximize_fisher_combined_pvalue(N_w1, N_l1, N1, N_w2, N_l2, N2,
     if len(test_lambdas) < 5:
         stepsize = (lambda_upper + 1 - lambda_lower)/5
         test_lambdas = np.arange(lambda_lower, lambda_upper+stepsize, stepsize)
-    fisher_pvalues = np.empty_like(test_lambdas)
-    for i in range(len(test_lambdas)):
-        pvalue1 = np.min([1, pvalue_funs[0](test_lambdas[i])])
-        pvalue2 = np.min([1, pvalue_funs[1](1-test_lambdas[i])])
-        fisher_pvalues[i] = fisher_combined_pvalue([pvalue1, pvalue2])
-        
-    pvalue = np.max(fisher_pvalues)
-    alloc_lambda = test_lambdas[np.argmax(fisher_pvalues)]
+    with instrumentation.stage('maximize_fisher_combined_pvalue.grid'):
+        if lambda_guess is None:
+            fisher_pvalues = np.empty_like(test_lambdas)
+            for i in range(len(test_lambdas)):
+                pvalue1 = np.min([1, pvalue_funs[0](test_lambdas[i])])
+                pvalue2 = np.min([1, pvalue_funs[1](1-test_lambdas[i])])
+                fisher_pvalues[i] = fisher_combined_pvalue([pvalue1, pvalue2])
+        else:
+            fisher_pvalues = _warm_start_grid(test_lambdas, pvalue_funs, \
+                                              lambda_guess)
+    instrumentation.count('lambda_grid_points', \
+                          int(np.sum(~np.isnan(fisher_pvalues))))
+
+    # lambdas that were skipped are nan, and below the maximum
+    pvalue = np.nanmax(fisher_pvalues)
+    alloc_lambda = test_lambdas[np.nanargmax(fisher_pvalues)]
     
     # If p-value is over the risk limit, then there's no need to refine the
     # maximization. We have a lower bound on the maximum.
     if pvalue > alpha or modulus is None:
         return {'max_pvalue' : pvalue,
-                'min_chisq' : sp.stats.chi2.ppf(1 - pvalue, df=4),
+                'min_chisq' : _chi2_ppf(1 - pvalue, df=4),
                 'allocation lambda' : alloc_lambda,
                 'tol' : None,
                 'stepsize' : stepsize,
@@ -143,8 +175,8 @@ def maximize_fisher_combined_pvalue(N_w1, N_l1, N1, N_w2, N_l2, N2,
     
     # Use modulus of continuity for the Fisher combination function to check
     # how close this is to the true max
-    fisher_fun_obs = scipy.stats.chi2.ppf(1-pvalue, df=4)
-    fisher_fun_alpha = scipy.stats.chi2.ppf(1-alpha, df=4)
+    fisher_fun_obs = _chi2_ppf(1-pvalue, df=4)
+    fisher_fun_alpha = _chi2_ppf(1-alpha, df=4)
     dist = np.abs(fisher_fun_obs - fisher_fun_alpha)
     mod = modulus(stepsize)
 
@@ -161,60 +193,236 @@ def maximize_fisher_combined_pvalue(N_w1, N_l1, N1, N_w2, N_l2, N2,
         lambda_upper = alloc_lambda + 2*stepsize
         refined = maximize_fisher_combined_pvalue(N_w1, N_l1, N1, N_w2, N_l2, N2,
             pvalue_funs, stepsize=stepsize/10, modulus=modulus, alpha=alpha, 
-            feasible_lambda_range=(lambda_lower, lambda_upper))
+            feasible_lambda_range=(lambda_lower, lambda_upper),
+            lambda_guess=None if lambda_guess is None else alloc_lambda)
         refined['refined'] = True
+        instrumentation.count('fisher_refinements')
+        instrumentation.record_max('refinement_depth', \
+            int(round(np.log10(stepsize/refined['stepsize']))))
         return refined
 
 
-def plot_fisher_pvalues(N, overall_margin, pvalue_funs, alpha=None):
+def _warm_start_grid(test_lambdas, pvalue_funs, lambda_guess, width=2):
+    """
+    Combined P-values on the grid test_lambdas, as in
+    `maximize_fisher_combined_pvalue`, starting from the `width` lambdas on
+    either side of lambda_guess. Elsewhere, the first P-value bounds the
+    combined P-value by fisher_combined_pvalue([pvalue1, 1]); lambdas whose
+    bound is below the largest combined P-value found are left as nan,
+    without evaluating the second P-value there. The largest value and the
+    first lambda attaining it are those of the full grid.
+    """
+    fisher_pvalues = np.full(len(test_lambdas), np.nan)
+    pvalues1 = np.array([np.min([1, pvalue_funs[0](lam)]) \
+                         for lam in test_lambdas])
+    def evaluate(i):
+        pvalue2 = np.min([1, pvalue_funs[1](1-test_lambdas[i])])
+        fisher_pvalues[i] = fisher_combined_pvalue([pvalues1[i], pvalue2])
+
+    center = int(np.argmin(np.abs(test_lambdas - lambda_guess)))
+    window = range(max(0, center - width), \
+                   min(len(test_lambdas), center + width + 1))
+    for i in window:
+        evaluate(i)
+    best = np.nanmax(fisher_pvalues)
+    bounds = np.array([fisher_combined_pvalue([p, 1]) for p in pvalues1])
+    # the most promising lambdas first, so that the rest can be skipped
+    for i in np.argsort(-bounds, kind='stable'):
+        if bounds[i] < best:
+            break
+        if np.isnan(fisher_pvalues[i]):
+            evaluate(i)
+            best = max(best, fisher_pvalues[i])
+    return fisher_pvalues
+
+
+def unique_rows(table):
     """
-    Plot the Fisher's combined p-value for varying error allocations 
-    using data X=(X1, X2) 
+    The distinct rows of a 2-d array, like np.unique(table, axis=0,
+    return_inverse=True), but sorting the columns with np.lexsort, which
+    is much faster than sorting the rows as single items.
+
+    Returns
+    -------
+    tuple : (distinct rows, index of each row of `table` among them)
+    """
+    if len(table) == 0:
+        return (table, np.zeros(0, dtype=int))
+    order = np.lexsort(table.T[::-1])
+    ordered = table[order]
+    new_row = np.ones(len(table), dtype=bool)
+    new_row[1:] = np.any(ordered[1:] != ordered[:-1], axis=1)
+    index = np.empty(len(table), dtype=int)
+    index[order] = np.cumsum(new_row) - 1
+    return (ordered[new_row], index)
+
+
+def _lambda_grids(lambda_lower, lambda_upper, stepsize):
+    """
+    The grids of `maximize_fisher_combined_pvalue` for many ranges at once.
+    Row i holds the values of np.arange(lambda_lower[i], lambda_upper[i] +
+    stepsize[i], stepsize[i]) (after the adjustment for grids with fewer
+    than 5 points), padded on the right; `valid` masks the padding.
+    """
+    length = np.ceil((lambda_upper + stepsize - lambda_lower)/stepsize)
+    short = length < 5
+    stepsize = np.where(short, (lambda_upper + 1 - lambda_lower)/5, stepsize)
+    length = np.where(short,
+                      np.ceil((lambda_upper + stepsize - lambda_lower)/stepsize),
+                      length).astype(int)
+    # np.arange steps by the representable difference of its first two values
+    delta = (lambda_lower + stepsize) - lambda_lower
+    index = np.arange(np.max(length))
+    lambdas = lambda_lower[:, None] + index[None, :]*delta[:, None]
+    valid = index[None, :] < length[:, None]
+    return (lambdas, valid, stepsize)
+
+
+def maximize_fisher_combined_pvalue_batch(N_w1, N_l1, N1, N_w2, N_l2, N2,
+    n1, o1, o2, u1, u2, n2, n_w2, n_l2, gamma=1.03905, stepsize=0.05,
+    alpha=0.05, refine=True, feasible_lambda_range=None, max_refinements=10):
+    """
+    `maximize_fisher_combined_pvalue` for many SUITE hypotheses at once,
+    with the Kaplan-Markov P-value in the CVR stratum and the SPRT P-value
+    in the no-CVR stratum, as in `suite_tools.audit_pair`.
+
+    Instead of P-value functions, this takes the reported votes and the
+    sample counts; all of them are broadcast against each other. The
+    stratum P-values are computed for every row and every lambda on the
+    grid in one pass, and rows that need a finer grid are refined together.
 
     Parameters
     ----------
-    N : array_like
-        Array of stratum sizes
-    overall_margin : int
-        the difference in votes for reported winner and loser in the population
-    pvalue_funs : array_like
-        functions for computing p-values. The observed statistics/sample and known parameters should be plugged in already. The function should take the lambda allocation AS INPUT and output a p-value.
+    N_w1, N_l1, N1, N_w2, N_l2, N2 : array-like
+        as in `maximize_fisher_combined_pvalue`
+    n1 : array-like
+        sample size in the CVR stratum
+    o1, o2, u1, u2 : array-like
+        discrepancy counts in the CVR sample, as in `ballot_comparison_pvalue`
+    n2 : array-like
+        sample size in the no-CVR stratum
+    n_w2 : array-like
+        votes for the reported winner in the no-CVR sample
+    n_l2 : array-like
+        votes for the reported loser in the no-CVR sample
+    gamma : float
+        gamma from the ballot comparison audit. Default is 1.03905.
+    stepsize : float
+        size of the initial grid. Default is 0.05.
     alpha : float
-        Optional, desired upper percentage point
-    
+        Risk limit. Default is 0.05.
+    refine : bool
+        Refine the grid search using the modulus of continuity from
+        `create_modulus`? Default True.
+    feasible_lambda_range : tuple of array-like
+        lower and upper limits to search over lambda. Optional; default is
+        the range from `calculate_lambda_range`.
+    max_refinements : int
+        the most times the grid of any one row is refined. Default is 10.
+
     Returns
     -------
-    dict with 
-    
-    float
-        maximum combined p-value
-    float
-        minimum value of Fisher's combined test statistic
-    float
-        lambda, the parameter that minimizes the Fisher's combined statistic/maximizes the combined p-value
+    dict with the keys of `maximize_fisher_combined_pvalue`; each value is an
+    array with the broadcast shape of the inputs. 'tol' is nan where it would
+    be None.
     """
-    assert len(N)==2
-    assert len(pvalue_funs)==2
-        
-    # find range of possible lambda
-    (lambda_lower, lambda_upper) = calculate_lambda_range(N_w1, N_l1, N1, N_w2, N_l2, N2)
-
-    fisher_pvalues = []
-    cvr_pvalues = []
-    nocvr_pvalues = []
-    for lam in np.arange(lambda_lower, lambda_upper+1, 0.5):
-        pvalue1 = np.min([1, pvalue_funs[0](lam)])
-        pvalue2 = np.min([1, pvalue_funs[1](1-lam)])
-        fisher_pvalues.append(fisher_combined_pvalue([pvalue1, pvalue2]))
-
-    plt.scatter(np.arange(lambda_lower, lambda_upper+1, 0.5), fisher_pvalues, color='black')
-    if alpha is not None:
-        plt.axhline(y=alpha, linestyle='--', color='gray')
-    plt.xlabel("Allocation of Allowable Error")
-    plt.ylabel("Fisher Combined P-value")
-    plt.show()
-    
-    
+    arrays = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in \
+        (N_w1, N_l1, N1, N_w2, N_l2, N2, n1, o1, o2, u1, u2, n2, n_w2, n_l2)])
+    shape = arrays[0].shape
+    (N_w1, N_l1, N1, N_w2, N_l2, N2, n1, o1, o2, u1, u2, n2, n_w2, n_l2) = \
+        [a.ravel() for a in arrays]
+    V = (N_w1 + N_w2) - (N_l1 + N_l2)
+    if feasible_lambda_range is None:
+        feasible_lambda_range = calculate_lambda_range(N_w1, N_l1, N1,
+                                                       N_w2, N_l2, N2)
+    (lambda_lower, lambda_upper) = [np.broadcast_to(np.asarray(lim, \
+        dtype=float), N1.shape).ravel() for lim in feasible_lambda_range]
+    Un = n2 - n_w2 - n_l2
+    assert np.all(n_w2 >= 0) and np.all(n_l2 >= 0) and np.all(Un >= 0)
+    fisher_fun_alpha = _chi2_ppf(1-alpha, df=4)
+
+    res = {'max_pvalue' : np.empty_like(V),
+           'min_chisq' : np.empty_like(V),
+           'allocation lambda' : np.empty_like(V),
+           'stepsize' : np.empty_like(V),
+           'tol' : np.full_like(V, np.nan),
+           'refined' : np.zeros(V.shape, dtype=bool)
+           }
+    rows = np.arange(len(V))
+    step = np.full_like(V, stepsize)
+    for level in range(max_refinements + 1):
+        (lambdas, valid, step) = _lambda_grids(lambda_lower, lambda_upper, step)
+        instrumentation.count('lambda_grid_points', int(np.sum(valid)))
+        instrumentation.record_max('refinement_depth', level)
+        col = lambda a: a[rows][:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pvalue1 = ballot_comparison_pvalue(n=col(n1), gamma=gamma, \
+                        o1=col(o1), u1=col(u1), o2=col(o2), u2=col(u2), \
+                        reported_margin=col(V), N=col(N1), null_lambda=lambdas)
+        pvalue1 = np.where(col(n1) == 0, 1.0, np.minimum(1, pvalue1))
+        pvalue2 = np.ones_like(lambdas)
+        polled = np.nonzero((col(n2) > 0) & valid)
+        if len(polled[0]) > 0:
+            r = rows[polled[0]]
+            # rows often share the no-CVR sample; evaluate each SPRT once
+            sprt_args = np.column_stack([n_w2[r], n_l2[r], Un[r], N2[r], \
+                N_w2[r], N_l2[r], \
+                (N_w2[r] - N_l2[r]) - (1 - lambdas[polled])*V[r]])
+            (sprt_args, index) = unique_rows(sprt_args)
+            instrumentation.count('cache_hits:sprt_rows', \
+                                  len(index) - len(sprt_args))
+            pvalue2[polled] = ballot_polling_sprt_pvalues(*sprt_args.T)[index]
+            pvalue2 = np.minimum(1, pvalue2)
+        with np.errstate(divide='ignore'):
+            obs = -2*(np.log(pvalue1) + np.log(pvalue2))
+        fisher_pvalues = np.where((pvalue1 == 0) | (pvalue2 == 0), 0.0, \
+                                  1 - _chi2_cdf(obs, df=4))
+        fisher_pvalues = np.where(valid, fisher_pvalues, -np.inf)
+
+        best = np.argmax(fisher_pvalues, axis=1)
+        pvalue = fisher_pvalues[np.arange(len(rows)), best]
+        alloc_lambda = lambdas[np.arange(len(rows)), best]
+        res['max_pvalue'][rows] = pvalue
+        res['min_chisq'][rows] = _chi2_ppf(1 - pvalue, df=4)
+        res['allocation lambda'][rows] = alloc_lambda
+        res['stepsize'][rows] = step
+        res['refined'][rows] = level > 0
+        res['tol'][rows] = np.nan
+        if not refine:
+            break
+
+        # Rows under the risk limit are checked against the modulus of
+        # continuity, and refined if the grid might be too coarse
+        checked = ~(pvalue > alpha)
+        r = rows[checked]
+        s = step[checked]
+        mod = 2*n_w2[r]*np.log(1 + V[r]*s) + 2*n_l2[r]*np.log(1 + 2*V[r]*s) + \
+              2*Un[r]*np.log(1 + 3*V[r]*s) + \
+              2*n1[r]*np.log(1 + V[r]*s/(2*N1[r]*gamma))
+        res['tol'][r] = mod
+        dist = np.abs(res['min_chisq'][r] - fisher_fun_alpha)
+        again = np.zeros_like(checked)
+        again[np.flatnonzero(checked)[~(mod <= dist)]] = True
+        if not np.any(again):
+            break
+        rows = rows[again]
+        lambda_lower = alloc_lambda[again] - 2*step[again]
+        lambda_upper = alloc_lambda[again] + 2*step[again]
+        step = step[again]/10
+    res = dict((k, v.reshape(shape)) for k, v in res.items())
+    return res
+
+
+def plot_fisher_pvalues(*args, **kwargs):
+    """
+    Plot Fisher's combined P-value against the error allocation; see
+    `plotting.plot_fisher_pvalues`. Plotting lives in its own module so that
+    importing this one does not import matplotlib.
+    """
+    from plotting import plot_fisher_pvalues
+    return plot_fisher_pvalues(*args, **kwargs)
+
+
 def simulate_fisher_combined_audit(N_w1, N_l1, N1, N_w2, N_l2, N2, n1, n2, alpha,
     reps=10000, verbose=False, feasible_lambda_range=None):
     """
@@ -282,10 +490,69 @@ def simulate_fisher_combined_audit(N_w1, N_l1, N1, N_w2, N_l2, N2, n1, n2, alpha
                                N1, N_w2, N_l2, N2,
                                pvalue_funs=[cvr_pvalue, nocvr_pvalue],
                                modulus=mod,
-                               plausible_lambda_range=plausible_lambda_range)['max_pvalue']
+                               feasible_lambda_range=feasible_lambda_range)['max_pvalue']
     return np.mean(fisher_pvalues <= alpha)
 
 
+def fisher_combined_power(N_w1, N_l1, N1, N_w2, N_l2, N2, n1, n2, alpha,
+    gamma=1.03905, stepsize=0.05, tol=1e-12, feasible_lambda_range=None):
+    """
+    Exact power of the Fisher method of combining a ballot comparison audit
+    and ballot polling audit, assuming the reported results are correct, so
+    that the CVR sample has no discrepancies. This is the fraction that
+    `simulate_fisher_combined_audit` estimates.
+
+    The Kaplan-Markov P-value is then fixed, and the decision depends only
+    on the polling counts (w, l, u), which have a multivariate
+    hypergeometric distribution. All counts with probability above tol are
+    evaluated together by `maximize_fisher_combined_pvalue_batch`, and the
+    power is the total probability of those that confirm the results; the
+    error is at most (n2+1)(n2+2)/2 * tol.
+
+    Parameters
+    ----------
+    N_w1 : int
+        votes for the reported winner in the ballot comparison stratum
+    N_l1 : int
+        votes for the reported loser in the ballot comparison stratum
+    N1 : int
+        total number of votes in the ballot comparison stratum
+    N_w2 : int
+        votes for the reported winner in the ballot polling stratum
+    N_l2 : int
+        votes for the reported loser in the ballot polling stratum
+    N2 : int
+        total number of votes in the ballot polling stratum
+    n1 : int
+        sample size in the ballot comparison stratum
+    n2 : int
+        sample size in the ballot polling stratum
+    alpha : float
+        risk limit
+    gamma : float
+        gamma from the ballot comparison audit. Default is 1.03905.
+    stepsize : float
+        size of the grid for searching over lambda. Default is 0.05
+    tol : float
+        smallest probability of polling counts that are evaluated.
+        Default is 1e-12
+    feasible_lambda_range : array-like
+        lower and upper limits to search over lambda. Optional, but will speed up the search
+
+    Returns
+    -------
+    float : probability that the audit confirms the election results
+    """
+    w, l = _polling_sample_grid(n2)
+    prob = np.exp(polling_sample_logpmf(w, l, n2, N_w2, N_l2, N2))
+    keep = prob > tol
+    res = maximize_fisher_combined_pvalue_batch(N_w1, N_l1, N1, N_w2, N_l2, N2,
+              n1, 0, 0, 0, 0, n2, w[keep], l[keep], gamma=gamma,
+              stepsize=stepsize, alpha=alpha,
+              feasible_lambda_range=feasible_lambda_range)
+    return np.sum(prob[keep][res['max_pvalue'] <= alpha])
+
+
 def calculate_lambda_range(N_w1, N_ell1, N_1, N_w2, N_ell2, N_2):
     '''
     Find the largest and smallest possible values of lambda.
@@ -307,7 +574,8 @@ def calculate_lambda_range(N_w1, N_ell1, N_1, N_w2, N_ell2, N_2):
    
     Returns:
     --------
-        (lb, ub): real ordered pair. lb is a sharp lower bound on lambda; ub is a sharp upper bound
+        (lb, ub): real ordered pair. lb is a sharp lower bound on lambda; ub is a sharp upper bound.
+        The inputs may be arrays, in which case lb and ub are arrays.
     
     Derivation:
     -----------
@@ -335,8 +603,8 @@ def calculate_lambda_range(N_w1, N_ell1, N_1, N_w2, N_ell2, N_2):
        lambda <= min( N_w1 - N_ell1 + N_1, V - (N_w2 - N_ell2 - N_2) )/V.
     '''
     V = N_w1 + N_w2 - N_ell1 - N_ell2
-    lb = np.amax([N_w1 - N_ell1 - N_1, V - (N_w2 - N_ell2 + N_2)] )/V
-    ub = np.amin([ N_w1 - N_ell1 + N_1, V - (N_w2 - N_ell2 - N_2)] )/V       
+    lb = np.maximum(N_w1 - N_ell1 - N_1, V - (N_w2 - N_ell2 + N_2))/V
+    ub = np.minimum(N_w1 - N_ell1 + N_1, V - (N_w2 - N_ell2 - N_2))/V
     return (lb, ub)
     
     
@@ -464,7 +732,58 @@ def test_modulus1():
     v1 = np.abs(fisher_fun(0.8 + 0.001) - fisher_fun(0.8))
     v2 = mod(0.001)
     np.testing.assert_array_less(v1, v2)
-    
-    
+
+
+
+def test_fisher_combined_power():
+    from hypergeometric import trihypergeometric_pmf
+    (N_w1, N_l1, N1, N_w2, N_l2, N2) = (550, 400, 1000, 60, 30, 100)
+    (n1, n2) = (60, 6)
+    margin = (N_w1 + N_w2) - (N_l1 + N_l2)
+    cvr_pvalue = lambda alloc: ballot_comparison_pvalue(n=n1, gamma=1.03905, \
+        o1=0, u1=0, o2=0, u2=0, reported_margin=margin, N=N1, null_lambda=alloc)
+    expected = 0
+    for w in range(n2+1):
+        for l in range(n2+1-w):
+            sample = np.array([1]*w + [0]*l + [np.nan]*(n2-w-l))
+            nocvr_pvalue = lambda alloc: \
+                ballot_polling_sprt(sample=sample, popsize=N2, alpha=0.1,
+                                    Vw=N_w2, Vl=N_l2,
+                                    null_margin=(N_w2-N_l2) - alloc*margin)['pvalue']
+            mod = create_modulus(n1, n2, w, l, N1, margin, 1.03905)
+            pvalue = maximize_fisher_combined_pvalue(N_w1, N_l1, N1, N_w2, N_l2,
+                         N2, pvalue_funs=[cvr_pvalue, nocvr_pvalue],
+                         modulus=mod, alpha=0.1)['max_pvalue']
+            if pvalue <= 0.1:
+                expected += trihypergeometric_pmf(w, l, n2, N_w2, N_l2, N2)
+    assert 0 < expected < 1
+    np.testing.assert_almost_equal(fisher_combined_power(N_w1, N_l1, N1,
+        N_w2, N_l2, N2, n1, n2, 0.1, tol=0), expected)
+
+
+def test_maximize_lambda_guess():
+    # a guess gives the full search's result, even with two local maxima
+    # and a guess at the lower one, with fewer second P-values
+    calls = []
+    def pvalue2(alloc):
+        calls.append(alloc)
+        lam = 1 - alloc
+        return 0.02 + 0.5*np.exp(-50*(lam - 0.3)**2) + \
+               0.8*np.exp(-50*(lam - 1.2)**2)
+    pvalue_funs = (lambda lam: 0.3*np.exp(-lam), pvalue2)
+    expected = maximize_fisher_combined_pvalue(1000, 900, 2000, 500, 400, \
+        1000, pvalue_funs, feasible_lambda_range=(-1, 2))
+    full_calls = len(calls)
+    for guess in (-1, 0.3, 1.2, 2):
+        del calls[:]
+        res = maximize_fisher_combined_pvalue(1000, 900, 2000, 500, 400, \
+            1000, pvalue_funs, feasible_lambda_range=(-1, 2), \
+            lambda_guess=guess)
+        assert res == expected
+        assert len(calls) < full_calls
+
+
 if __name__ == "__main__":
-    test_modulus1()
\ No newline at end of file
+    test_modulus1()
+    test_fisher_combined_power()
+    test_maximize_lambda_guess()
\ No newline at end of file
@@ -5,24 +5,35 @@ import math
 import numpy as np
 import numpy.random
 import scipy as sp
-from scipy.special import comb, gammaln as gamln
-import scipy.stats
-from scipy.optimize import minimize_scalar
+from scipy.special import comb
+import kernels
+from logfactorial import log_factorial
+# scipy.stats and scipy.optimize are slow to import, so they are imported in
+# the functions that use them
 import itertools
 
 ### Tri-hypergeometric distribution tests
 
 def trihypergeometric_logpmf(w, l, n, N_w, N_l, N):
-    return gamln(N_w+1) - gamln(N_w-w+1) - gamln(w+1) \
-            + gamln(N_l+1) - gamln(N_l-l+1) - gamln(l+1) \
-            + gamln(N-N_w-N_l+1) - gamln(N-N_w-N_l-n+w+l+1) - gamln(n-w-l+1) \
-            - gamln(N+1) + gamln(N-n+1) + gamln(n+1)
+    return log_factorial(N_w) - log_factorial(N_w-w) - log_factorial(w) \
+            + log_factorial(N_l) - log_factorial(N_l-l) - log_factorial(l) \
+            + log_factorial(N-N_w-N_l) - log_factorial(N-N_w-N_l-n+w+l) \
+            - log_factorial(n-w-l) \
+            - log_factorial(N) + log_factorial(N-n) + log_factorial(n)
 
 
 def trihypergeometric_pmf(w, l, n, N_w, N_l, N):
     return np.exp(trihypergeometric_logpmf(w, l, n, N_w, N_l, N))
 
 
+def _polling_sample_grid(n):
+    """
+    All pairs (w, l) of nonnegative integers with w+l <= n.
+    """
+    w, l = np.nonzero(np.add.outer(np.arange(n+1), np.arange(n+1)) <= n)
+    return w, l
+
+
 def diluted_margin_trihypergeometric_gamma(w, l, n, N_w, N_l, N):
     """
     Conduct tri-hypergeometric test
@@ -57,10 +68,9 @@ def diluted_margin_trihypergeometric_gamma(w, l, n, N_w, N_l, N):
         The test conditions on n.
     """
     N_u = N-N_w-N_l
-    pairs = itertools.product(range(n+1), range(n+1))   # Cartesian product
-    pairs = itertools.filterfalse(lambda y: sum(y) > n or y[0] - y[1] < (w-l), pairs)
-    pairs = itertools.filterfalse(lambda y: y[0] > N_w or y[1] > N_l or n-y[0]-y[1] > N_u, pairs)
-    return sum(map(lambda p: trihypergeometric_pmf(p[0], p[1], n, N_w, N_l, N), pairs))
+    ww, ll = _polling_sample_grid(n)
+    keep = (ww - ll >= w-l) & (ww <= N_w) & (ll <= N_l) & (n-ww-ll <= N_u)
+    return np.sum(trihypergeometric_pmf(ww[keep], ll[keep], n, N_w, N_l, N))
 
 
 def trihypergeometric_optim(sample, popsize, null_margin):
@@ -91,6 +101,7 @@ def trihypergeometric_optim(sample, popsize, null_margin):
         divided by the sample size n, will be greater than or equal to (w-l)/n.
         The test conditions on n.
     '''
+    import scipy.optimize
     
     w = sum(sample==1)
     l = sum(sample==0)
@@ -103,7 +114,7 @@ def trihypergeometric_optim(sample, popsize, null_margin):
     upper_Nw = int((popsize-u+null_margin)/2)
     lower_Nw = int(np.max([w, null_margin]))
     
-    res = minimize_scalar(optim_fun, 
+    res = sp.optimize.minimize_scalar(optim_fun, 
                        bracket = [lower_Nw, upper_Nw],
                        method = 'brent')
     if res['x'] > upper_Nw:
@@ -192,6 +203,8 @@ def diluted_margin_trihypergeometric2(w, l, n, N_w, N_l, N, exact=True):
         divided by the sample size n, will be greater than or equal to (w-l)/n.
         The test conditions on n.
     """
+    if not exact and kernels.ENABLED:
+        return kernels.trihypergeometric_tail(w, l, n, N_w, N_l, N)
     pvalue = 0
     N_u = N-N_w-N_l
     for ww in range(w-l, n+1):
@@ -260,20 +273,19 @@ def gen_sample(w, n):
     return sample
     
 
-def simulate_ballot_polling_power(N_w, N_l, N, null_margin, n, alpha, reps=10000,
-    stepsize=5, seed=987654321, verbose=True):
+def trihypergeometric_critical_margin(N_w, N, null_margin, n, alpha,
+                                      stepsize=5, verbose=False):
     """
-    Simulate the power of the trihypergeometric ballot polling audit.
-    This simulation assumes that the reported vote totals are true and
-    draws `reps` samples of size n from the population, then computes
-    the proportion of samples for which the audit could stop.
+    Find the smallest diluted margin w-l in a sample of size n for which
+    `trihypergeometric_optim` rejects the null at level alpha.
+    Helper function for `simulate_ballot_polling_power` and
+    `trihypergeometric_power`.
     
     Parameters
     ----------
     N_w : int
-        total number of *reported* votes for w in the population
-    N_l : int
-        total number of *reported* votes for l in the population
+        total number of *reported* votes for w in the population, used for
+        the starting point of the search
     N : int
         total number of ballots in the population
     null_margin : int
@@ -283,19 +295,15 @@ def simulate_ballot_polling_power(N_w, N_l, N, null_margin, n, alpha, reps=10000
         number of ballots in the sample
     alpha : float
         risk limit
-    reps : int
-        number of simulation runs. Default is 10000
     stepsize : int
         when searching for the threshold margin, what step size to use? Default is 5
-    seed : int
-        random seed value for the pseudorandom number generator. Default is 987654321
     verbose : bool
-        print (margin, pvalue) pairs? Default is True
+        print (margin, pvalue) pairs? Default is False
+    Returns
+    -------
+    int
+        critical value of the diluted margin
     """
-    np.random.seed(seed)
-    
-    # step 1: find diluted margin for which we'd reject
-    # the p-value depends only on the margin, not the values of w and l
     if verbose:
         print("Step 1: find diluted margin for which the p-value <= alpha")
     w = int(n*N_w/N)
@@ -331,16 +339,62 @@ def simulate_ballot_polling_power(N_w, N_l, N, null_margin, n, alpha, reps=10000
             if verbose:
                 print(w, pvalue_mar)
         threshold = w+1
+    return threshold
+
+
+def simulate_ballot_polling_power(N_w, N_l, N, null_margin, n, alpha, reps=10000,
+    stepsize=5, seed=987654321, verbose=True):
+    """
+    Simulate the power of the trihypergeometric ballot polling audit.
+    This simulation assumes that the reported vote totals are true and
+    draws `reps` samples of size n from the population, then computes
+    the proportion of samples for which the audit could stop.
+    
+    Parameters
+    ----------
+    N_w : int
+        total number of *reported* votes for w in the population
+    N_l : int
+        total number of *reported* votes for l in the population
+    N : int
+        total number of ballots in the population
+    null_margin : int
+        largest difference in *number* of votes between the reported winner and reported 
+        loser, N_w - N_l, under the null hypothesis
+    n : int
+        number of ballots in the sample
+    alpha : float
+        risk limit
+    reps : int
+        number of simulation runs. Default is 10000
+    stepsize : int
+        when searching for the threshold margin, what step size to use? Default is 5
+    seed : int
+        random seed value for the pseudorandom number generator. Default is 987654321
+    verbose : bool
+        print (margin, pvalue) pairs? Default is True
+    """
+    np.random.seed(seed)
+    
+    # step 1: find diluted margin for which we'd reject
+    # the p-value depends only on the margin, not the values of w and l
+    threshold = trihypergeometric_critical_margin(N_w, N, null_margin, n, alpha,
+                                                  stepsize=stepsize,
+                                                  verbose=verbose)
     print("The critical value of the test is ", threshold)
             
-    # step 2: over many samples, compute diluted margin
+    # step 2: over many samples, compute diluted margin. The samples are
+    # drawn in blocks, from the same random stream as one call to
+    # np.random.choice(population, size=n) per sample
     population = np.array([0]*int(N_l) + [1]*int(N_w) + [np.nan]*(N-N_w-N_l))
     rejects = 0
-    for r in range(reps):
-        sample = np.random.choice(population, size=n)
-        obs_mar = np.sum(sample==1) - np.sum(sample==0)
-        if obs_mar >= threshold:
-            rejects += 1
+    block = max(1, 10**6//n)
+    for start in range(0, reps, block):
+        rows = min(block, reps - start)
+        sample = population[np.random.randint(0, len(population), \
+                                              size=(rows, n))]
+        obs_mar = np.sum(sample==1, axis=1) - np.sum(sample==0, axis=1)
+        rejects += np.sum(obs_mar >= threshold)
 
     # step 3: what fraction of these are >= the threshold?
     return rejects/reps
@@ -376,6 +430,7 @@ def diluted_margin_hypergeometric(w, l, N_w, N_l):
         divided by the sample size n, will be greater than or equal to (w-l)/n.
         The test conditions on n and w+l.
     """
+    import scipy.stats
     n = w+l
     pvalue = sp.stats.hypergeom.sf(w-1, N_w + N_l, N_w, n)
     return pvalue
@@ -409,6 +464,7 @@ def diluted_margin_hypergeometric2(w, l, N_w, N_l):
         divided by the sample size n, will be greater than or equal to (w-l)/n.
         The test conditions on n and w+l.
     """
+    import scipy.stats
     pvalue = 0
     delta = w-l
     n = w+l
@@ -445,6 +501,7 @@ def diluted_margin_hypergeometric3(w, l, N_w, N_l):
         divided by the sample size n, will be greater than or equal to (w-l)/n.
         The test conditions on n and w+l.
     """
+    import scipy.stats
     delta = w-l
     n = w+l
     pairs = itertools.product(range(n+1), range(n+1))
@@ -485,14 +542,149 @@ def hypergeometric_optim(sample, popsize, null_margin):
     l = sum(sample==0)
     n = len(sample)
     u = n-w-l    
+    return _hypergeometric_optim_pvalue(w, l, u, popsize, null_margin)
 
-    # maximize p-value over N_w
-    optim_fun = lambda N_w: diluted_margin_hypergeometric(w, l, N_w, N_w-null_margin)
+
+def _hypergeometric_optim_pvalue(w, l, u, popsize, null_margin):
+    """
+    P-value of `hypergeometric_optim` for a sample with w votes for w, l votes
+    for l and u other ballots. The p-value is computed for all values of the
+    nuisance parameter at once.
+    """
     # conditions are that N_w+N_l = 2*upper - c < N-u, N_l = upper-c > l, N_w = upper > w
     upper_Nw = int((popsize-u+null_margin)/2)
     lower_Nw = int(np.max([w, null_margin]))
+    N_w = np.arange(lower_Nw, upper_Nw+1)
+    return np.max(diluted_margin_hypergeometric(w, l, N_w, N_w-null_margin))
+
+
+### Exact power
+
+def polling_sample_logpmf(w, l, n, N_w, N_l, N, replace=False):
+    """
+    Log probability of w votes for w and l votes for l in a sample of n ballots
+    from a population of N ballots with N_w votes for w and N_l votes for l,
+    drawn without replacement (tri-hypergeometric) or with replacement
+    (multinomial). Vectorized; -inf for impossible samples.
+    """
+    w, l = np.broadcast_arrays(np.asarray(w, dtype=float), np.asarray(l, dtype=float))
+    u = n-w-l
+    N_u = N-N_w-N_l
+    if replace:
+        with np.errstate(divide='ignore'):
+            logp = log_factorial(n) - log_factorial(w) - log_factorial(l) \
+                - log_factorial(u) \
+                + sp.special.xlogy(w, N_w/N) + sp.special.xlogy(l, N_l/N) \
+                + sp.special.xlogy(u, N_u/N)
+        possible = (u >= 0) & ((w == 0) | (N_w > 0)) & ((l == 0) | (N_l > 0)) \
+                   & ((u == 0) | (N_u > 0))
+    else:
+        possible = (w <= N_w) & (l <= N_l) & (u >= 0) & (u <= N_u)
+        with np.errstate(invalid='ignore'):
+            logp = trihypergeometric_logpmf(w, l, n, N_w, N_l, N)
+    return np.where(possible, logp, -np.inf)
+
+
+def trihypergeometric_power(N_w, N_l, N, null_margin, n, alpha, replace=False,
+    stepsize=5):
+    """
+    Exact power of the trihypergeometric ballot polling audit, the probability
+    that the diluted margin of a sample of size n is at least the critical
+    value of the test. This is the rejection rate that
+    `simulate_ballot_polling_power` estimates, computed by summing the
+    probabilities of all (w, l) in the rejection region instead of by
+    simulation.
     
-    return np.max(list(map(optim_fun, range(lower_Nw, upper_Nw+1))))
+    Parameters
+    ----------
+    N_w : int
+        total number of votes for w in the population
+    N_l : int
+        total number of votes for l in the population
+    N : int
+        total number of ballots in the population
+    null_margin : int
+        largest difference in *number* of votes between the reported winner and reported 
+        loser, N_w - N_l, under the null hypothesis
+    n : int
+        number of ballots in the sample
+    alpha : float
+        risk limit
+    replace : bool
+        is the sample drawn with replacement? Default is False.
+        `simulate_ballot_polling_power` samples with replacement.
+    stepsize : int
+        when searching for the threshold margin, what step size to use? Default is 5
+    Returns
+    -------
+    float
+        probability that the audit stops
+    """
+    threshold = trihypergeometric_critical_margin(N_w, N, null_margin, n, alpha,
+                                                  stepsize=stepsize)
+    w, l = _polling_sample_grid(n)
+    reject = w-l >= threshold
+    return np.sum(np.exp(polling_sample_logpmf(w[reject], l[reject], n, N_w, N_l, N,
+                                               replace=replace)))
+
+
+def hypergeometric_power(N_w, N_l, N, null_margin, n, alpha, replace=False,
+    tol=1e-12):
+    """
+    Exact power of the ballot polling audit with `hypergeometric_optim`, the
+    probability that a sample of size n has p-value at most alpha.
+    
+    Given the number m = w+l of votes for w or l in the sample, the p-value
+    decreases in w, so the rejection region is w >= t(m). The threshold t(m)
+    is found by bisection for each m, and the power is the probability of the
+    rejection region. Values of m with probability below tol are skipped, so
+    the error is at most (n+1)*tol.
+    
+    Parameters
+    ----------
+    N_w : int
+        total number of votes for w in the population
+    N_l : int
+        total number of votes for l in the population
+    N : int
+        total number of ballots in the population
+    null_margin : int
+        largest difference in *number* of votes between the reported winner and reported 
+        loser, N_w - N_l, under the null hypothesis
+    n : int
+        number of ballots in the sample
+    alpha : float
+        risk limit
+    replace : bool
+        is the sample drawn with replacement? Default is False
+    tol : float
+        smallest probability of m = w+l for which the threshold is computed.
+        Default is 1e-12
+    Returns
+    -------
+    float
+        probability that the audit stops
+    """
+    w, l = _polling_sample_grid(n)
+    prob = np.exp(polling_sample_logpmf(w, l, n, N_w, N_l, N, replace=replace))
+    m = w+l
+    prob_m = np.bincount(m, weights=prob, minlength=n+1)
+    
+    threshold = np.full(n+1, n+1)
+    for mm in np.flatnonzero(prob_m > tol):
+        pvalue = lambda ww: _hypergeometric_optim_pvalue(ww, mm-ww, n-mm, N,
+                                                         null_margin)
+        if pvalue(mm) > alpha:
+            continue
+        lo, hi = -1, mm
+        while hi-lo > 1:
+            mid = (lo+hi)//2
+            if pvalue(mid) <= alpha:
+                hi = mid
+            else:
+                lo = mid
+        threshold[mm] = hi
+    return np.sum(prob[w >= threshold[m]])
 
 
 ### Unit tests
@@ -591,9 +783,37 @@ def test_diluted_margin_pvalue_hyper():
     np.testing.assert_almost_equal(diluted_margin_hypergeometric3(4, 1, 5, 2), t3+t4)
 
 
+def test_exact_power():
+    N_w, N_l, N, n = 12, 8, 25, 7
+    power_hyp = 0
+    power_tri = 0
+    threshold = trihypergeometric_critical_margin(N_w, N, 0, n, 0.2)
+    for w in range(n+1):
+        for l in range(n+1-w):
+            if w > N_w or l > N_l or n-w-l > N-N_w-N_l:
+                continue
+            p = trihypergeometric_pmf(w, l, n, N_w, N_l, N)
+            sample = np.array([1]*w + [0]*l + [np.nan]*(n-w-l))
+            if hypergeometric_optim(sample, N, 0) <= 0.2:
+                power_hyp += p
+            if w-l >= threshold:
+                power_tri += p
+    np.testing.assert_almost_equal(hypergeometric_power(N_w, N_l, N, 0, n, 0.2), power_hyp)
+    np.testing.assert_almost_equal(trihypergeometric_power(N_w, N_l, N, 0, n, 0.2), power_tri)
+    
+    # the probabilities of all samples add to one, with or without replacement
+    w, l = _polling_sample_grid(n)
+    for replace in [False, True]:
+        np.testing.assert_almost_equal(np.sum(np.exp(
+            polling_sample_logpmf(w, l, n, N_w, N_l, N, replace=replace))), 1)
+    np.testing.assert_almost_equal(polling_sample_logpmf(2, 1, 3, 2, 1, 4, replace=True),
+                                   np.log(3*0.5**2*0.25))
+
+
 ### Run tests
 if __name__ == "__main__": 
     test_find_pairs_trihyper()
     test_diluted_margin_pvalue_trihyper()
     test_find_pairs_hyper()
-    test_diluted_margin_pvalue_hyper()
\ No newline at end of file
+    test_diluted_margin_pvalue_hyper()
+    test_exact_power()
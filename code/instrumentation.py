@@ -0,0 +1,273 @@
+"""
+Opt-in instrumentation of the hot paths of SUITE: counters of P-value
+evaluations, root-finder iterations, grid points and cache hits, and timers
+for the stages of the maximization of Fisher's combined P-value, sample
+size estimation and auditing a contest.
+
+Instrumentation is off by default, and then every hook returns after
+checking one flag. Turn it on for a block of code with
+
+    with instrumentation.recording():
+        estimate_n(...)
+    instrumentation.report()
+
+and export what was recorded with `export_json` or `export_chrome_trace`.
+Chrome traces can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+from __future__ import division, print_function
+from collections import OrderedDict
+import functools
+import json
+import os
+import threading
+import time
+
+
+ENABLED = False
+
+# Largest number of timed events kept for the trace; stage totals are kept
+# regardless.
+MAX_EVENTS = 10**6
+
+_counters = OrderedDict()
+_maxima = OrderedDict()
+_stages = OrderedDict()
+_events = []
+_depths = {}
+_origin = time.perf_counter()
+
+
+################################################################################
+############################### Recording ######################################
+################################################################################
+
+def enable():
+    """
+    Turn instrumentation on.
+    """
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    """
+    Turn instrumentation off. What was recorded is kept until `reset`.
+    """
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    """
+    Forget everything recorded so far.
+    """
+    global _origin
+    _counters.clear()
+    _maxima.clear()
+    _stages.clear()
+    del _events[:]
+    _depths.clear()
+    _origin = time.perf_counter()
+
+
+class recording(object):
+    """
+    Context manager that resets the records, turns instrumentation on for
+    the block, and restores the previous state afterwards.
+    """
+    def __enter__(self):
+        self.was_enabled = ENABLED
+        reset()
+        enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.was_enabled:
+            disable()
+        return False
+
+
+def count(name, k=1):
+    """
+    Add k to the counter name.
+    """
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + k
+
+
+def record_max(name, value):
+    """
+    Keep the largest value seen under name.
+    """
+    if ENABLED and value > _maxima.get(name, value - 1):
+        _maxima[name] = value
+
+
+class _Stage(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        depth = _depths.get(self.name, 0) + 1
+        _depths[self.name] = depth
+        record_max('depth:' + self.name, depth)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        duration = end - self.start
+        _depths[self.name] -= 1
+        stats = _stages.get(self.name)
+        if stats is None:
+            stats = _stages[self.name] = {'calls' : 0, 'total_time' : 0.0, \
+                                          'max_time' : 0.0}
+        stats['calls'] += 1
+        if _depths[self.name] == 0:
+            # time in nested calls is already in the outermost call
+            stats['total_time'] += duration
+        stats['max_time'] = max(stats['max_time'], duration)
+        if len(_events) < MAX_EVENTS:
+            _events.append((self.name, self.start - _origin, duration, \
+                            threading.current_thread().ident))
+        return False
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """
+    Context manager timing a stage of a computation. Nested stages of the
+    same name, e.g. from recursion, are counted as calls but only the
+    outermost adds to the total time; their deepest nesting is recorded as
+    'depth:<name>'.
+    """
+    return _Stage(name) if ENABLED else _NULL_STAGE
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as the stage name.
+    """
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fun(*args, **kwargs)
+            with _Stage(name):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+################################################################################
+############################### Reporting ######################################
+################################################################################
+
+def report():
+    """
+    Everything recorded so far.
+
+    Returns
+    -------
+    dict : 'counters', 'maxima' and 'stages', the last with the number of
+    calls, total time and longest time in seconds of each stage
+    """
+    return {'counters' : OrderedDict(_counters),
+            'maxima' : OrderedDict(_maxima),
+            'stages' : OrderedDict((k, dict(v)) for (k, v) in _stages.items())
+            }
+
+
+def export_json(filename):
+    """
+    Write `report()` to a JSON file.
+    """
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=1)
+
+
+def export_chrome_trace(filename):
+    """
+    Write the timed stages to a file in the Chrome trace event format, one
+    complete event per stage call, with the counters as a final counter
+    event.
+    """
+    pid = os.getpid()
+    events = [{'name' : name, 'cat' : 'suite', 'ph' : 'X', \
+               'ts' : start*1e6, 'dur' : duration*1e6, \
+               'pid' : pid, 'tid' : tid} \
+              for (name, start, duration, tid) in _events]
+    end = max([e['ts'] + e['dur'] for e in events] + [0])
+    if _counters:
+        events.append({'name' : 'counters', 'ph' : 'C', 'ts' : end, \
+                       'pid' : pid, 'args' : dict(_counters)})
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_instrumentation():
+    import shutil
+    import tempfile
+    from suite_tools import estimate_n
+
+    reset()
+    count('ignored')
+    with stage('ignored'):
+        pass
+    assert report()['counters'] == {} and report()['stages'] == {}
+
+    with recording():
+        n = estimate_n(N_w1=4550, N_w2=975, N_l1=3950, N_l2=825, N1=8500, \
+                       N2=2000, o1_rate=0.002, risk_limit=0.05)
+    assert not ENABLED
+    res = report()
+    assert res['stages']['estimate_n']['calls'] == 1
+    calls = res['stages']['maximize_fisher_combined_pvalue']['calls']
+    assert res['stages']['estimate_n.doubling']['calls'] == 1
+    assert res['counters']['pvalues:ballot_comparison'] >= calls
+    assert res['counters']['pvalues:ballot_polling_sprt'] >= calls
+    assert res['counters']['lambda_grid_points'] >= 5*calls
+    # brentq, or the compiled Newton kernel if Numba is installed
+    assert sum(v for (k, v) in res['counters'].items() \
+               if k.startswith('root_iterations:')) > 0
+    assert res['maxima']['depth:maximize_fisher_combined_pvalue'] >= 1
+    total = res['stages']['estimate_n']['total_time']
+    assert res['stages']['estimate_n.doubling']['total_time'] <= total
+
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, 'trace.json')
+        export_chrome_trace(filename)
+        with open(filename) as f:
+            trace = json.load(f)['traceEvents']
+        assert len(trace) == sum(v['calls'] for v in res['stages'].values()) \
+            + 1
+        assert trace[-1]['args'] == dict(res['counters'])
+        export_json(filename)
+        with open(filename) as f:
+            assert json.load(f)['counters'] == dict(res['counters'])
+    finally:
+        shutil.rmtree(dirname)
+    reset()
+
+
+if __name__ == "__main__":
+    test_instrumentation()
@@ -0,0 +1,178 @@
+"""
+Optional compiled kernels for the loops that do not vectorize: the search
+for the nuisance parameter in `ballot_polling_sprt` and the tail sum of
+`diluted_margin_trihypergeometric2`.
+
+The kernels are plain Python. If Numba is installed they are compiled with
+`numba.njit`, and the callers use them in place of their NumPy/SciPy code;
+otherwise the callers keep their own code. The compiled functions are
+cached on disk (in __pycache__, or NUMBA_CACHE_DIR if it is set), so they
+are compiled once rather than in every process. Set the environment
+variable SUITE_NUMBA=0 to turn the kernels off.
+
+Tolerances: the nuisance parameter agrees with `scipy.optimize.brentq` to
+its tolerance, about 2e-12 + 4e-16*Nw, and the P-value of the SPRT, which
+is stationary there, to about 1e-12 relative error. The tail sum agrees
+with the floating point sum of `scipy.special.comb` terms to about
+N*1e-15 relative error, N the population size, from the log gamma terms.
+"""
+
+from __future__ import division, print_function
+import math
+import os
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+ENABLED = numba is not None and os.environ.get('SUITE_NUMBA', '1') != '0'
+
+
+def _jit(fun):
+    """
+    Compile fun with Numba if the kernels are enabled.
+    """
+    if not ENABLED:
+        return fun
+    return numba.njit(cache=True, nogil=True)(fun)
+
+
+################################################################################
+################################# SPRT #########################################
+################################################################################
+
+@_jit
+def sprt_null_loglik_derivatives(Nw, Wn, Ln, Un, popsize, null_margin):
+    """
+    First and second derivatives in Nw of the log likelihood of the sample
+    under the null of `ballot_polling_sprt`.
+    """
+    first = 0.0
+    second = 0.0
+    for i in range(Wn):
+        first += 1/(Nw - i)
+        second -= 1/(Nw - i)**2
+    for i in range(Ln):
+        first += 1/(Nw - null_margin - i)
+        second -= 1/(Nw - null_margin - i)**2
+    for i in range(Un):
+        first -= 2/(popsize - 2*Nw + null_margin - i)
+        second -= 4/(popsize - 2*Nw + null_margin - i)**2
+    return (first, second)
+
+
+@_jit
+def sprt_nuisance(Wn, Ln, Un, popsize, null_margin, lower, upper):
+    """
+    Root in [lower, upper] of the derivative of the null log likelihood of
+    `ballot_polling_sprt`, which decreases in Nw and changes sign on the
+    interval: the Nw that maximizes the likelihood. Newton's method,
+    falling back to bisection whenever a step leaves the bracket. Returns
+    the root and the number of iterations.
+    """
+    (lo, hi) = (lower, upper)
+    x = (lo + hi)/2
+    for it in range(200):
+        (first, second) = sprt_null_loglik_derivatives(x, Wn, Ln, Un, \
+                                                       popsize, null_margin)
+        if first == 0:
+            return (x, it + 1)
+        if first > 0:
+            lo = x
+        else:
+            hi = x
+        newton = x - first/second
+        x_new = newton if lo < newton < hi else (lo + hi)/2
+        tol = 2e-12 + 4*2.220446049250313e-16*abs(x)
+        if abs(x_new - x) <= tol or hi - lo <= tol:
+            return (x_new, it + 1)
+        x = x_new
+    return (x, 200)
+
+
+################################################################################
+######################### Tri-hypergeometric ###################################
+################################################################################
+
+@_jit
+def _log_comb(N, k):
+    if k < 0 or k > N:
+        return -math.inf
+    return math.lgamma(N + 1) - math.lgamma(k + 1) - math.lgamma(N - k + 1)
+
+
+@_jit
+def trihypergeometric_tail(w, l, n, N_w, N_l, N):
+    """
+    Floating point version of `diluted_margin_trihypergeometric2`: the
+    chance that the sample margin is at least w - l, summed term by term.
+    """
+    N_u = N - N_w - N_l
+    log_total = _log_comb(N, n)
+    pvalue = 0.0
+    for ww in range(w - l, n + 1):
+        log_w = _log_comb(N_w, ww)
+        if log_w == -math.inf:
+            continue
+        for ll in range(0, ww - w + l + 1):
+            if ww + ll > n:
+                break
+            pvalue += math.exp(log_w + _log_comb(N_l, ll) + \
+                               _log_comb(N_u, n - ww - ll) - log_total)
+    return pvalue
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def _python(fun):
+    return getattr(fun, 'py_func', fun)
+
+
+def test_kernels():
+    import numpy as np
+    import scipy.optimize
+    from hypergeometric import diluted_margin_trihypergeometric2
+    from sprt import ballot_polling_sprt
+
+    # the Python kernels, and the compiled ones if Numba is installed
+    for nuisance in set([_python(sprt_nuisance), sprt_nuisance]):
+        for (Wn, Ln, Un, popsize, c) in [(60, 40, 20, 1000, 0), \
+                                         (55, 45, 100, 10000, -30), \
+                                         (5, 3, 2, 50, 2)]:
+            deriv = lambda Nw: _python(sprt_null_loglik_derivatives)(Nw, \
+                                   Wn, Ln, Un, popsize, c)[0]
+            (lower, upper) = (max(Wn, Ln + c), (popsize - Un + c)/2 - 1)
+            expected = scipy.optimize.brentq(deriv, lower, upper)
+            (root, iterations) = nuisance(Wn, Ln, Un, popsize, c, lower, \
+                                          upper)
+            np.testing.assert_allclose(root, expected, rtol=1e-12, atol=4e-12)
+            assert 0 < iterations < 200
+
+    for tail in set([_python(trihypergeometric_tail), trihypergeometric_tail]):
+        for args in [(2, 1, 3, 2, 2, 6), (4, 1, 5, 5, 2, 9), \
+                     (30, 20, 80, 500, 400, 1000), (10, 15, 40, 300, 300, 900)]:
+            np.testing.assert_allclose(tail(*args), \
+                diluted_margin_trihypergeometric2(*args), rtol=1e-11)
+
+    # the SPRT gives the same answer with the kernels on or off
+    sample = [1]*60 + [0]*40 + [np.nan]*20
+    res = ballot_polling_sprt(sample, 1000, 0.05, Vw=500, Vl=400, \
+                              null_margin=0)
+    global ENABLED
+    enabled = ENABLED
+    try:
+        ENABLED = not enabled
+        other = ballot_polling_sprt(sample, 1000, 0.05, Vw=500, Vl=400, \
+                                    null_margin=0)
+    finally:
+        ENABLED = enabled
+    np.testing.assert_allclose(res['pvalue'], other['pvalue'], rtol=1e-12)
+    np.testing.assert_allclose(res['Nw_used'], other['Nw_used'], rtol=1e-12)
+
+
+if __name__ == "__main__":
+    test_kernels()
@@ -0,0 +1,249 @@
+"""
+A shared table of log factorials.
+
+`trihypergeometric_logpmf` evaluates twelve log factorials per term and
+`ballot_polling_sprt` sums logs of falling factorials, and in a parallel
+simulation every worker evaluates the same ones. `create(size)` computes
+log(k!) for k = 0, ..., size once and writes them to a .npy file, which is
+memory-mapped read-only: every process that attaches the table shares the
+same pages of memory, so a table for a stratum of 10^7 ballots costs 80 MB
+once, rather than in every worker. A file written earlier is reused, after
+checking entries spread over the table against gammaln; by default files
+are kept in a directory private to the user, ~/.cache/suite.
+
+While a table is attached, `log_factorial`, `log_comb` and
+`log_falling_factorial` look integer arguments up in it. Other arguments,
+e.g. the real-valued nuisance parameter of the SPRT, and arguments outside
+the table, fall back to `scipy.special.gammaln`. The table holds the values
+of gammaln, so the results are the same either way.
+
+Worker processes started by fork inherit the table. Pools started otherwise
+attach it with `multiprocessing.Pool(processes, **pool_arguments())`.
+`audit_simulation.simulate_audits`, `planning.suite_pvalues`,
+`sweep.run_sweep` and `suite_tools.audit_contest` call `create` before
+starting their workers when given `logfactorial_size`.
+"""
+
+from __future__ import division, print_function
+import os
+import numpy as np
+from scipy.special import gammaln
+
+
+# log(k!) for k = 0, ..., len(TABLE)-1, or None
+TABLE = None
+# file TABLE is mapped from
+FILENAME = None
+
+# entries computed at a time when writing a table
+_CHUNK = 2**20
+
+# number of entries, spread over the table, checked when a table is attached
+_CHECKED_ENTRIES = 65
+
+
+def _default_directory():
+    """
+    Directory private to the user for tables: $XDG_CACHE_HOME/suite, or
+    ~/.cache/suite.
+    """
+    cache = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+    dirname = os.path.join(cache, 'suite')
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+    return dirname
+
+
+def _check(table, size=None):
+    """
+    Raise ValueError unless table is a 1-d float64 table of log factorials,
+    of size+1 entries if size is given, whose entries at k = 0, 1, size and
+    others spread between them equal gammaln(k+1).
+    """
+    if table.ndim != 1 or table.dtype != np.float64 or len(table) == 0:
+        raise ValueError('not a table of log factorials')
+    if size is not None and len(table) != size + 1:
+        raise ValueError('the table has %d entries, not %d' % \
+                         (len(table), size + 1))
+    k = np.unique(np.r_[0, 1, np.linspace(0, len(table) - 1, \
+                                          _CHECKED_ENTRIES).astype(int)])
+    k = k[k < len(table)]
+    if not np.array_equal(table[k], gammaln(k + 1.0)):
+        raise ValueError('the table does not hold log factorials')
+
+
+def create(size, filename=None):
+    """
+    Write the table of log(k!) for k = 0, ..., size to a file, unless a file
+    with a table of that size exists, and attach it.
+
+    Parameters
+    ----------
+    size : int
+        largest k in the table, e.g. the largest population size
+    filename : str
+        the .npy file. Default is logfactorial-<size>.npy in
+        $XDG_CACHE_HOME/suite or ~/.cache/suite.
+    Returns
+    -------
+    str : the name of the file
+    """
+    assert size >= 0, "size must be nonnegative"
+    if filename is None:
+        filename = os.path.join(_default_directory(), \
+                                'logfactorial-%d.npy' % size)
+    try:
+        _check(np.load(filename, mmap_mode='r'), size)
+        exists = True
+    except (IOError, ValueError):
+        # missing, stale or corrupt: write it again
+        exists = False
+    if not exists:
+        # written under a temporary name, so that other processes never
+        # attach a partial table
+        partial = '%s.%d.tmp' % (filename, os.getpid())
+        table = np.lib.format.open_memmap(partial, mode='w+', \
+                                          dtype=np.float64, shape=(size+1,))
+        for start in range(0, size+1, _CHUNK):
+            stop = min(size+1, start + _CHUNK)
+            table[start:stop] = gammaln(np.arange(start, stop) + 1.0)
+        table.flush()
+        del table
+        os.replace(partial, filename)
+    attach(filename)
+    return filename
+
+
+def attach(filename):
+    """
+    Memory-map the table in a file written by `create`, after checking it
+    (ValueError if it is not a table of log factorials). Does nothing if
+    filename is None, so it can be a pool initializer in any case.
+    """
+    global TABLE, FILENAME
+    if filename is not None:
+        table = np.load(filename, mmap_mode='r')
+        _check(table)
+        TABLE = table
+        FILENAME = filename
+
+
+def detach():
+    """
+    Stop using the table. The file is kept.
+    """
+    global TABLE, FILENAME
+    TABLE = None
+    FILENAME = None
+
+
+def pool_arguments():
+    """
+    Keyword arguments of `multiprocessing.Pool` that attach the table in
+    every worker: empty if no table is attached.
+    """
+    if FILENAME is None:
+        return {}
+    return {'initializer' : attach, 'initargs' : (FILENAME,)}
+
+
+################################################################################
+############################## Log factorials ##################################
+################################################################################
+
+def log_factorial(k):
+    """
+    log(k!) = gammaln(k+1) elementwise, from the table where every element
+    of k is an integer in it.
+    """
+    table = TABLE
+    if table is not None:
+        k = np.asarray(k)
+        if k.size and (k.dtype.kind in 'iu' or \
+                       (k.dtype.kind == 'f' and np.array_equal(k, np.trunc(k)))) \
+                  and k.min() >= 0 and k.max() < len(table):
+            return table[k.astype(np.intp)]
+    return gammaln(k + 1)
+
+
+def log_comb(N, k):
+    """
+    log of the binomial coefficient N choose k, for 0 <= k <= N.
+    """
+    return log_factorial(N) - log_factorial(k) - log_factorial(N - k)
+
+
+def log_falling_factorial(x, k):
+    """
+    log(x (x-1) ... (x-k+1)) = log(x!) - log((x-k)!), for x >= k.
+    """
+    return log_factorial(x) - log_factorial(x - k)
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def _attached_file(i):
+    return FILENAME
+
+
+def test_logfactorial():
+    import multiprocessing
+    import shutil
+    import tempfile
+    dirname = tempfile.mkdtemp()
+    k = np.array([0, 1, 5, 999, 1000])
+    x = np.array([2.5, 10.0, 1000.0])
+    expected = (gammaln(k + 1), gammaln(x + 1))
+    try:
+        filename = create(1000, os.path.join(dirname, 'table.npy'))
+        assert TABLE.shape == (1001,) and FILENAME == filename
+        mtime = os.stat(filename).st_mtime_ns
+        assert create(1000, filename) == filename
+        assert os.stat(filename).st_mtime_ns == mtime
+
+        # a corrupt table is not attached, and is written again by create
+        corrupt = os.path.join(dirname, 'corrupt.npy')
+        table = np.array(TABLE)
+        table[-1] += 1e-9
+        np.save(corrupt, table)
+        try:
+            attach(corrupt)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('a corrupt table was attached')
+        assert FILENAME == filename
+        create(1000, corrupt)
+        assert np.array_equal(TABLE, gammaln(np.arange(1001) + 1.0))
+        create(1000, filename)
+
+        # the same values from the table and from gammaln
+        for (args, value) in zip((k, x), expected):
+            assert np.array_equal(log_factorial(args), value)
+        assert log_factorial(7) == gammaln(8)
+        assert log_factorial(1001) == gammaln(1002)
+        np.testing.assert_allclose(log_comb(10, 3), np.log(120))
+        np.testing.assert_allclose(log_falling_factorial(10, 3), np.log(720))
+
+        # workers started without fork attach the table
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(2, **pool_arguments())
+        try:
+            res = pool.map(log_factorial, [k, x])
+            assert pool.map(_attached_file, range(2)) == [filename]*2
+        finally:
+            pool.close()
+            pool.join()
+        for (got, value) in zip(res, expected):
+            assert np.array_equal(got, value)
+    finally:
+        detach()
+        shutil.rmtree(dirname)
+    assert pool_arguments() == {}
+    assert np.array_equal(log_factorial(k), expected[0])
+
+
+if __name__ == "__main__":
+    test_logfactorial()
@@ -0,0 +1,394 @@
+"""
+Importance sampling estimates of small rejection probabilities, such as the
+type I error rates of ballot polling tests at small risk limits.
+
+The decisions of the tri-hypergeometric test, the SPRT and SUITE with
+error-free CVRs depend on the sample only through the polling counts
+(w, l, u), which are tri-hypergeometric. Instead of drawing the counts from
+the true population, they are drawn from a tilted population with `tilt`
+votes moved from l to w, so that the rejection region is hit often, and each
+draw is weighted by its likelihood ratio. The weights are exact, from
+`polling_sample_logpmf`.
+
+Power, which is not small, is estimated by plain Monte Carlo instead, but
+adaptively: replications are run in vectorized chunks until an anytime-valid
+confidence interval for the rejection rate is narrow enough, or clears a
+decision threshold such as a required power.
+"""
+
+from __future__ import division, print_function
+import numpy as np
+# scipy.stats is slow to import, so it is imported in the functions that use
+# it
+import scipy
+
+from hypergeometric import polling_sample_logpmf, \
+        trihypergeometric_critical_margin, trihypergeometric_power
+from sprt import _sprt_log_likelihood_ratios
+from fishers_combination import maximize_fisher_combined_pvalue_batch
+
+
+################################################################################
+########################## Importance sampling #################################
+################################################################################
+
+def _draw_counts(prng, N_w, N_l, N, n, size):
+    """
+    Polling counts (w, l) of `size` samples of n ballots drawn without
+    replacement.
+    """
+    w = prng.hypergeometric(N_w, N - N_w, n, size=size)
+    l = prng.hypergeometric(N_l, N - N_w - N_l, n - w)
+    return (w, l)
+
+
+def _pilot_tilt(rejects, N_w, N_l, N, n, prng, pilot_reps=200):
+    """
+    A tilt at which about half of the tilted samples are rejected, found by
+    bisection with small pilot samples. 0 if the test rejects half of the
+    untilted samples, and the largest tilt if no tilt does.
+    """
+    max_tilt = max(N_l - n, 0)
+    rate = lambda t: np.mean(rejects(*_draw_counts(prng, N_w + t, N_l - t, \
+                                                   N, n, pilot_reps)))
+    if rate(0) >= 0.5:
+        return 0
+    if rate(max_tilt) < 0.5:
+        return max_tilt
+    (lo, hi) = (0, max_tilt)
+    while hi - lo > 1:
+        mid = (lo + hi)//2
+        if rate(mid) >= 0.5:
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+def importance_sampling_rejection_rate(rejects, N_w, N_l, N, n, tilt=None, \
+                                       reps=10000, chunk=1000, \
+                                       half_width=None, confidence=0.95, \
+                                       seed=None):
+    """
+    Estimate the probability that a test rejects, for samples of n ballots
+    drawn without replacement from a population with N_w votes for w and
+    N_l votes for l, by importance sampling.
+
+    The counts are drawn in chunks from the population with N_w + tilt
+    votes for w and N_l - tilt votes for l, and weighted by the ratio of
+    their probabilities under the true and the tilted population. The tilt
+    is at most N_l - n, so that every sample possible under the true
+    population is possible under the tilted one.
+
+    Parameters
+    ----------
+    rejects : function
+        takes arrays of counts (w, l) of samples of size n and returns a
+        boolean array, True where the test rejects
+    N_w : int
+        true number of votes for w in the population
+    N_l : int
+        true number of votes for l in the population
+    N : int
+        total number of ballots in the population
+    n : int
+        number of ballots in the sample
+    tilt : int
+        number of votes moved from l to w in the sampling distribution.
+        Optional; by default, the tilt at which about half of the samples
+        are rejected, found with small pilot samples.
+    reps : int
+        largest number of samples. Default is 10000.
+    chunk : int
+        number of samples drawn at a time. Default is 1000.
+    half_width : float
+        stop once the half-width of the confidence interval is at most
+        this. Optional; default is to draw all reps samples.
+    confidence : float
+        confidence level of the interval. Default is 0.95.
+    seed : int
+        seed for the random number generator. Optional.
+    Returns
+    -------
+    dict : 'rejection_rate', 'std_error', 'ci' (normal approximation),
+    'reps' (the number of samples drawn), 'tilt', and
+    'effective_sample_size' of the weights
+    """
+    import scipy.stats
+    prng = np.random.default_rng(seed)
+    if tilt is None:
+        tilt = _pilot_tilt(rejects, N_w, N_l, N, n, prng)
+    tilt = int(min(tilt, max(N_l - n, 0)))
+    z = scipy.stats.norm.ppf(1 - (1 - confidence)/2)
+
+    terms = []
+    drawn = 0
+    while drawn < reps:
+        size = min(chunk, reps - drawn)
+        (w, l) = _draw_counts(prng, N_w + tilt, N_l - tilt, N, n, size)
+        weights = np.exp(polling_sample_logpmf(w, l, n, N_w, N_l, N) - \
+                         polling_sample_logpmf(w, l, n, N_w + tilt, \
+                                               N_l - tilt, N))
+        terms.append(np.where(rejects(w, l), weights, 0.0))
+        drawn += size
+        x = np.concatenate(terms)
+        std_error = np.std(x, ddof=1)/np.sqrt(drawn) if drawn > 1 else np.inf
+        if half_width is not None and z*std_error <= half_width:
+            break
+    estimate = np.mean(x)
+    return {'rejection_rate' : estimate,
+            'std_error' : std_error,
+            'ci' : (max(estimate - z*std_error, 0), estimate + z*std_error),
+            'reps' : drawn,
+            'tilt' : tilt,
+            'effective_sample_size' : np.sum(x)**2/np.sum(x**2) \
+                                      if np.any(x > 0) else 0
+            }
+
+
+################################################################################
+############################# Type I error #####################################
+################################################################################
+
+def trihypergeometric_type1_error(N_w, N_l, N, null_margin, n, alpha, \
+                                  **kwargs):
+    """
+    Importance sampling estimate of the rejection rate of the
+    tri-hypergeometric test, which rejects when the diluted margin w-l is at
+    least its critical value (see `simulate_ballot_polling_power`), when
+    the population has N_w votes for w and N_l votes for l. Other keyword
+    arguments are passed to `importance_sampling_rejection_rate`.
+    """
+    threshold = trihypergeometric_critical_margin(N_w, N, null_margin, n, \
+                                                  alpha)
+    rejects = lambda w, l: w - l >= threshold
+    return importance_sampling_rejection_rate(rejects, N_w, N_l, N, n, \
+                                              **kwargs)
+
+
+def sprt_type1_error(N_w, N_l, N, Vw, Vl, n, alpha, null_margin=0, \
+                     **kwargs):
+    """
+    Importance sampling estimate of the rejection rate of
+    `ballot_polling_sprt` with alternative (Vw, Vl), when the population
+    has N_w votes for w and N_l votes for l. Samples that are impossible
+    under the alternative do not reject. Other keyword arguments are passed
+    to `importance_sampling_rejection_rate`.
+    """
+    def rejects(w, l):
+        logLR = _sprt_log_likelihood_ratios(w*1., l*1., (n - w - l)*1., N, \
+                                            int(Vw), int(Vl), null_margin)
+        with np.errstate(over='ignore'):
+            return np.exp(logLR) >= 1/alpha
+    return importance_sampling_rejection_rate(rejects, N_w, N_l, N, n, \
+                                              **kwargs)
+
+
+def suite_type1_error(N_w1, N_l1, N1, N_w2, N_l2, N2, n1, n2, true_w2, \
+                      true_l2, alpha, gamma=1.03905, stepsize=0.05, \
+                      **kwargs):
+    """
+    Importance sampling estimate of the rejection rate of SUITE, as in
+    `maximize_fisher_combined_pvalue_batch`, when the CVR sample has no
+    discrepancies and the no-CVR stratum has true_w2 votes for w and
+    true_l2 votes for l instead of the reported N_w2 and N_l2. Other
+    keyword arguments are passed to `importance_sampling_rejection_rate`.
+    """
+    def rejects(w, l):
+        # samples impossible under the reported votes are not rejected
+        consistent = (w <= N_w2) & (l <= N_l2) & \
+                     (n2 - w - l <= N2 - N_w2 - N_l2)
+        keep = lambda x: np.where(consistent, x, 0)
+        pvalues = maximize_fisher_combined_pvalue_batch(N_w1, N_l1, N1, \
+                      N_w2, N_l2, N2, n1, 0, 0, 0, 0, keep(n2), keep(w), \
+                      keep(l), gamma=gamma, stepsize=stepsize, \
+                      alpha=alpha)['max_pvalue']
+        return consistent & (pvalues <= alpha)
+    return importance_sampling_rejection_rate(rejects, true_w2, true_l2, N2, \
+                                              n2, **kwargs)
+
+
+################################################################################
+######################### Adaptive Monte Carlo #################################
+################################################################################
+
+def _anytime_interval(successes, reps, look, confidence):
+    """
+    Clopper-Pearson intervals at level 1 - (1-confidence)*6/(pi^2 look^2)
+    for the look-th look at the data. The levels sum to 1 - confidence
+    over all looks, so the intervals are valid simultaneously, however the
+    number of replications is chosen.
+    """
+    import scipy.stats
+    a = (1 - confidence)*6/(np.pi**2*look**2)
+    lower = np.where(successes == 0, 0.0, \
+                     scipy.stats.beta.ppf(a/2, successes, \
+                                          reps - successes + 1))
+    upper = np.where(successes == reps, 1.0, \
+                     scipy.stats.beta.ppf(1 - a/2, successes + 1, \
+                                          reps - successes))
+    return (lower, upper)
+
+
+def adaptive_rejection_rate(simulate, half_width=0.01, threshold=None, \
+                            confidence=0.95, chunk=500, max_reps=10000, \
+                            seed=None):
+    """
+    Estimate rejection rates by Monte Carlo, in chunks of replications,
+    until a confidence interval is narrow enough or clears a threshold.
+
+    After each chunk, an anytime-valid confidence interval is computed for
+    each rate (see `_anytime_interval`). Sampling stops when every interval
+    has half-width at most half_width, when every interval excludes the
+    threshold, or after max_reps replications.
+
+    Parameters
+    ----------
+    simulate : function
+        takes a numpy random Generator and a number of replications, and
+        returns a boolean array of whether each replication rejects, with
+        one column per rate if there are several
+    half_width : float
+        target half-width of the intervals. None to only stop at the
+        threshold or max_reps. Default is 0.01.
+    threshold : float
+        stop once it is known whether the rates are above or below this,
+        e.g. the power a study requires. Optional.
+    confidence : float
+        simultaneous confidence level of the intervals. Default is 0.95.
+    chunk : int
+        number of replications between looks. Default is 500.
+    max_reps : int
+        largest number of replications. Default is 10000.
+    seed : int or numpy SeedSequence
+        seed for the random number generator. Optional.
+    Returns
+    -------
+    dict : 'rejection_rate', 'ci' (lower and upper limits), 'reps' spent and
+    'stopped' ('half_width', 'threshold' or 'max_reps')
+    """
+    prng = np.random.default_rng(seed)
+    successes = 0
+    reps = 0
+    look = 0
+    stopped = 'max_reps'
+    while reps < max_reps:
+        size = min(chunk, max_reps - reps)
+        successes = successes + np.sum(simulate(prng, size), axis=0)
+        reps += size
+        look += 1
+        (lower, upper) = _anytime_interval(successes, reps, look, confidence)
+        if half_width is not None and \
+           np.all((upper - lower)/2 <= half_width):
+            stopped = 'half_width'
+            break
+        if threshold is not None and \
+           np.all((lower > threshold) | (upper < threshold)):
+            stopped = 'threshold'
+            break
+    return {'rejection_rate' : successes/reps,
+            'ci' : (lower, upper),
+            'reps' : reps,
+            'stopped' : stopped
+            }
+
+
+def adaptive_ballot_polling_power(N_w, N_l, N, null_margin, n, alpha, \
+                                  replace=True, stepsize=5, **kwargs):
+    """
+    Adaptive version of `simulate_ballot_polling_power`: the rejection rate
+    of the trihypergeometric ballot polling audit, estimated by
+    `adaptive_rejection_rate`, to which other keyword arguments are passed.
+    The counts of each chunk of samples are drawn at once; as in
+    `simulate_ballot_polling_power`, samples are drawn with replacement
+    unless replace is False.
+    """
+    threshold = trihypergeometric_critical_margin(N_w, N, null_margin, n, \
+                                                  alpha, stepsize=stepsize)
+    def simulate(prng, size):
+        if replace:
+            counts = prng.multinomial(n, [N_w/N, N_l/N, 1 - (N_w + N_l)/N], \
+                                      size=size)
+            (w, l) = (counts[:, 0], counts[:, 1])
+        else:
+            (w, l) = _draw_counts(prng, N_w, N_l, N, n, size)
+        return w - l >= threshold
+    return adaptive_rejection_rate(simulate, **kwargs)
+
+
+def adaptive_fisher_combined_power(N_w1, N_l1, N1, N_w2, N_l2, N2, n1, n2, \
+                                   alpha, gamma=1.03905, stepsize=0.05, \
+                                   **kwargs):
+    """
+    Adaptive version of `simulate_fisher_combined_audit`: the rate at which
+    SUITE confirms correct reported results with error-free CVRs,
+    estimated by `adaptive_rejection_rate`, to which other keyword
+    arguments are passed. The polling samples of each chunk are evaluated
+    together by `maximize_fisher_combined_pvalue_batch`.
+    """
+    def simulate(prng, size):
+        (w, l) = _draw_counts(prng, N_w2, N_l2, N2, n2, size)
+        return maximize_fisher_combined_pvalue_batch(N_w1, N_l1, N1, N_w2, \
+                   N_l2, N2, n1, 0, 0, 0, 0, n2, w, l, gamma=gamma, \
+                   stepsize=stepsize, alpha=alpha)['max_pvalue'] <= alpha
+    return adaptive_rejection_rate(simulate, **kwargs)
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_importance_sampling():
+    from sprt import ballot_polling_sprt_power
+    # the null is true: w and l are tied
+    (N_w, N_l, N, n) = (4500, 4500, 10000, 500)
+    exact = ballot_polling_sprt_power(N_w, N_l, N, 4950, 4050, n, 0.01)
+    res = sprt_type1_error(N_w, N_l, N, 4950, 4050, n, 0.01, reps=4000, \
+                           seed=1)
+    assert res['tilt'] > 0
+    assert res['ci'][0] <= exact <= res['ci'][1]
+    # naive Monte Carlo would need far more samples for the same precision
+    naive_std_error = np.sqrt(exact*(1 - exact)/res['reps'])
+    assert res['std_error'] < naive_std_error/10
+
+    res = trihypergeometric_type1_error(450, 450, 1000, 0, 100, 0.01, \
+                                        half_width=5e-4, seed=2)
+    assert res['reps'] < 10000
+    assert res['ci'][1] - res['rejection_rate'] <= 5e-4
+
+
+def test_adaptive_rejection_rate():
+    # the interval covers the exact power, and is narrow enough
+    res = adaptive_ballot_polling_power(600, 400, 1100, 0, 100, 0.05, \
+                                        half_width=0.02, seed=5, \
+                                        max_reps=50000)
+    exact = trihypergeometric_power(600, 400, 1100, 0, 100, 0.05, \
+                                    replace=True)
+    assert res['stopped'] == 'half_width'
+    assert res['ci'][0] <= exact <= res['ci'][1]
+    assert res['ci'][1] - res['ci'][0] <= 0.04
+    assert res['reps'] % 500 == 0
+
+    # a power far from the threshold is settled after a chunk or two
+    res = adaptive_ballot_polling_power(600, 400, 1100, 0, 100, 0.05, \
+                                        half_width=None, threshold=0.2, \
+                                        replace=False, seed=5)
+    assert res['stopped'] == 'threshold' and res['reps'] <= 1000
+
+    # several rates at once; max_reps is respected
+    res = adaptive_rejection_rate(lambda prng, size: \
+                                  prng.random((size, 2)) < [0.1, 0.5], \
+                                  half_width=0.001, chunk=300, max_reps=1000, \
+                                  seed=1)
+    assert res['stopped'] == 'max_reps' and res['reps'] == 1000
+    assert res['rejection_rate'].shape == (2,)
+
+    res = adaptive_fisher_combined_power(4000, 3000, 8000, 700, 400, 1200, \
+                                         300, 150, 0.05, half_width=None, \
+                                         threshold=0.5, chunk=100, seed=2)
+    assert res['stopped'] == 'threshold' and res['rejection_rate'] > 0.5
+
+
+if __name__ == "__main__":
+    test_importance_sampling()
+    test_adaptive_rejection_rate()
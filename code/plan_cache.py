@@ -0,0 +1,279 @@
+"""
+Persistent cache of sample size plans.
+
+`estimate_n` and `estimate_escalation_n` are deterministic functions of
+their inputs, so once a plan has been computed it can be reused whenever the
+same contest is planned again, e.g. every time a planning notebook is rerun.
+Given `cache=PlanCache(filename)`, they look their result up in an SQLite
+database first, and store it after computing it. The expected P-values they
+evaluate on the way are stored too, so that a search with different
+tolerances reuses them.
+
+Entries are keyed by a SHA-256 hash of the kind of result, its inputs in
+canonical JSON and the version of the code, a hash of the source of the
+modules that compute plans, so that results of older code are not reused.
+The database is capped in size; the least recently used entries are
+evicted first. Several processes may share a database.
+"""
+
+from __future__ import division, print_function
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+# Modules whose code determines the plans
+_VERSIONED_MODULES = ('suite_tools', 'fishers_combination', 'sprt', \
+                      'ballot_comparison', 'hypergeometric', 'kernels', \
+                      'logfactorial')
+
+_code_version = None
+
+
+def code_version():
+    """
+    SHA-256 hash of the source of the modules that compute plans.
+    """
+    global _code_version
+    if _code_version is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        h = hashlib.sha256()
+        for name in _VERSIONED_MODULES:
+            with open(os.path.join(here, name + '.py'), 'rb') as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+
+def _jsonable(x):
+    if isinstance(x, np.integer):
+        return int(x)
+    if isinstance(x, np.floating):
+        return float(x)
+    if isinstance(x, (np.ndarray, tuple)):
+        return list(x)
+    raise TypeError('cannot store %r in the plan cache' % (x,))
+
+
+def canonical_key(kind, inputs, version):
+    """
+    Hash of the kind of a result, its inputs and the code version.
+    """
+    text = json.dumps([kind, inputs, version], sort_keys=True, \
+                      separators=(',', ':'), default=_jsonable)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class PlanCache(object):
+    """
+    SQLite cache of plans and of the expected P-values behind them.
+
+    Parameters
+    ----------
+    filename : str
+        the database file; created if it does not exist
+    max_bytes : int
+        cap on the total size of the stored inputs and results. Default is
+        100 MB.
+    version : str
+        version of the code; results stored under another version are not
+        used. Default is `code_version()`.
+    """
+    def __init__(self, filename, max_bytes=10**8, version=None):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.version = version if version is not None else code_version()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection()
+
+    def _connection(self):
+        # a connection must not be shared with a forked process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._db = sqlite3.connect(self.filename, timeout=60, \
+                                       check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS plans ('
+                             'key TEXT PRIMARY KEY, kind TEXT, inputs TEXT, '
+                             'value TEXT, size INTEGER, last_used REAL)')
+            self._db.commit()
+        return self._db
+
+    def get(self, kind, inputs):
+        """
+        The result stored for these inputs, or None.
+        """
+        key = canonical_key(kind, inputs, self.version)
+        db = self._connection()
+        with self._lock:
+            row = db.execute('SELECT value FROM plans WHERE key=?', \
+                             (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            db.execute('UPDATE plans SET last_used=? WHERE key=?', \
+                       (time.time(), key))
+            db.commit()
+        return json.loads(row[0])
+
+    def put(self, kind, inputs, value):
+        """
+        Store a result, evicting the least recently used entries if the
+        cache grows beyond max_bytes.
+        """
+        key = canonical_key(kind, inputs, self.version)
+        inputs = json.dumps(inputs, sort_keys=True, default=_jsonable)
+        value = json.dumps(value, default=_jsonable)
+        size = len(key) + len(kind) + len(inputs) + len(value)
+        db = self._connection()
+        with self._lock:
+            db.execute('INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?, ?)', \
+                       (key, kind, inputs, value, size, time.time()))
+            total = db.execute('SELECT SUM(size) FROM plans').fetchone()[0]
+            if total > self.max_bytes:
+                for (old_key, old_size) in db.execute(\
+                        'SELECT key, size FROM plans ORDER BY last_used').fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    db.execute('DELETE FROM plans WHERE key=?', (old_key,))
+                    total -= old_size
+                    self.evictions += 1
+            db.commit()
+
+    def memoize(self, kind, inputs, compute, restore=None):
+        """
+        The result stored for these inputs, or compute(), which is then
+        stored. Stored results come back from JSON, so tuples come back as
+        lists; `restore`, e.g. tuple, converts them.
+        """
+        value = self.get(kind, inputs)
+        if value is not None:
+            return restore(value) if restore is not None else value
+        value = compute()
+        self.put(kind, inputs, value)
+        return value
+
+    def stats(self):
+        """
+        dict : 'hits', 'misses' and 'evictions' in this process, and the
+        'entries' and 'bytes' in the database
+        """
+        db = self._connection()
+        with self._lock:
+            (entries, size) = db.execute('SELECT COUNT(*), SUM(size) '
+                                         'FROM plans').fetchone()
+        return {'hits' : self.hits, 'misses' : self.misses, \
+                'evictions' : self.evictions, 'entries' : entries, \
+                'bytes' : size or 0}
+
+    def clear(self):
+        """
+        Delete every entry.
+        """
+        db = self._connection()
+        with self._lock:
+            db.execute('DELETE FROM plans')
+            db.commit()
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._db.close()
+        self._pid = None
+
+
+def cached_plan(kind, ignore=('verbose',)):
+    """
+    Decorator for a planning function with a `cache` argument: if a
+    PlanCache is given, the result is looked up by the function's other
+    arguments, except those in `ignore`, which must not change the result.
+    Results are returned as tuples.
+    """
+    def decorator(fun):
+        signature = inspect.signature(fun)
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            cache = bound.arguments.get('cache')
+            if cache is None:
+                return fun(*args, **kwargs)
+            inputs = dict((k, v) for (k, v) in bound.arguments.items() \
+                          if k != 'cache' and k not in ignore)
+            return cache.memoize(kind, inputs, \
+                                 lambda: fun(*args, **kwargs), restore=tuple)
+        return wrapper
+    return decorator
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_plan_cache():
+    import shutil
+    import tempfile
+    from suite_tools import estimate_n, estimate_n_pairs, find_winners_losers
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, 'plans.sqlite')
+        cache = PlanCache(filename)
+        args = dict(N_w1=4550, N_w2=975, N_l1=3950, N_l2=825, N1=8500, \
+                    N2=2000, o1_rate=0.002, risk_limit=0.05, method='secant')
+        expected = estimate_n(**args)
+        assert estimate_n(cache=cache, **args) == expected
+        stats = cache.stats()
+        assert stats['hits'] == 0 and stats['misses'] == stats['entries'] > 1
+
+        # a new process reopens the database; only the plan is looked up
+        cache = PlanCache(filename)
+        assert estimate_n(cache=cache, verbose=True, **args) == expected
+        assert (cache.hits, cache.misses) == (1, 0)
+
+        # another tolerance: a new plan, from the stored expected P-values
+        hits = cache.hits
+        estimate_n(cache=cache, risk_limit_tol=0.7, **args)
+        assert cache.hits > hits
+
+        # pairs of a contest are passed through
+        candidates = {'a' : [4550, 975], 'b' : [3950, 825], 'c' : [0, 200]}
+        (candidates, margins, winners, losers) = \
+            find_winners_losers(candidates, 1)
+        res = estimate_n_pairs(candidates, margins, [8500, 2000], \
+                               o1_rate=0.002, method='secant', cache=cache)
+        assert res['sample_sizes'][('a', 'b')] == expected
+
+        # other code versions are not used
+        other = PlanCache(filename, version='other')
+        assert other.get('estimate_n', {}) is None
+        other.memoize('x', {'n' : np.int64(3)}, lambda: (1, 2))
+        assert other.memoize('x', {'n' : 3}, lambda: None, restore=tuple) == \
+            (1, 2)
+
+        # eviction keeps the database under its cap
+        small = PlanCache(os.path.join(dirname, 'small.sqlite'), max_bytes=1000)
+        for i in range(20):
+            small.put('x', {'i' : i}, [i, i])
+        stats = small.stats()
+        assert stats['bytes'] <= 1000 and stats['evictions'] > 0
+        assert small.get('x', {'i' : 19}) == [19, 19]
+        assert small.get('x', {'i' : 0}) is None
+        for c in (cache, other, small):
+            c.close()
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == "__main__":
+    test_plan_cache()
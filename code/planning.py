@@ -0,0 +1,610 @@
+"""
+Sample size planning for SUITE audits by simulation.
+
+`estimate_n` and `estimate_escalation_n` in `suite_tools` plug the expected
+discrepancy counts and vote shares into the P-values, so the next round
+reaches the risk limit only about half the time. The planners here draw
+the sample many times under stated discrepancy rates and report the
+probability that the audit stops at each sample size.
+"""
+
+from __future__ import division, print_function
+import math
+import multiprocessing
+import numpy as np
+
+import instrumentation
+import logfactorial
+from ballot_comparison import ballot_comparison_pvalue
+from fishers_combination import maximize_fisher_combined_pvalue_batch, \
+    unique_rows, calculate_lambda_range, _chi2_ppf
+from sprt import ballot_polling_sprt_pvalues
+
+################################################################################
+########################## Simulated stratum samples ###########################
+################################################################################
+
+def simulate_sample_counts(N_w2, N_l2, N2, n_values, reps, n_ratio, \
+                           n1=0, n2=0, o1_obs=0, o2_obs=0, u1_obs=0, u2_obs=0, \
+                           n2l_obs=0, n2w_obs=0, \
+                           o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0, \
+                           prng=None):
+    """
+    Draw the counts of the sample after growing it to each total size in
+    `n_values`, `reps` times.
+
+    New CVR ballots have discrepancies independently at the given rates.
+    New no-CVR ballots are drawn without replacement from the ballots not
+    yet sampled, with the reported votes. In each replication the samples
+    for increasing sizes are nested, so the simulated P-values of
+    neighbouring sizes are strongly positively correlated and the
+    stopping-probability curve is smooth.
+
+    Parameters
+    ----------
+    N_w2, N_l2, N2 : int
+        reported votes for the winner and loser, and total ballots, in
+        the no-CVR stratum
+    n_values : array-like
+        total sample sizes, at least n1+n2
+    reps : int
+        number of replications
+    n_ratio : float
+        fraction of the total sample size in the CVR stratum
+    n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, n2l_obs, n2w_obs : int
+        sample already drawn, as in `suite_tools.estimate_escalation_n`.
+        Default 0 (no sample yet).
+    o1_rate, o2_rate, u1_rate, u2_rate : float
+        rates of discrepancies in new CVR ballots
+    prng : RandomState
+        pseudorandom number generator. Default is np.random.
+    Returns
+    -------
+    dict with arrays of shape (len(n_values), reps) for keys
+    'n1', 'o1', 'o2', 'u1', 'u2', 'n2', 'n_w2', 'n_l2', in the order of
+    sorted n_values
+    """
+    prng = np.random if prng is None else prng
+    n_values = np.sort(np.asarray(n_values, dtype=float))
+    size1 = np.ceil(n_ratio*n_values)
+    size2 = np.trunc(n_values - size1)
+    assert np.all(size1 >= n1) and np.all(size2 >= n2), \
+        "sample sizes must be at least the sample already drawn"
+    assert np.all(np.diff(size2) >= 0), "no-CVR sample sizes must increase"
+    assert N2 - n2 >= size2[-1] - n2, "sample is larger than the stratum"
+
+    rates = [o1_rate, o2_rate, u1_rate, u2_rate]
+    assert sum(rates) <= 1, "discrepancy rates must sum to at most 1"
+    counts = dict((k, np.empty((len(n_values), reps))) for k in \
+                  ('o1', 'o2', 'u1', 'u2', 'n_w2', 'n_l2'))
+    discrepancies = np.tile([o1_obs, o2_obs, u1_obs, u2_obs], (reps, 1))
+    n_w2 = np.full(reps, n2w_obs)
+    n_l2 = np.full(reps, n2l_obs)
+    # unsampled ballots for w, l and others in the no-CVR stratum
+    remaining_w = np.full(reps, N_w2 - n2w_obs)
+    remaining_l = np.full(reps, N_l2 - n2l_obs)
+    remaining_u = np.full(reps, (N2 - N_w2 - N_l2) - (n2 - n2w_obs - n2l_obs))
+    last1, last2 = n1, n2
+    for i in range(len(n_values)):
+        new1 = int(size1[i] - last1)
+        if new1 > 0:
+            discrepancies = discrepancies + prng.multinomial(new1, \
+                                rates + [1 - sum(rates)], size=reps)[:, 0:4]
+        new2 = int(size2[i] - last2)
+        if new2 > 0:
+            # w versus the rest, then l versus the others among the rest
+            new_w = _hypergeometric(prng, remaining_w, \
+                                    remaining_l + remaining_u, new2)
+            new_l = _hypergeometric(prng, remaining_l, remaining_u, new2 - new_w)
+            remaining_w = remaining_w - new_w
+            remaining_l = remaining_l - new_l
+            remaining_u = remaining_u - (new2 - new_w - new_l)
+            n_w2 = n_w2 + new_w
+            n_l2 = n_l2 + new_l
+        last1, last2 = size1[i], size2[i]
+        for j, k in enumerate(('o1', 'o2', 'u1', 'u2')):
+            counts[k][i] = discrepancies[:, j]
+        counts['n_w2'][i] = n_w2
+        counts['n_l2'][i] = n_l2
+    counts['n1'] = np.tile(size1[:, None], (1, reps))
+    counts['n2'] = np.tile(size2[:, None], (1, reps))
+    return counts
+
+
+def _hypergeometric(prng, ngood, nbad, nsample):
+    """
+    Hypergeometric draws that allow a population of only good or only bad
+    items, which np.random rejects.
+    """
+    ngood, nbad, nsample = np.broadcast_arrays(ngood, nbad, nsample)
+    draws = np.where(nbad == 0, nsample, 0)
+    mixed = (ngood > 0) & (nbad > 0) & (nsample > 0)
+    if np.any(mixed):
+        draws[mixed] = prng.hypergeometric(ngood[mixed], nbad[mixed], \
+                                           nsample[mixed])
+    return draws
+
+################################################################################
+############################ Simulated SUITE risk ##############################
+################################################################################
+
+def _pvalue_worker(args):
+    (rows, kwargs) = args
+    return maximize_fisher_combined_pvalue_batch(*rows.T, **kwargs)['max_pvalue']
+
+
+def suite_pvalues(N_w1, N_l1, N1, N_w2, N_l2, N2, counts, risk_limit=0.05, \
+                  gamma=1.03905, stepsize=0.05, processes=1, \
+                  logfactorial_size=None):
+    """
+    Maximum combined P-values for the simulated samples in `counts`.
+
+    Distinct samples are evaluated once; they are split among `processes`
+    worker processes (None uses all CPUs), each of which evaluates its
+    share with `maximize_fisher_combined_pvalue_batch`.
+
+    Parameters
+    ----------
+    N_w1, N_l1, N1, N_w2, N_l2, N2 : int
+        as in `maximize_fisher_combined_pvalue`
+    counts : dict
+        sample counts, as returned by `simulate_sample_counts`
+    risk_limit, gamma, stepsize :
+        as in `suite_tools.audit_contest`
+    processes : int
+        number of worker processes. Default 1
+    logfactorial_size : int
+        if given and there are several processes,
+        `logfactorial.create(logfactorial_size)` is called before the workers
+        start, so that they share one table of log factorials; e.g. N1+N2.
+        The table stays attached. Optional
+    Returns
+    -------
+    array of P-values, with the shape of the arrays in `counts`
+    """
+    keys = ('n1', 'o1', 'o2', 'u1', 'u2', 'n2', 'n_w2', 'n_l2')
+    shape = counts['n1'].shape
+    table = np.column_stack([np.ravel(counts[k]) for k in keys])
+    (rows, index) = unique_rows(table)
+    rows = np.column_stack([np.tile([N_w1, N_l1, N1, N_w2, N_l2, N2], \
+                                    (len(rows), 1)), rows])
+    kwargs = {'gamma' : gamma, 'stepsize' : stepsize, 'alpha' : risk_limit}
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(rows)))
+    if processes == 1:
+        pvalues = _pvalue_worker((rows, kwargs))
+    else:
+        if logfactorial_size is not None:
+            logfactorial.create(logfactorial_size)
+        pool = multiprocessing.Pool(processes, \
+                                    **logfactorial.pool_arguments())
+        try:
+            chunks = np.array_split(rows, processes)
+            pvalues = np.concatenate(pool.map(_pvalue_worker, \
+                          [(chunk, kwargs) for chunk in chunks]))
+        finally:
+            pool.close()
+            pool.join()
+    return pvalues[index].reshape(shape)
+
+
+def stopping_probability_curve(N_w1, N_w2, N_l1, N_l2, N1, N2, n_values, \
+                               n1=0, n2=0, o1_obs=0, o2_obs=0, u1_obs=0, \
+                               u2_obs=0, n2l_obs=0, n2w_obs=0, \
+                               o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0, \
+                               n_ratio=None, \
+                               risk_limit=0.05, \
+                               gamma=1.03905, \
+                               stepsize=0.05, \
+                               reps=1000, \
+                               seed=None, \
+                               processes=1, \
+                               logfactorial_size=None):
+    """
+    Estimate the probability that the audit stops, i.e. that the SUITE
+    P-value is at most the risk limit, at each total sample size in
+    `n_values`, by simulating the sample `reps` times.
+
+    Parameters
+    ----------
+    N_w1, N_w2, N_l1, N_l2, N1, N2 : int
+        reported votes and stratum sizes, as in `suite_tools.estimate_n`
+    n_values : array-like
+        total sample sizes to evaluate
+    n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, n2l_obs, n2w_obs : int
+        sample already drawn, as in `suite_tools.estimate_escalation_n`.
+        Default 0 (plan the first round).
+    o1_rate, o2_rate, u1_rate, u2_rate : float
+        rates of discrepancies in the CVR ballots still to be drawn
+    n_ratio : float
+        ratio of sample allocated to each stratum.
+        If None, allocate sample in proportion to ballots cast in each stratum
+    risk_limit, gamma, stepsize :
+        as in `suite_tools.estimate_n`
+    reps : int
+        number of simulated samples. Default 1000
+    seed : int
+        seed for the pseudorandom number generator. Optional
+    processes : int
+        number of worker processes. Default 1; None uses all CPUs
+    logfactorial_size : int
+        size of a table of log factorials shared by the workers, as in
+        `suite_pvalues`. Optional
+    Returns
+    -------
+    dict with
+
+    n, n1, n2 : array
+        total, CVR and no-CVR sample sizes, increasing
+    stopping_probability : array
+        fraction of simulated samples with P-value at most the risk limit
+    pvalues : array
+        simulated P-values, one row per sample size
+    """
+    n_ratio = n_ratio if n_ratio else N1/(N1+N2)
+    prng = np.random.RandomState(seed)
+    n_values = np.unique(np.asarray(n_values, dtype=float))
+    counts = simulate_sample_counts(N_w2, N_l2, N2, n_values, reps, n_ratio, \
+                 n1=n1, n2=n2, o1_obs=o1_obs, o2_obs=o2_obs, u1_obs=u1_obs, \
+                 u2_obs=u2_obs, n2l_obs=n2l_obs, n2w_obs=n2w_obs, \
+                 o1_rate=o1_rate, o2_rate=o2_rate, u1_rate=u1_rate, \
+                 u2_rate=u2_rate, prng=prng)
+    pvalues = suite_pvalues(N_w1, N_l1, N1, N_w2, N_l2, N2, counts, \
+                            risk_limit=risk_limit, gamma=gamma, \
+                            stepsize=stepsize, processes=processes, \
+                            logfactorial_size=logfactorial_size)
+    return {'n' : n_values,
+            'n1' : counts['n1'][:, 0],
+            'n2' : counts['n2'][:, 0],
+            'stopping_probability' : np.mean(pvalues <= risk_limit, axis=1),
+            'pvalues' : pvalues
+            }
+
+
+def estimate_n_quantile(N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                        n1=0, n2=0, o1_obs=0, o2_obs=0, u1_obs=0, \
+                        u2_obs=0, n2l_obs=0, n2w_obs=0, \
+                        o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0, \
+                        n_ratio=None, \
+                        stopping_probability=0.9, \
+                        risk_limit=0.05, \
+                        gamma=1.03905, \
+                        stepsize=0.05, \
+                        reps=1000, \
+                        num=20, \
+                        seed=None, \
+                        processes=1, \
+                        logfactorial_size=None):
+    """
+    Find the smallest total sample size at which the audit stops with at
+    least the given probability, by simulation.
+
+    The stopping probability is first estimated at `num` sizes spaced
+    geometrically between the current sample size and a full hand count,
+    then at up to `num` sizes between the last size below the target
+    probability and the first size reaching it.
+
+    Parameters
+    ----------
+    stopping_probability : float
+        desired probability that the audit stops. Default 0.9
+    num : int
+        number of sample sizes in each of the two passes. Default 20
+    all others :
+        as in `stopping_probability_curve`
+    Returns
+    -------
+    dict with
+
+    sample_size : tuple
+        (n1, n2) for the smallest size reaching the stopping probability, or
+        (N1, N2) if none does short of a full hand count
+    n, n1, n2, stopping_probability : array
+        the curve over all sizes evaluated, as in `stopping_probability_curve`
+    """
+    assert 0 < stopping_probability < 1, "bad stopping probability"
+    n_ratio = n_ratio if n_ratio else N1/(N1+N2)
+    # largest total size for which neither stratum is exhausted
+    max_n = min(N1 + N2, math.floor((N2 - 1)/(1 - n_ratio)) if n_ratio < 1 \
+                else N1)
+    kwargs = dict(n1=n1, n2=n2, o1_obs=o1_obs, o2_obs=o2_obs, u1_obs=u1_obs, \
+                  u2_obs=u2_obs, n2l_obs=n2l_obs, n2w_obs=n2w_obs, \
+                  o1_rate=o1_rate, o2_rate=o2_rate, u1_rate=u1_rate, \
+                  u2_rate=u2_rate, n_ratio=n_ratio, risk_limit=risk_limit, \
+                  gamma=gamma, stepsize=stepsize, reps=reps, seed=seed, \
+                  processes=processes, logfactorial_size=logfactorial_size)
+
+    n_values = np.unique(np.round(np.geomspace(max(n1 + n2, 1), max_n, num)))
+    curve = stopping_probability_curve(N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                                       n_values, **kwargs)
+    reached = np.flatnonzero(curve['stopping_probability'] >= \
+                             stopping_probability)
+    if len(reached) > 0 and reached[0] > 0:
+        (low_n, high_n) = curve['n'][reached[0]-1:reached[0]+1]
+        n_values = np.unique(np.round(np.linspace(low_n, high_n, num)))
+        fine = stopping_probability_curve(N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                                          n_values, **kwargs)
+        keep = ~np.isin(curve['n'], fine['n'])
+        order = np.argsort(np.concatenate([curve['n'][keep], fine['n']]))
+        curve = dict((k, np.concatenate([curve[k][keep], fine[k]])[order]) \
+                     for k in ('n', 'n1', 'n2', 'stopping_probability'))
+        reached = np.flatnonzero(curve['stopping_probability'] >= \
+                                 stopping_probability)
+
+    if len(reached) > 0:
+        i = reached[0]
+        sample_size = (int(curve['n1'][i]), int(curve['n2'][i]))
+    else:
+        sample_size = (N1, N2)
+    return {'sample_size' : sample_size,
+            'n' : curve['n'],
+            'n1' : curve['n1'],
+            'n2' : curve['n2'],
+            'stopping_probability' : curve['stopping_probability']
+            }
+
+
+################################################################################
+############################# Stratum allocation ###############################
+################################################################################
+
+def expected_poll_counts(n2, N_w2, N_l2, N2):
+    """
+    Votes for the winner and the loser expected in a no-CVR sample of size
+    n2 (an array) if it has the reported vote shares, rounded by largest
+    remainders so that no count exceeds the votes in the stratum.
+
+    Returns
+    -------
+    tuple : (votes for the winner, votes for the loser), arrays like n2
+    """
+    n2 = np.asarray(n2, dtype=float)
+    shares = np.array([N_w2, N_l2, N2 - N_w2 - N_l2])/N2
+    exact = n2[..., None]*shares
+    counts = np.floor(exact)
+    leftover = n2 - counts.sum(axis=-1)
+    rank = np.argsort(np.argsort(-(exact - counts), axis=-1), axis=-1)
+    counts = counts + (rank < leftover[..., None])
+    return (counts[..., 0], counts[..., 1])
+
+
+def optimize_allocation(N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                        o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0, \
+                        costs=(1, 1), \
+                        risk_limit=0.05, \
+                        gamma=1.03905, \
+                        stepsize=0.05, \
+                        num=40):
+    """
+    Find the split of the initial sample between the strata that minimizes
+    the cost of the audit, among the splits whose expected combined P-value
+    (as in `suite_tools.estimate_n`, but with the polling counts from
+    `expected_poll_counts`) is at most the risk limit.
+
+    For each CVR sample size n1 the smallest sufficient no-CVR sample size
+    n2 is found by bisection; these pairs form the trade-off frontier. The
+    stratum P-values on a fixed grid of lambdas depend on n1 alone and on
+    n2 alone, so they are cached per stratum and sample size: the combined
+    P-value of any (n1, n2) is the maximum over the grid of Fisher's
+    combination of two cached rows, and nearby splits share nearly all
+    their stratum P-values. The frontier is evaluated at `num` values of
+    n1 spaced geometrically, then refined around the cheapest split until
+    it is exact. The chosen split is checked with
+    `maximize_fisher_combined_pvalue_batch`, including the refinement with
+    the modulus of continuity, and n2 is increased if needed.
+
+    Parameters
+    ----------
+    N_w1, N_w2, N_l1, N_l2, N1, N2, o1_rate, o2_rate, u1_rate, u2_rate, \
+    risk_limit, gamma, stepsize :
+        as in `suite_tools.estimate_n`
+    costs : tuple
+        cost of auditing one ballot in the CVR stratum and in the no-CVR
+        stratum. Default (1, 1), i.e. minimize the total sample size.
+    num : int
+        number of values of n1 in each pass. Default 40
+    Returns
+    -------
+    dict with
+
+    sample_size : tuple
+        the cost-minimizing (n1, n2), or None if no split short of a full
+        hand count meets the risk limit
+    cost : float
+        its cost
+    expected_pvalue : float
+        its expected combined P-value
+    frontier : dict
+        arrays 'n1', 'n2' and 'cost' of the splits evaluated that are not
+        dominated by another split (no other split has both n1 and n2 at
+        most as large), in increasing order of n1
+    """
+    reported_margin = (N_w1+N_w2)-(N_l1+N_l2)
+    (lambda_lower, lambda_upper) = calculate_lambda_range(N_w1, N_l1, N1, \
+                                                          N_w2, N_l2, N2)
+    # five times finer than the first pass of the maximization
+    lambdas = np.linspace(lambda_lower, lambda_upper, \
+                  max(5, int(math.ceil(5*(lambda_upper - lambda_lower)/stepsize)) + 1))
+    # sum of the log P-values must not exceed this for the combination to
+    # be at most the risk limit
+    threshold = -_chi2_ppf(1 - risk_limit, df=4)/2
+
+    cvr_cache = {}
+    def cvr_log_pvalues(n1):
+        if n1 not in cvr_cache:
+            if n1 == 0:
+                cvr_cache[n1] = np.zeros_like(lambdas)
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    cvr_cache[n1] = np.log(ballot_comparison_pvalue(n=n1, \
+                        gamma=gamma, o1=math.ceil(o1_rate*n1), \
+                        u1=math.floor(u1_rate*n1), o2=math.ceil(o2_rate*n1), \
+                        u2=math.floor(u2_rate*n1), \
+                        reported_margin=reported_margin, N=N1, \
+                        null_lambda=lambdas))
+        else:
+            instrumentation.count('cache_hits:planning_cvr_pvalues')
+        return cvr_cache[n1]
+
+    nocvr_cache = {}
+    def nocvr_log_pvalues(n2):
+        if n2 not in nocvr_cache:
+            if n2 == 0:
+                nocvr_cache[n2] = np.zeros_like(lambdas)
+            else:
+                (n_w2, n_l2) = expected_poll_counts(n2, N_w2, N_l2, N2)
+                with np.errstate(divide='ignore'):
+                    nocvr_cache[n2] = np.log(ballot_polling_sprt_pvalues(\
+                        n_w2, n_l2, n2 - n_w2 - n_l2, N2, N_w2, N_l2, \
+                        (N_w2 - N_l2) - (1 - lambdas)*reported_margin))
+        else:
+            instrumentation.count('cache_hits:planning_nocvr_pvalues')
+        return nocvr_cache[n2]
+
+    def sufficient(n1, n2):
+        with np.errstate(invalid='ignore'):
+            return np.nanmax(cvr_log_pvalues(n1) + nocvr_log_pvalues(n2)) \
+                   <= threshold
+
+    frontier = {}
+    def smallest_n2(n1):
+        if n1 not in frontier:
+            if not sufficient(n1, N2):
+                frontier[n1] = None
+            else:
+                (low, high) = (-1, N2)
+                while high - low > 1:
+                    mid = (low + high)//2
+                    if sufficient(n1, mid):
+                        high = mid
+                    else:
+                        low = mid
+                frontier[n1] = high
+        return frontier[n1]
+
+    cost = lambda n1, n2: costs[0]*n1 + costs[1]*n2
+    def cheapest(n1_values):
+        best = None
+        for n1 in n1_values:
+            n2 = smallest_n2(int(n1))
+            if n2 is not None and \
+               (best is None or cost(n1, n2) < cost(best, frontier[best])):
+                best = int(n1)
+        return best
+
+    n1_values = np.unique(np.concatenate([[0], \
+                    np.round(np.geomspace(1, N1, num))]))
+    best = cheapest(n1_values)
+    while best is not None:
+        # refine between the neighbours of the cheapest split
+        i = np.searchsorted(n1_values, best)
+        (low, high) = (n1_values[max(i - 1, 0)], \
+                       n1_values[min(i + 1, len(n1_values) - 1)])
+        if high - low <= 2:
+            break
+        n1_values = np.unique(np.round(np.linspace(low, high, num)))
+        best = cheapest(n1_values)
+
+    if best is None:
+        sample_size = None
+        expected_pvalue = np.nan
+    else:
+        # check the split with the refined maximization
+        (n1, n2) = (best, frontier[best])
+        while True:
+            candidates = np.arange(n2, min(n2 + num, N2) + 1)
+            (n_w2, n_l2) = expected_poll_counts(candidates, N_w2, N_l2, N2)
+            pvalues = maximize_fisher_combined_pvalue_batch(N_w1, N_l1, N1, \
+                          N_w2, N_l2, N2, n1, math.ceil(o1_rate*n1), \
+                          math.ceil(o2_rate*n1), math.floor(u1_rate*n1), \
+                          math.floor(u2_rate*n1), candidates, n_w2, n_l2, \
+                          gamma=gamma, stepsize=stepsize, \
+                          alpha=risk_limit)['max_pvalue']
+            ok = np.flatnonzero(pvalues <= risk_limit)
+            if len(ok) > 0 or candidates[-1] >= N2:
+                break
+            n2 = candidates[-1] + 1
+        if len(ok) > 0:
+            sample_size = (n1, int(candidates[ok[0]]))
+            expected_pvalue = pvalues[ok[0]]
+        else:
+            sample_size = None
+            expected_pvalue = np.nan
+
+    # splits not dominated by another split
+    points = sorted((n1, n2) for n1, n2 in frontier.items() if n2 is not None)
+    pareto = []
+    for (n1, n2) in points:
+        if not pareto or n2 < pareto[-1][1]:
+            pareto.append((n1, n2))
+    pareto = np.array(pareto, dtype=float).reshape(-1, 2)
+    return {'sample_size' : sample_size,
+            'cost' : cost(*sample_size) if sample_size else np.nan,
+            'expected_pvalue' : expected_pvalue,
+            'frontier' : {'n1' : pareto[:, 0],
+                          'n2' : pareto[:, 1],
+                          'cost' : costs[0]*pareto[:, 0] + \
+                                   costs[1]*pareto[:, 1]}
+            }
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_simulate_sample_counts():
+    prng = np.random.RandomState(12345)
+    counts = simulate_sample_counts(510, 490, 1100, [300, 100, 200], 50, 0.9, \
+                                    o1_rate=0.01, prng=prng)
+    np.testing.assert_array_equal(counts['n1'][:, 0], [90, 180, 270])
+    np.testing.assert_array_equal(counts['n2'][:, 0], [10, 20, 30])
+    # samples are nested
+    assert np.all(np.diff(counts['o1'], axis=0) >= 0)
+    assert np.all(np.diff(counts['n_w2'], axis=0) >= 0)
+    assert np.all(counts['n_w2'] + counts['n_l2'] <= counts['n2'])
+    assert np.all(counts['o2'] == 0) and np.all(counts['u1'] == 0)
+
+    # the whole no-CVR stratum
+    counts = simulate_sample_counts(510, 490, 1100, [1100], 5, 0, prng=prng)
+    assert np.all(counts['n_w2'] == 510) and np.all(counts['n_l2'] == 490)
+
+
+def test_estimate_n_quantile():
+    args = (5300, 510, 4700, 490, 11000, 1100)
+    res = estimate_n_quantile(*args, o1_rate=0.002, reps=200, seed=20180514)
+    assert np.all(np.diff(res['n']) > 0)
+    i = list(res['n']).index(sum(res['sample_size']))
+    assert res['stopping_probability'][i] >= 0.9
+    assert res['stopping_probability'][i-1] < 0.9
+
+    # more sample is needed to stop 90% of the time than 50% of the time
+    median = estimate_n_quantile(*args, o1_rate=0.002, reps=200, seed=1, \
+                                 stopping_probability=0.5)
+    assert sum(median['sample_size']) < sum(res['sample_size'])
+
+
+def test_optimize_allocation():
+    from suite_tools import estimate_n
+    args = (5300, 510, 4700, 490, 11000, 1100)
+    res = optimize_allocation(*args, o1_rate=0.001)
+    (n1, n2) = res['sample_size']
+    assert res['expected_pvalue'] <= 0.05
+    assert res['cost'] == n1 + n2
+    # no larger than the proportional allocation
+    assert n1 + n2 <= sum(estimate_n(*args, o1_rate=0.001))
+    assert np.all(np.diff(res['frontier']['n1']) > 0)
+    assert np.all(np.diff(res['frontier']['n2']) < 0)
+    # expensive no-CVR ballots move the sample to the CVR stratum
+    res = optimize_allocation(*args, o1_rate=0.001, costs=(1, 5))
+    assert res['sample_size'][0] >= n1 and res['sample_size'][1] <= n2
+
+    (n_w2, n_l2) = expected_poll_counts(np.arange(1101), 510, 490, 1100)
+    assert np.all(n_w2 <= 510) and np.all(n_l2 <= 490)
+    assert np.all(np.arange(1101) - n_w2 - n_l2 <= 100)
+
+
+if __name__ == "__main__":
+    test_simulate_sample_counts()
+    test_estimate_n_quantile()
+    test_optimize_allocation()
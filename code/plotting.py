@@ -0,0 +1,79 @@
+"""
+Plots of SUITE's P-values. This is the only module that imports matplotlib,
+so that the audit tools can be imported, and worker processes started,
+without it.
+"""
+
+from __future__ import division, print_function
+import numpy as np
+import matplotlib.pyplot as plt
+
+from fishers_combination import fisher_combined_pvalue, calculate_lambda_range
+
+
+def plot_fisher_pvalues(N_w1, N_l1, N1, N_w2, N_l2, N2, pvalue_funs, \
+                        alpha=None, stepsize=0.5, show=True):
+    """
+    Plot the Fisher's combined p-value for varying error allocations
+    using data X=(X1, X2)
+
+    Parameters
+    ----------
+    N_w1, N_l1, N1, N_w2, N_l2, N2 : int
+        votes for the reported winner and loser, and total votes, in the
+        ballot comparison and ballot polling strata, as in
+        `maximize_fisher_combined_pvalue`
+    pvalue_funs : array_like
+        functions for computing p-values. The observed statistics/sample and known parameters should be plugged in already. The function should take the lambda allocation AS INPUT and output a p-value.
+    alpha : float
+        Optional, desired upper percentage point
+    stepsize : float
+        spacing of the allocations plotted. Default is 0.5.
+    show : bool
+        show the plot? Default is True.
+
+    Returns
+    -------
+    tuple : the allocations lambda and the combined P-values plotted
+    """
+    assert len(pvalue_funs)==2
+
+    # find range of possible lambda
+    (lambda_lower, lambda_upper) = calculate_lambda_range(N_w1, N_l1, N1, N_w2, N_l2, N2)
+
+    lambdas = np.arange(lambda_lower, lambda_upper+1, stepsize)
+    fisher_pvalues = []
+    for lam in lambdas:
+        pvalue1 = np.min([1, pvalue_funs[0](lam)])
+        pvalue2 = np.min([1, pvalue_funs[1](1-lam)])
+        fisher_pvalues.append(fisher_combined_pvalue([pvalue1, pvalue2]))
+
+    plt.scatter(lambdas, fisher_pvalues, color='black')
+    if alpha is not None:
+        plt.axhline(y=alpha, linestyle='--', color='gray')
+    plt.xlabel("Allocation of Allowable Error")
+    plt.ylabel("Fisher Combined P-value")
+    if show:
+        plt.show()
+    return (lambdas, np.array(fisher_pvalues))
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_plot_fisher_pvalues():
+    import fishers_combination
+    plt.switch_backend('Agg')
+    pvalue_funs = (lambda lam: 0.1*np.exp(-lam), lambda lam: 0.5)
+    (lambdas, pvalues) = fishers_combination.plot_fisher_pvalues(1000, 900, \
+        2000, 500, 400, 1000, pvalue_funs, alpha=0.05, show=False)
+    assert len(lambdas) == len(pvalues) > 1
+    for (lam, pvalue) in zip(lambdas, pvalues):
+        assert pvalue == fisher_combined_pvalue([min(1, 0.1*np.exp(-lam)), \
+                                                 0.5])
+    plt.close('all')
+
+
+if __name__ == "__main__":
+    test_plot_fisher_pvalues()
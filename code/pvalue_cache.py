@@ -0,0 +1,220 @@
+"""
+Memoization of the stratum P-values.
+
+The same stratum P-values are computed many times: around the maximizing
+lambda when the grid search of `maximize_fisher_combined_pvalue` is refined,
+by the sample size searches, and in every round of an audit, in which the
+data of one stratum may not have changed. `ballot_comparison_pvalue` and
+`ballot_polling_sprt_pvalue` look P-values up by their full parameter tuple
+in a shared least-recently-used cache, with a cap on its memory. Each
+stratum's P-values are cached separately, so a stratum whose data did not
+change reuses its whole curve.
+
+The cache is safe to use from several threads. Each process has its own
+cache: a worker process started by fork begins with an empty one.
+"""
+
+from __future__ import division, print_function
+from collections import OrderedDict
+import os
+import sys
+import threading
+import numpy as np
+
+import instrumentation
+import ballot_comparison
+import sprt
+
+
+# Estimated bytes per entry on top of the key and value: the OrderedDict
+# node and hash table slot
+_ENTRY_OVERHEAD = 100
+
+
+class LRUCache(object):
+    """
+    A dict with least-recently-used eviction once its estimated size
+    exceeds max_bytes, and hit, miss and eviction counts.
+
+    Parameters
+    ----------
+    max_bytes : int
+        cap on the estimated memory of the entries. 0 disables the cache.
+        Default is 64 MiB.
+    """
+    def __init__(self, max_bytes=64*2**20):
+        assert max_bytes >= 0
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Remove every entry and reset the statistics.
+        """
+        self._pid = os.getpid()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _check_process(self):
+        # entries and statistics inherited from a parent process are not
+        # this process's
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self.clear()
+
+    def get_or_compute(self, key, compute):
+        """
+        The value cached under key, a tuple, or compute() if there is none,
+        which is then cached.
+        """
+        self._check_process()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            instrumentation.count('cache_hits:pvalue_cache')
+            return entry[0]
+
+        value = compute()
+        size = sys.getsizeof(key) + 32*len(key) + sys.getsizeof(value) + \
+               _ENTRY_OVERHEAD
+        with self._lock:
+            self.misses += 1
+            if size > self.max_bytes:
+                return value
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self._bytes += size
+            while self._bytes > self.max_bytes:
+                (old_value, old_size) = self._entries.popitem(last=False)[1]
+                self._bytes -= old_size
+                self.evictions += 1
+        return value
+
+    def stats(self):
+        """
+        dict : 'hits', 'misses', 'evictions', 'entries', 'bytes' (estimated)
+        and 'max_bytes'
+        """
+        self._check_process()
+        with self._lock:
+            return {'hits' : self.hits,
+                    'misses' : self.misses,
+                    'evictions' : self.evictions,
+                    'entries' : len(self._entries),
+                    'bytes' : self._bytes,
+                    'max_bytes' : self.max_bytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+PVALUE_CACHE = LRUCache()
+
+
+################################################################################
+########################### Cached P-values ####################################
+################################################################################
+
+def ballot_comparison_pvalue(n, gamma, o1, u1, o2, u2, reported_margin, N, \
+                             null_lambda=1, cache=PVALUE_CACHE):
+    """
+    `ballot_comparison.ballot_comparison_pvalue` for scalar arguments,
+    cached in `cache`.
+    """
+    key = ('ballot_comparison', n, gamma, o1, u1, o2, u2, reported_margin, \
+           N, null_lambda)
+    return cache.get_or_compute(key, \
+        lambda: ballot_comparison.ballot_comparison_pvalue(n=n, gamma=gamma, \
+                    o1=o1, u1=u1, o2=o2, u2=u2, \
+                    reported_margin=reported_margin, N=N, \
+                    null_lambda=null_lambda))
+
+
+def ballot_polling_sprt_pvalue(Wn, Ln, Un, popsize, Vw, Vl, null_margin=0, \
+                               cache=PVALUE_CACHE):
+    """
+    P-value of `sprt.ballot_polling_sprt` for a sample with Wn ballots for
+    w, Ln for l and Un others, cached in `cache`. The P-value depends on
+    the sample only through these counts, and not on the risk limit.
+    """
+    key = ('ballot_polling_sprt', Wn, Ln, Un, popsize, Vw, Vl, null_margin)
+    def compute():
+        sample = np.array([1]*int(Wn) + [0]*int(Ln) + [np.nan]*int(Un))
+        return sprt.ballot_polling_sprt(sample, popsize, 0.05, Vw, Vl, \
+                                        null_margin=null_margin)['pvalue']
+    return cache.get_or_compute(key, compute)
+
+
+def sample_counts(sample):
+    """
+    Numbers of ballots for w (1), for l (0) and others in a sample.
+    """
+    sample = np.asarray(sample)
+    Wn = int(np.sum(sample == 1))
+    Ln = int(np.sum(sample == 0))
+    return (Wn, Ln, len(sample) - Wn - Ln)
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_pvalue_cache():
+    cache = LRUCache(max_bytes=10**6)
+    args = dict(n=200, gamma=1.03905, o1=1, u1=0, o2=0, u2=0, \
+                reported_margin=500, N=5000)
+    for lam in (0.2, 0.4, 0.2, 0.4, 0.6):
+        assert ballot_comparison_pvalue(null_lambda=lam, cache=cache, \
+                                        **args) == \
+            ballot_comparison.ballot_comparison_pvalue(null_lambda=lam, **args)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (2, 3, 3)
+
+    sample = [1]*60 + [0]*40 + [np.nan]*20
+    counts = sample_counts(sample)
+    assert counts == (60, 40, 20)
+    for margin in (0, 10, 0):
+        assert ballot_polling_sprt_pvalue(*counts, popsize=1000, Vw=500, \
+                                          Vl=400, null_margin=margin, \
+                                          cache=cache) == \
+            sprt.ballot_polling_sprt(sample, 1000, 0.1, 500, 400, \
+                                     null_margin=margin)['pvalue']
+    assert cache.stats()['hits'] == 3
+
+    # least recently used entries are evicted to respect the cap
+    small = LRUCache()
+    small.get_or_compute(('a',), lambda: 1.0)
+    small.max_bytes = 3*small.stats()['bytes']
+    for key in ('b', 'c', 'a', 'd'):
+        small.get_or_compute((key,), lambda: 1.0)
+    stats = small.stats()
+    assert (stats['entries'], stats['evictions']) == (3, 1)
+    assert small.get_or_compute(('a',), lambda: 2.0) == 1.0
+    assert small.get_or_compute(('b',), lambda: 2.0) == 2.0
+    assert LRUCache(max_bytes=0).get_or_compute(('x',), lambda: 3) == 3
+
+    # threads share the cache
+    from multiprocessing.pool import ThreadPool
+    threaded = LRUCache()
+    pool = ThreadPool(4)
+    try:
+        res = pool.map(lambda i: threaded.get_or_compute((i % 10,), \
+                                                         lambda: i % 10), \
+                       range(1000))
+    finally:
+        pool.close()
+        pool.join()
+    assert res == [i % 10 for i in range(1000)]
+    stats = threaded.stats()
+    assert stats['entries'] == 10 and stats['hits'] + stats['misses'] == 1000
+
+
+if __name__ == "__main__":
+    test_pvalue_cache()
@@ -1,10 +1,17 @@
 from __future__ import division
+from collections import OrderedDict
 import math
 import numpy as np
 import numpy.random
 import scipy as sp
-import scipy.stats
-import scipy.optimize
+# scipy.optimize is slow to import, so it is imported in the functions that
+# use it
+from scipy.special import digamma
+
+import instrumentation
+import kernels
+from logfactorial import log_falling_factorial
+from hypergeometric import polling_sample_logpmf, _polling_sample_grid
 
 
 def ballot_polling_sprt(sample, popsize, alpha, Vw, Vl, 
@@ -41,7 +48,10 @@ def ballot_polling_sprt(sample, popsize, alpha, Vw, Vl,
     -------
     dict
     """
-    
+    import scipy.optimize
+
+    instrumentation.count('pvalues:ballot_polling_sprt')
+
     # Set parameters
     upper = 1/alpha
     n = len(sample)
@@ -57,14 +67,15 @@ def ballot_polling_sprt(sample, popsize, alpha, Vw, Vl,
     Vl = int(Vl)
     Vu = int(popsize - Vw - Vl)
     assert Vw >= Wn and Vl >= Ln and Vu >= Un, "Alternative hypothesis isn't consistent with the sample"
-    alt_logLR = np.sum(np.log(Vw - np.arange(Wn))) + \
-                np.sum(np.log(Vl - np.arange(Ln))) + \
-                np.sum(np.log(Vu - np.arange(Un)))
+    # log falling factorials, from the log-factorial table for the integer
+    # counts of the alternative
+    alt_logLR = float(_log_falling_factorial(Vw, Wn) + \
+                      _log_falling_factorial(Vl, Ln) + \
+                      _log_falling_factorial(Vu, Un))
         
 #    np.seterr(divide='ignore', invalid='ignore')
-    null_logLR = lambda Nw: np.sum(np.log(Nw - np.arange(Wn))) + \
-                np.sum(np.log(Nw - null_margin - np.arange(Ln))) + \
-                np.sum(np.log(popsize - 2*Nw + null_margin - np.arange(Un)))
+    null_logLR = lambda Nw: float(_sprt_null_loglik(Nw, Wn, Ln, Un, popsize, \
+                                                    null_margin))
     
     # This is for testing purposes. In practice, number_invalid will be unknown.
     if number_invalid is not None:
@@ -112,7 +123,11 @@ def ballot_polling_sprt(sample, popsize, alpha, Vw, Vl,
         if lower_Nw_limit > upper_Nw_limit:
             lower_Nw_limit, upper_Nw_limit = upper_Nw_limit, lower_Nw_limit
         
-        LR_derivative = lambda Nw: np.sum([1/(Nw - i) for i in range(Wn)]) + \
+        if kernels.ENABLED:
+            LR_derivative = lambda Nw: kernels.sprt_null_loglik_derivatives(\
+                                Nw, Wn, Ln, Un, popsize, null_margin)[0]
+        else:
+            LR_derivative = lambda Nw: np.sum([1/(Nw - i) for i in range(Wn)]) + \
                     np.sum([1/(Nw - null_margin - i) for i in range(Ln)]) - \
                     2*np.sum([1/(popsize - 2*Nw + null_margin - i) for i in range(Un)])
 
@@ -125,8 +140,14 @@ def ballot_polling_sprt(sample, popsize, alpha, Vw, Vl,
         if LR_derivative(upper_Nw_limit)*LR_derivative(lower_Nw_limit) > 0:
             nuisance_param = upper_Nw_limit if null_logLR(upper_Nw_limit)>=null_logLR(lower_Nw_limit) else lower_Nw_limit
         # Otherwise, find the (unique) root of the derivative of the log likelihood ratio
+        elif kernels.ENABLED:
+            (nuisance_param, iterations) = kernels.sprt_nuisance(Wn, Ln, Un, \
+                popsize, null_margin, lower_Nw_limit, upper_Nw_limit)
+            instrumentation.count('root_iterations:newton_kernel', iterations)
         else:
-            nuisance_param = sp.optimize.brentq(LR_derivative, lower_Nw_limit, upper_Nw_limit)
+            (nuisance_param, root) = sp.optimize.brentq(LR_derivative, \
+                lower_Nw_limit, upper_Nw_limit, full_output=True)
+            instrumentation.count('root_iterations:brentq', root.iterations)
 #            nuisance_param = np.floor(nuisance_param) if null_logLR(np.floor(nuisance_param))>=null_logLR(np.ceil(nuisance_param)) else np.ceil(nuisance_param)
         number_invalid = popsize - nuisance_param*2 + null_margin
 
@@ -171,6 +192,727 @@ def ballot_polling_sprt(sample, popsize, alpha, Vw, Vl,
             }
 
 
+def _log_falling_factorial(x, k):
+    """
+    log(x (x-1) ... (x-k+1)) elementwise, the vectorized form of
+    np.sum(np.log(x - np.arange(k))): -inf if x = k-1 and nan if x < k-1.
+    """
+    x, k = np.broadcast_arrays(np.asarray(x, dtype=float),
+                               np.asarray(k, dtype=float))
+    bottom = x - k + 1
+    with np.errstate(invalid='ignore'):
+        res = log_falling_factorial(x, k)
+    res = np.where(bottom == 0, -np.inf, res)
+    res = np.where(bottom < 0, np.nan, res)
+    return np.where(k == 0, 0.0, res)
+
+
+def _sum_reciprocals(x, k):
+    """
+    1/x + 1/(x-1) + ... + 1/(x-k+1) elementwise: inf if x = k-1 and nan
+    if x < k-1.
+    """
+    x, k = np.broadcast_arrays(np.asarray(x, dtype=float),
+                               np.asarray(k, dtype=float))
+    bottom = x - k + 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = digamma(x + 1) - digamma(bottom)
+    res = np.where(bottom == 0, np.inf, res)
+    res = np.where(bottom < 0, np.nan, res)
+    return np.where(k == 0, 0.0, res)
+
+
+def _sum_reciprocal_squares(x, k):
+    """
+    Approximately 1/x^2 + 1/(x-1)^2 + ... + 1/(x-k+1)^2 elementwise: inf if
+    x = k-1 and nan if x < k-1. Each term 1/y^2 is replaced by
+    1/((y-1/2)(y+1/2)), so the sum telescopes; the relative error is
+    below 1/(4(x-k+1)^2).
+    """
+    x, k = np.broadcast_arrays(np.asarray(x, dtype=float),
+                               np.asarray(k, dtype=float))
+    bottom = x - k + 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = k/((x + 0.5)*(bottom - 0.5))
+    res = np.where(bottom <= 0.5, np.inf, res)
+    res = np.where(bottom < 0, np.nan, res)
+    return np.where(k == 0, 0.0, res)
+
+
+def _sprt_null_loglik(Nw, Wn, Ln, Un, popsize, null_margin):
+    return _log_falling_factorial(Nw, Wn) + \
+           _log_falling_factorial(Nw - null_margin, Ln) + \
+           _log_falling_factorial(popsize - 2*Nw + null_margin, Un)
+
+
+def _sprt_null_loglik_derivative(Nw, Wn, Ln, Un, popsize, null_margin):
+    return _sum_reciprocals(Nw, Wn) + \
+           _sum_reciprocals(Nw - null_margin, Ln) - \
+           2*_sum_reciprocals(popsize - 2*Nw + null_margin, Un)
+
+
+def _sprt_null_loglik_second_derivative(Nw, Wn, Ln, Un, popsize, null_margin):
+    return -_sum_reciprocal_squares(Nw, Wn) - \
+           _sum_reciprocal_squares(Nw - null_margin, Ln) - \
+           4*_sum_reciprocal_squares(popsize - 2*Nw + null_margin, Un)
+
+
+def _sprt_maximize_null(Wn, Ln, Un, popsize, null_margin):
+    """
+    Maximize the null likelihood of `ballot_polling_sprt` over the nuisance
+    parameter Nw, elementwise. The arguments are 1-d arrays of equal length.
+
+    The log likelihood is concave in Nw, so the root of its derivative is
+    found by safeguarded Newton iterations, for all elements at once.
+
+    Returns
+    -------
+    tuple : (maximizing Nw, null log likelihood there, mask of elements for
+    which the null is impossible given the sample)
+    """
+    upper = (popsize - Un + null_margin)/2
+    lower = np.maximum(Wn, Ln + null_margin)
+    impossible = (upper < Wn) | ((upper - null_margin) < Ln)
+    lower, upper = np.minimum(lower, upper), np.maximum(lower, upper)
+
+    args = (Wn, Ln, Un, popsize, null_margin)
+    with np.errstate(invalid='ignore'):
+        # Sometimes the upper limit is too extreme, causing illegal 0s.
+        too_extreme = np.isinf(_sprt_null_loglik(upper, *args)) | \
+                      np.isinf(_sprt_null_loglik_derivative(upper, *args))
+        upper = np.where(too_extreme, upper - 1, upper)
+
+        deriv_lower = _sprt_null_loglik_derivative(lower, *args)
+        deriv_upper = _sprt_null_loglik_derivative(upper, *args)
+        at_endpoint = deriv_upper*deriv_lower > 0
+        nuisance = np.where(_sprt_null_loglik(upper, *args) >= \
+                            _sprt_null_loglik(lower, *args), upper, lower)
+
+        # Newton's method on the derivative, which is decreasing, with an
+        # approximate second derivative, falling back to bisection whenever
+        # a step leaves the bracket
+        lo = np.where(deriv_upper == 0, upper, lower)
+        hi = np.where(deriv_lower == 0, lower, upper)
+        root = (lo + hi)/2
+        active = np.flatnonzero(~at_endpoint & ~impossible)
+        eps = np.finfo(float).eps
+        while len(active) > 0:
+            instrumentation.count('root_iterations:newton', len(active))
+            x = root[active]
+            sub = (Wn[active], Ln[active], Un[active], popsize[active], \
+                   null_margin[active])
+            deriv = _sprt_null_loglik_derivative(x, *sub)
+            a = np.where(deriv >= 0, x, lo[active])
+            b = np.where(deriv <= 0, x, hi[active])
+            newton = x - deriv/_sprt_null_loglik_second_derivative(x, *sub)
+            step_ok = (newton > a) & (newton < b)
+            x_new = np.where(step_ok, newton, (a + b)/2)
+            tol = 2e-12 + 4*eps*np.abs(x)
+            converged = (np.abs(x_new - x) <= tol) | ((b - a) <= tol) | \
+                        (deriv == 0)
+            lo[active] = a
+            hi[active] = b
+            root[active] = np.where(deriv == 0, x, x_new)
+            active = active[~converged]
+        nuisance = np.where(at_endpoint, nuisance, root)
+
+        number_invalid = popsize - nuisance*2 + null_margin
+        impossible = impossible | (nuisance < 0) | (nuisance > popsize) | \
+                     (nuisance < Wn) | ((nuisance - null_margin) < Ln) | \
+                     (number_invalid < Un)
+        return (nuisance, _sprt_null_loglik(nuisance, *args), impossible)
+
+
+def _sprt_likelihood_ratios(Wn, Ln, Un, popsize, Vw, Vl, null_margin,
+                            number_invalid=None):
+    """
+    Likelihood ratios of `ballot_polling_sprt` for 1-d arrays of sample
+    counts and parameters of equal length.
+
+    Returns
+    -------
+    tuple : (likelihood ratios, nuisance parameters Nw used, numbers of
+    invalid ballots used)
+    """
+    Vw = np.trunc(Vw)
+    Vl = np.trunc(Vl)
+    Vu = np.trunc(popsize - Vw - Vl)
+    assert np.all(Vw >= Wn) and np.all(Vl >= Ln) and np.all(Vu >= Un), \
+        "Alternative hypothesis isn't consistent with the sample"
+    alt_logLR = _log_falling_factorial(Vw, Wn) + \
+                _log_falling_factorial(Vl, Ln) + \
+                _log_falling_factorial(Vu, Un)
+
+    if number_invalid is None:
+        (nuisance, null_logLR, impossible) = _sprt_maximize_null(Wn, Ln, \
+                                                 Un, popsize, null_margin)
+        number_invalid = popsize - nuisance*2 + null_margin
+    else:
+        nuisance = (popsize - number_invalid + null_margin)/2
+        impossible = (nuisance < 0) | (nuisance > popsize) | \
+                     (nuisance < Wn) | ((nuisance - null_margin) < Ln) | \
+                     (number_invalid < Un)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            null_logLR = _sprt_null_loglik(nuisance, Wn, Ln, Un, popsize, \
+                                           null_margin)
+    with np.errstate(over='ignore', invalid='ignore'):
+        LR = np.exp(alt_logLR - null_logLR)
+    LR = np.where(impossible, np.inf, LR)
+    return (LR, nuisance, number_invalid)
+
+
+def _broadcast_counts(*args):
+    """
+    Broadcast the arguments against each other as float arrays, and
+    flatten them.
+
+    Returns
+    -------
+    tuple : (broadcast shape, list of flattened arrays)
+    """
+    arrays = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in args])
+    return (arrays[0].shape, [a.ravel() for a in arrays])
+
+
+def ballot_polling_sprt_pvalues(Wn, Ln, Un, popsize, Vw, Vl, null_margin=0):
+    """
+    P-values of `ballot_polling_sprt` for many samples and/or null margins
+    at once. The samples are given by their counts, and all arguments are
+    broadcast against each other.
+
+    The nuisance parameter is found for all elements simultaneously,
+    by safeguarded Newton iterations on the derivative of the null log
+    likelihood, instead of a call to `brentq` per element. The P-values agree with those of
+    `ballot_polling_sprt` to about 1e-12 relative error.
+
+    Parameters
+    ----------
+    Wn : array-like
+        number of ballots for w in the sample
+    Ln : array-like
+        number of ballots for l in the sample
+    Un : array-like
+        number of other ballots in the sample
+    popsize : array-like
+        total size of population being audited
+    Vw : array-like
+        total number of votes for w under the alternative hypothesis
+    Vl : array-like
+        total number of votes for l under the alternative hypothesis
+    null_margin : array-like
+        vote margin between w and l under the null hypothesis; optional
+        (default 0)
+    Returns
+    -------
+    numpy array of P-values, with the broadcast shape of the arguments
+    """
+    (shape, arrays) = _broadcast_counts(Wn, Ln, Un, popsize, Vw, Vl, \
+                                        null_margin)
+    instrumentation.count('pvalues:ballot_polling_sprt', len(arrays[0]))
+    LR = _sprt_likelihood_ratios(*arrays)[0]
+    with np.errstate(divide='ignore'):
+        pvalue = 1/LR
+    pvalue = np.where(pvalue < 1, pvalue, 1.0)
+    return pvalue.reshape(shape)
+
+
+def ballot_polling_sprt_batch(Wn, Ln, Un, popsize, alpha, Vw, Vl,
+                              null_margin=0, number_invalid=None):
+    """
+    Conduct `ballot_polling_sprt` for many samples at once, such as the
+    reps of a simulation study. The samples are given by their counts, and
+    all arguments except alpha are broadcast against each other.
+
+    The nuisance parameter is maximized for all samples simultaneously by
+    vectorized safeguarded Newton iterations (see `_sprt_maximize_null`),
+    so the cost is a few array passes rather than a `brentq` call per
+    sample.
+
+    Parameters
+    ----------
+    Wn : array-like
+        number of ballots for w in each sample
+    Ln : array-like
+        number of ballots for l in each sample
+    Un : array-like
+        number of other ballots in each sample
+    popsize : array-like
+        total size of population being audited
+    alpha : float
+        desired type 1 error rate
+    Vw : array-like
+        total number of votes for w under the alternative hypothesis
+    Vl : array-like
+        total number of votes for l under the alternative hypothesis
+    null_margin : array-like
+        vote margin between w and l under the null hypothesis; optional
+        (default 0)
+    number_invalid : array-like
+        total number of invalid items in the population; optional (default
+        None)
+    Returns
+    -------
+    dict : 'decision' (1 to reject the null, 0 to accept it, np.nan if
+    neither), 'upper_threshold', 'LR', 'pvalue', 'Nu_used' and 'Nw_used',
+    as in `ballot_polling_sprt`, with arrays of the broadcast shape of the
+    arguments
+    """
+    upper = 1/alpha
+    args = (Wn, Ln, Un, popsize, Vw, Vl, null_margin)
+    if number_invalid is not None:
+        args = args + (number_invalid, )
+    (shape, arrays) = _broadcast_counts(*args)
+    (LR, nuisance, number_invalid) = _sprt_likelihood_ratios(*arrays)
+
+    decision = np.full(LR.shape, np.nan)
+    decision[LR <= 0] = 0
+    decision[LR >= upper] = 1
+    with np.errstate(divide='ignore'):
+        pvalue = 1/LR
+    pvalue = np.where(pvalue < 1, pvalue, 1.0)
+    return {'decision' : decision.reshape(shape),
+            'upper_threshold' : upper,
+            'LR' : LR.reshape(shape),
+            'pvalue' : pvalue.reshape(shape),
+            'Nu_used' : number_invalid.reshape(shape),
+            'Nw_used' : nuisance.reshape(shape)
+            }
+
+
+def _sprt_alt_loglik(Wn, Ln, Un, Vw, Vl, Vu):
+    """
+    Log likelihood of the sample counts under the alternative: -inf where
+    the sample has more ballots of a kind than the alternative allows.
+    """
+    consistent = (Wn <= Vw) & (Ln <= Vl) & (Un <= Vu)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = _log_falling_factorial(Vw, Wn) + \
+              _log_falling_factorial(Vl, Ln) + \
+              _log_falling_factorial(Vu, Un)
+    return np.where(consistent, res, -np.inf)
+
+
+def _distinct_prefixes(n, Wn, Ln):
+    """
+    The distinct (sample size, Wn, Ln) of a chunk of sample paths, where
+    column j of the 2-d arrays Wn and Ln holds the counts after n + j + 1
+    ballots. Duplicates are found by marking a dense grid spanning the
+    observed counts, which is cheaper than sorting.
+
+    Returns
+    -------
+    tuple : (Wn, Ln, Un) of the distinct prefixes, and the index of each
+    prefix's distinct element, with the shape of Wn
+    """
+    steps = Wn.shape[1]
+    (w_lo, l_lo) = (Wn.min(), Ln.min())
+    (w_range, l_range) = (Wn.max() - w_lo + 1, Ln.max() - l_lo + 1)
+    key = (np.arange(steps)*w_range + (Wn - w_lo))*l_range + (Ln - l_lo)
+    grid = np.zeros(steps*w_range*l_range, dtype=bool)
+    grid[key.ravel()] = True
+    distinct = np.flatnonzero(grid)
+    position = np.cumsum(grid) - 1
+    size = n + 1 + distinct // (w_range*l_range)
+    Wn = w_lo + (distinct // l_range) % w_range
+    Ln = l_lo + distinct % l_range
+    return (Wn.astype(float), Ln.astype(float), (size - Wn - Ln).astype(float),
+            position[key])
+
+
+def simulate_sprt_stopping_times(popsize, Nw, Nl, Vw, Vl, null_margin=0,
+                                 alpha=0.05, reps=10000, max_n=None,
+                                 quantiles=(0.25, 0.5, 0.75, 0.9, 0.99),
+                                 chunk=50, seed=None):
+    """
+    Simulate the sequential `ballot_polling_sprt`, drawing one ballot at a
+    time without replacement, and find the number of ballots at which it
+    stops (rejects the null).
+
+    The ballot sequences of all reps are drawn together, `chunk` ballots at
+    a time, and the log likelihood ratio is evaluated for every prefix at
+    once from the cumulative counts. The nuisance parameter is maximized
+    only once for each distinct (n, Wn, Ln) among the prefixes, by
+    `_sprt_maximize_null`. Reps stop drawing as soon as they stop.
+
+    Parameters
+    ----------
+    popsize : int
+        total size of population being audited
+    Nw : int
+        true number of votes for w in the population
+    Nl : int
+        true number of votes for l in the population
+    Vw : int
+        total number of votes for w under the alternative hypothesis
+    Vl : int
+        total number of votes for l under the alternative hypothesis
+    null_margin : int
+        vote margin between w and l under the null hypothesis; optional
+        (default 0)
+    alpha : float
+        desired type 1 error rate. Default is 0.05.
+    reps : int
+        number of simulated audits. Default is 10000.
+    max_n : int
+        largest sample size; the audit is a full count if it has not
+        stopped by then. Default is popsize.
+    quantiles : tuple
+        quantiles of the stopping time to return
+    chunk : int
+        number of ballots drawn per rep at a time. Default is 50.
+    seed : int
+        seed for the random number generator. Optional.
+    Returns
+    -------
+    dict : 'stopping_times' (np.inf for reps that did not stop by max_n),
+    'rejection_rate', 'asn' (average sample number, counting max_n for
+    reps that did not stop), and 'quantiles' (OrderedDict of the stopping
+    time quantiles, np.inf if above max_n)
+    """
+    popsize = int(popsize)
+    max_n = popsize if max_n is None else min(int(max_n), popsize)
+    Vw = int(Vw)
+    Vl = int(Vl)
+    Vu = popsize - Vw - Vl
+    threshold = np.log(1/alpha)
+    prng = np.random.default_rng(seed)
+
+    remaining = np.tile(np.array([Nw, Nl, popsize - Nw - Nl], dtype=int),
+                        (reps, 1))
+    counts = np.zeros((reps, 2), dtype=int)
+    stopping_times = np.full(reps, np.inf)
+    active = np.arange(reps)
+    n = 0
+    while len(active) > 0 and n < max_n:
+        steps = min(chunk, max_n - n)
+        # the next ballots of every active rep: how many of each kind is
+        # multivariate hypergeometric, and their order is uniformly random.
+        # 0 is a ballot for w, 1 for l and 2 for the rest.
+        left = remaining[active]
+        drawn_w = prng.hypergeometric(left[:, 0], left[:, 1] + left[:, 2], \
+                                      steps)
+        drawn_l = prng.hypergeometric(left[:, 1], left[:, 2], steps - drawn_w)
+        remaining[active] -= np.column_stack([drawn_w, drawn_l, \
+                                              steps - drawn_w - drawn_l])
+        position = np.arange(steps)
+        draws = (position >= drawn_w[:, None]).astype(np.int8) + \
+                (position >= (drawn_w + drawn_l)[:, None])
+        draws = prng.permuted(draws, axis=1)
+
+        # cumulative counts of every prefix in the chunk
+        path = [counts[active, c][:, None] + \
+                np.cumsum(draws == c, axis=1, dtype=np.int32) for c in (0, 1)]
+        counts[active, 0:2] += np.column_stack([drawn_w, drawn_l])
+        (Wn, Ln, Un, index) = _distinct_prefixes(n, path[0], path[1])
+        (nuisance, null_loglik, impossible) = _sprt_maximize_null(Wn, Ln, \
+            Un, np.full(len(Wn), popsize), np.full(len(Wn), null_margin))
+        with np.errstate(invalid='ignore'):
+            logLR = _sprt_alt_loglik(Wn, Ln, Un, Vw, Vl, Vu) - null_loglik
+        reject = (impossible | (logLR >= threshold))[index]
+
+        stopped = np.any(reject, axis=1)
+        stopping_times[active[stopped]] = \
+            n + 1 + np.argmax(reject[stopped], axis=1)
+        active = active[~stopped]
+        n += steps
+
+    order = np.sort(stopping_times)
+    q = OrderedDict((p, order[max(int(np.ceil(p*reps)) - 1, 0)])
+                    for p in quantiles)
+    return {'stopping_times' : stopping_times,
+            'rejection_rate' : np.mean(np.isfinite(stopping_times)),
+            'asn' : np.mean(np.minimum(stopping_times, max_n)),
+            'quantiles' : q
+            }
+
+
+def _sprt_log_likelihood_ratios(Wn, Ln, Un, popsize, Vw, Vl, null_margin):
+    """
+    Log likelihood ratios of `ballot_polling_sprt` for 1-d arrays of sample
+    counts: inf where the null is impossible given the sample and -inf
+    where the alternative is.
+    """
+    size = len(Wn)
+    (nuisance, null_loglik, impossible) = _sprt_maximize_null(Wn, Ln, Un, \
+        np.full(size, popsize), np.full(size, null_margin))
+    alt_loglik = _sprt_alt_loglik(Wn, Ln, Un, Vw, Vl, popsize - Vw - Vl)
+    with np.errstate(invalid='ignore'):
+        logLR = np.where(impossible, np.inf, alt_loglik - null_loglik)
+    return np.where(np.isfinite(alt_loglik), logLR, -np.inf)
+
+
+def _first_true(predicate, lo, hi, guess):
+    """
+    For each cell, the smallest integer x in [lo, hi] at which
+    predicate(x, cells) is true, or hi + 1 if there is none, where the
+    predicate is increasing in x. The search gallops from the guess until
+    the answer is bracketed, and then bisects, for all cells at once.
+    predicate(x, cells) evaluates the predicate at x[i] for cell cells[i].
+    """
+    guess = np.clip(guess, lo, hi + 1)
+    value = np.ones(len(guess), dtype=bool)
+    cells = np.flatnonzero(guess <= hi)
+    value[cells] = predicate(guess[cells], cells)
+    # the answer is in (bad, good]
+    good = np.where(value, guess, hi + 1)
+    bad = np.where(value, lo - 1, guess)
+    down = value
+    step = np.ones(len(guess), dtype=int)
+    cells = np.flatnonzero(np.where(down, good > lo, bad < hi))
+    while len(cells) > 0:
+        x = np.where(down[cells], good[cells] - step[cells], \
+                     bad[cells] + step[cells])
+        x = np.clip(x, lo[cells], hi[cells])
+        value = predicate(x, cells)
+        good[cells] = np.where(value, x, good[cells])
+        bad[cells] = np.where(value, bad[cells], x)
+        step[cells] *= 2
+        # keep galloping while the predicate does not change
+        moving = np.where(down[cells], value & (x > lo[cells]), \
+                          ~value & (x < hi[cells]))
+        cells = cells[moving]
+    cells = np.flatnonzero(good - bad > 1)
+    while len(cells) > 0:
+        x = (good[cells] + bad[cells])//2
+        value = predicate(x, cells)
+        good[cells] = np.where(value, x, good[cells])
+        bad[cells] = np.where(value, bad[cells], x)
+        cells = cells[good[cells] - bad[cells] > 1]
+    return good
+
+
+def _extrapolate_rows(table, start, before, n, Ln, valid):
+    """
+    Linear extrapolation of table[n, Ln] from the rows start and before of
+    the table, where valid[Ln] in both; otherwise the value in row start.
+    The table may be a dict holding only those rows.
+    """
+    last = table[start][np.minimum(Ln, start)]
+    earlier = table[before][np.minimum(Ln, before)]
+    slope = (last - earlier)/max(start - before, 1)
+    extrapolate = valid[np.minimum(Ln, start)] & (Ln <= before)
+    return np.where(extrapolate, np.round(last + (n - start)*slope), \
+                    last).astype(int)
+
+
+def _boundary_row(n):
+    """
+    Index of the entry (n, 0) in the rows of a boundary table, which holds
+    the entries (n, Ln) for Ln = 0, ..., n one row after another.
+    """
+    return n*(n + 1)//2
+
+
+def sprt_boundary_table(popsize, alpha, Vw, Vl, max_n, null_margin=0,
+                        block_rows=32):
+    """
+    Compute the rejection region of `ballot_polling_sprt` for all samples
+    of up to max_n ballots, so that the test is a table lookup (see
+    `sprt_boundary_rejects`) and the table is a stopping chart.
+
+    For each sample size n and number Ln of ballots for l, the SPRT rejects
+    for the numbers Wn of ballots for w in an interval [lower, upper]. It
+    is not a threshold, because maximizing over the nuisance parameter
+    makes a sample without other ballots weak evidence: e.g. a sample of
+    only w ballots is as likely under the null with Nw = popsize/2 and no
+    invalid ballots as under the alternative Vw = popsize/2.
+
+    The likelihood ratio is assumed to be unimodal in Wn. Its peak and the
+    two ends of the interval are found for a block of rows at a time,
+    starting from those of the last row computed, by galloping and bisection
+    over all cells at once.
+
+    Parameters
+    ----------
+    popsize : int
+        total size of population being audited
+    alpha : float
+        desired type 1 error rate
+    Vw : int
+        total number of votes for w under the alternative hypothesis
+    Vl : int
+        total number of votes for l under the alternative hypothesis
+    max_n : int
+        largest sample size in the table
+    null_margin : int
+        vote margin between w and l under the null hypothesis; optional
+        (default 0)
+    block_rows : int
+        number of sample sizes computed together. Default is 32.
+    Returns
+    -------
+    dict : 'lower' and 'upper', the ends of the interval of Wn that reject
+    (lower > upper if there is none) for each (n, Ln) with Ln <= n, stored
+    row after row in integer arrays of (max_n+1)(max_n+2)/2 entries (int16
+    unless max_n is too large for it), and 'max_n' and the parameters of the
+    test
+    """
+    popsize = int(popsize)
+    Vw = int(Vw)
+    Vl = int(Vl)
+    max_n = min(int(max_n), popsize)
+    threshold = np.log(1/alpha)
+    dtype = np.int16 if max_n < np.iinfo(np.int16).max else np.int32
+    lower = np.full(_boundary_row(max_n + 1), 1, dtype=dtype)
+    upper = np.full(_boundary_row(max_n + 1), 0, dtype=dtype)
+    row = lambda table, n: table[_boundary_row(n):_boundary_row(n + 1)]
+    # the peaks of the last row of the two previous blocks, which are all
+    # the guesses need
+    peak = {0 : np.zeros(1, dtype=int)}
+
+    (start, before) = (0, 0)
+    while start < max_n:
+        # the cells (n, Ln) of the next block of rows
+        rows = min(block_rows, max_n - start)
+        sizes = start + 1 + np.arange(rows)
+        n = np.repeat(sizes, sizes + 1)
+        Ln = np.arange(len(n)) - np.repeat(np.cumsum(sizes + 1) - (sizes + 1), \
+                                           sizes + 1)
+        top = n - Ln
+        zero = np.zeros(len(n), dtype=int)
+        logLR = lambda Wn, cells: _sprt_log_likelihood_ratios(Wn*1., \
+                    Ln[cells]*1., (n[cells] - Wn - Ln[cells])*1., popsize, \
+                    Vw, Vl, null_margin)
+        rejects = lambda Wn, cells: logLR(Wn, cells) >= threshold
+        accepts = lambda Wn, cells: ~rejects(Wn, cells)
+        past_peak = lambda Wn, cells: (Wn + 1 > Vw) | \
+            (logLR(Wn + 1, cells) < logLR(Wn, cells))
+
+        # guesses extrapolated from the last rows of the two previous blocks
+        last_lower = {start : row(lower, start), before : row(lower, before)}
+        last_upper = {start : row(upper, start), before : row(upper, before)}
+        region = last_lower[start] <= last_upper[start]
+        region[:before + 1] &= last_lower[before] <= last_upper[before]
+        guess = _extrapolate_rows(peak, start, before, n, Ln, \
+                                  np.ones(max_n + 1, dtype=bool))
+        block_peak = _first_true(past_peak, zero, top - 1, \
+                                 np.where(Ln <= start, guess, top))
+        cells = np.flatnonzero(rejects(block_peak, np.arange(len(n))))
+        block_lower = top + 1
+        block_upper = top
+        guess = _extrapolate_rows(last_lower, start, before, n, Ln, region)
+        block_lower[cells] = _first_true(lambda Wn, c: rejects(Wn, cells[c]), \
+            zero[cells], block_peak[cells], guess[cells])
+        guess = _extrapolate_rows(last_upper, start, before, n, Ln, region)
+        block_upper[cells] = _first_true(lambda Wn, c: accepts(Wn, cells[c]), \
+            block_peak[cells], top[cells], guess[cells] + 1) - 1
+        # the cells of the block are the rows start+1, ..., start+rows
+        cells = slice(_boundary_row(start + 1), _boundary_row(start + rows + 1))
+        lower[cells] = block_lower
+        upper[cells] = block_upper
+        peak = {start : peak[start],
+                start + rows : block_peak[-(start + rows + 1):]}
+        (start, before) = (start + rows, start)
+    return {'lower' : lower,
+            'upper' : upper,
+            'max_n' : max_n,
+            'popsize' : popsize,
+            'Vw' : Vw,
+            'Vl' : Vl,
+            'alpha' : alpha,
+            'null_margin' : null_margin
+            }
+
+
+def sprt_boundary_rejects(table, Wn, Ln, Un):
+    """
+    Whether the SPRT rejects the null for samples with the given counts,
+    looked up in a table from `sprt_boundary_table`. The counts are
+    broadcast against each other.
+
+    Parameters
+    ----------
+    table : dict
+        rejection region, as returned by `sprt_boundary_table`
+    Wn : array-like
+        number of ballots for w in the sample
+    Ln : array-like
+        number of ballots for l in the sample
+    Un : array-like
+        number of other ballots in the sample
+    Returns
+    -------
+    boolean numpy array
+    """
+    (Wn, Ln, Un) = np.broadcast_arrays(np.asarray(Wn, dtype=int), \
+                       np.asarray(Ln, dtype=int), np.asarray(Un, dtype=int))
+    n = Wn + Ln + Un
+    assert np.all(n <= table['max_n']), "Sample size is larger than the table"
+    cell = _boundary_row(n) + Ln
+    return (Wn >= table['lower'][cell]) & (Wn <= table['upper'][cell])
+
+
+def save_sprt_boundary_table(table, filename):
+    """
+    Save a table from `sprt_boundary_table` to a .npz file.
+    """
+    np.savez_compressed(filename, **table)
+
+
+def load_sprt_boundary_table(filename):
+    """
+    Load a table saved by `save_sprt_boundary_table`.
+    """
+    with np.load(filename) as data:
+        table = dict((k, data[k]) for k in data.files)
+    for k in ('max_n', 'popsize', 'Vw', 'Vl', 'alpha', 'null_margin'):
+        table[k] = table[k].item()
+    return table
+
+
+def ballot_polling_sprt_power(N_w, N_l, N, Vw, Vl, n, alpha, null_margin=0,
+                              replace=False, tol=1e-12):
+    """
+    Exact power of `ballot_polling_sprt` for a sample of n ballots, the
+    probability that the SPRT rejects the null, when the population has N_w
+    votes for w and N_l votes for l.
+
+    The counts (Wn, Ln, Un) of the sample are tri-hypergeometric (or
+    multinomial, with replacement). The SPRT is evaluated at once for all
+    counts with probability above tol, and the power is the total
+    probability of those that reject; the error is at most
+    (n+1)(n+2)/2 * tol. Counts that are impossible under the alternative do
+    not reject.
+
+    Parameters
+    ----------
+    N_w : int
+        true number of votes for w in the population
+    N_l : int
+        true number of votes for l in the population
+    N : int
+        total size of population being audited
+    Vw : int
+        total number of votes for w under the alternative hypothesis
+    Vl : int
+        total number of votes for l under the alternative hypothesis
+    n : int
+        number of ballots in the sample
+    alpha : float
+        desired type 1 error rate
+    null_margin : int
+        vote margin between w and l under the null hypothesis; optional
+        (default 0)
+    replace : bool
+        is the sample drawn with replacement? Default is False
+    tol : float
+        smallest probability of a sample that is evaluated. Default is 1e-12
+    Returns
+    -------
+    float : probability that the SPRT rejects
+    """
+    (Wn, Ln) = _polling_sample_grid(n)
+    prob = np.exp(polling_sample_logpmf(Wn, Ln, n, N_w, N_l, N, \
+                                        replace=replace))
+    keep = prob > tol
+    (Wn, Ln, prob) = (Wn[keep]*1., Ln[keep]*1., prob[keep])
+    logLR = _sprt_log_likelihood_ratios(Wn, Ln, n - Wn - Ln, N, int(Vw), \
+                                        int(Vl), null_margin)
+    with np.errstate(over='ignore'):
+        reject = np.exp(logLR) >= 1/alpha
+    return np.sum(prob[reject])
+
+
 ###################### Unit tests ############################
 
 def test_sprt_functionality():
@@ -239,7 +981,125 @@ def test_sprt_analytic_example():
     np.testing.assert_almost_equal(res2['Nu_used'], 0, decimal=2)
 
 
+def test_sprt_pvalues_vectorized():
+    np.random.seed(20180514)
+    popsize = 10000
+    Vw, Vl = 4800, 4200
+    for n in [0, 5, 50, 500]:
+        for rep in range(5):
+            (Wn, Ln, Un) = np.random.multinomial(n, [0.48, 0.42, 0.10])
+            sample = np.array([1]*Wn + [0]*Ln + [np.nan]*Un)
+            null_margins = np.linspace(-2000, 2500, 25)
+            vec = ballot_polling_sprt_pvalues(Wn, Ln, Un, popsize, Vw, Vl,
+                                              null_margins)
+            for c, p in zip(null_margins, vec):
+                if n == 0:
+                    continue
+                expected = ballot_polling_sprt(sample, popsize, 0.05, Vw, Vl,
+                                               null_margin=c)['pvalue']
+                np.testing.assert_allclose(p, expected, rtol=1e-9, atol=1e-300)
+    # broadcasting across samples
+    res = ballot_polling_sprt_pvalues([2, 1], [1, 2], [1, 1], 10, 5, 4, [0, 0])
+    np.testing.assert_almost_equal(res[0], ballot_polling_sprt(
+        np.array([1, 1, 0, np.nan]), 10, 0.05, 5, 4)['pvalue'])
+    np.testing.assert_almost_equal(res[1], ballot_polling_sprt(
+        np.array([1, 0, 0, np.nan]), 10, 0.05, 5, 4)['pvalue'])
+
+
+def test_sprt_batch():
+    np.random.seed(20180515)
+    counts = np.random.multinomial(200, [0.5, 0.4, 0.1], size=30)
+    (Wn, Ln, Un) = counts.T
+    for kwargs in [{}, {'null_margin' : 50}, {'number_invalid' : 1000}]:
+        res = ballot_polling_sprt_batch(Wn, Ln, Un, 10000, 0.05, 5000, 4000,
+                                        **kwargs)
+        for i in range(len(Wn)):
+            sample = np.array([1]*Wn[i] + [0]*Ln[i] + [np.nan]*Un[i])
+            expected = ballot_polling_sprt(sample, 10000, 0.05, 5000, 4000,
+                                           **kwargs)
+            np.testing.assert_allclose(res['pvalue'][i], expected['pvalue'],
+                                       rtol=1e-9)
+            np.testing.assert_allclose(res['Nw_used'][i], expected['Nw_used'],
+                                       rtol=1e-9)
+            if expected['decision'] == 'None':
+                assert np.isnan(res['decision'][i])
+            else:
+                assert res['decision'][i] == expected['decision']
+    assert np.nansum(res['decision']) > 0
+
+
+def test_sprt_boundary_table():
+    import os
+    import shutil
+    import tempfile
+    table = sprt_boundary_table(1000, 0.05, 500, 400, 60)
+    assert table['lower'].shape == (61*62//2,)
+    assert table['lower'].dtype == np.int16
+    for n in [25, 60]:
+        for Ln in range(0, n + 1, 4):
+            for Wn in range(n - Ln + 1):
+                Un = n - Wn - Ln
+                if Un > 100:
+                    continue
+                sample = np.array([1]*Wn + [0]*Ln + [np.nan]*Un)
+                res = ballot_polling_sprt(sample, 1000, 0.05, 500, 400)
+                assert sprt_boundary_rejects(table, Wn, Ln, Un) == \
+                       (res['decision'] == 1)
+    # a sample of only w ballots is weak evidence
+    assert not sprt_boundary_rejects(table, 40, 0, 0)
+    assert sprt_boundary_rejects(table, 36, 0, 4)
+
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, 'boundary.npz')
+        save_sprt_boundary_table(table, filename)
+        loaded = load_sprt_boundary_table(filename)
+        np.testing.assert_array_equal(loaded['lower'], table['lower'])
+        np.testing.assert_array_equal(loaded['upper'], table['upper'])
+        assert loaded['Vw'] == 500 and loaded['alpha'] == 0.05
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_sprt_power():
+    from hypergeometric import trihypergeometric_pmf
+    (N_w, N_l, N, n) = (60, 30, 100, 20)
+    expected = 0
+    for Wn in range(n + 1):
+        for Ln in range(n + 1 - Wn):
+            if Ln > N_l or n - Wn - Ln > N - N_w - N_l:
+                continue
+            sample = np.array([1]*Wn + [0]*Ln + [np.nan]*(n - Wn - Ln))
+            if ballot_polling_sprt(sample, N, 0.1, 60, 30)['decision'] == 1:
+                expected += trihypergeometric_pmf(Wn, Ln, n, N_w, N_l, N)
+    assert expected > 0
+    np.testing.assert_almost_equal(ballot_polling_sprt_power(N_w, N_l, N, \
+                                   60, 30, n, 0.1, tol=0), expected)
+
+
+def test_simulate_sprt_stopping_times():
+    # a population of only w ballots gives the same path in every rep
+    res = simulate_sprt_stopping_times(100, 100, 0, 70, 30, reps=20, seed=1)
+    n = 1
+    while ballot_polling_sprt(np.ones(n), 100, 0.05, 70, 30)['pvalue'] > 0.05:
+        n += 1
+    assert np.all(res['stopping_times'] == n)
+    assert res['asn'] == n and res['rejection_rate'] == 1
+    # the type I error rate is controlled
+    res = simulate_sprt_stopping_times(1000, 450, 450, 500, 400, reps=2000, \
+                                       seed=2)
+    assert res['rejection_rate'] <= 0.065
+    assert res['quantiles'][0.5] == np.inf
+    res2 = simulate_sprt_stopping_times(1000, 450, 450, 500, 400, \
+                                        reps=2000, chunk=7, seed=2)
+    assert res2['rejection_rate'] <= 0.065
+
 
 if __name__ == 'main':
     test_sprt_functionality()
-    test_sprt_analytic_example()
\ No newline at end of file
+    test_sprt_analytic_example()
+    test_sprt_pvalues_vectorized()
+    test_sprt_batch()
+    test_sprt_boundary_table()
+    test_sprt_power()
+    test_simulate_sprt_stopping_times()
@@ -0,0 +1,199 @@
+from __future__ import print_function, division
+
+from collections import OrderedDict
+from itertools import product
+import numpy as np
+
+from ballot_comparison import ballot_comparison_pvalue
+from fishers_combination import maximize_fisher_combined_pvalue_batch, \
+    unique_rows
+from sprt import ballot_polling_sprt_pvalues
+from suite_tools import find_winners_losers, check_valid_vote_counts
+
+################################################################################
+############################ Statewide risk table ##############################
+################################################################################
+
+# Columns of the table of hypotheses. Rows with equal values in all of them
+# have equal risks, and are only evaluated once.
+_PAIR_COLUMNS = ('N_w1', 'N_l1', 'N1', 'N_w2', 'N_l2', 'N2', \
+                 'n1', 'o1', 'o2', 'u1', 'u2', 'n2', 'n_w2', 'n_l2')
+
+
+def _contest_pair_rows(contest):
+    """
+    The (winner, loser) pairs of a contest and a row of `_PAIR_COLUMNS`
+    for each of them.
+    """
+    candidates = OrderedDict((k, list(v[0:2])) for k, v in \
+                             contest['candidates'].items())
+    check_valid_vote_counts(candidates, contest['stratum_sizes'])
+    (candidates, margins, winners, losers) = \
+        find_winners_losers(candidates, contest['num_winners'])
+    (N1, N2) = contest['stratum_sizes']
+    observed_poll = contest.get('observed_poll', {})
+    pairs = list(product(winners, losers))
+    rows = []
+    for (w, l) in pairs:
+        rows.append([candidates[w][0], candidates[l][0], N1, \
+                     candidates[w][1], candidates[l][1], N2, \
+                     contest.get('n1', 0), contest.get('o1', 0), \
+                     contest.get('o2', 0), contest.get('u1', 0), \
+                     contest.get('u2', 0), contest.get('n2', 0), \
+                     observed_poll.get(w, 0), observed_poll.get(l, 0)])
+    return (pairs, rows)
+
+
+def _pair_risks(table, risk_limit, gamma, stepsize):
+    """
+    Risks for the distinct rows of the table of hypotheses.
+    """
+    cols = dict((name, table[:, i]) for i, name in enumerate(_PAIR_COLUMNS))
+    V = (cols['N_w1'] + cols['N_w2']) - (cols['N_l1'] + cols['N_l2'])
+    risks = np.empty(len(table))
+
+    # A contest entirely in the CVR stratum is a ballot-level comparison
+    # audit with all of the margin in that stratum
+    cvr_only = cols['N2'] == 0
+    risks[cvr_only] = np.where(cols['n1'][cvr_only] == 0, 1.0, \
+        ballot_comparison_pvalue(n=cols['n1'][cvr_only], gamma=gamma, \
+                                 o1=cols['o1'][cvr_only], \
+                                 u1=cols['u1'][cvr_only], \
+                                 o2=cols['o2'][cvr_only], \
+                                 u2=cols['u2'][cvr_only], \
+                                 reported_margin=V[cvr_only], \
+                                 N=cols['N1'][cvr_only], null_lambda=1))
+
+    # A contest entirely in the no-CVR stratum is a ballot-polling audit
+    # of the null that the winner and loser are tied
+    polling_only = (cols['N1'] == 0) & ~cvr_only
+    r = polling_only & (cols['n2'] > 0)
+    risks[polling_only] = 1.0
+    risks[r] = ballot_polling_sprt_pvalues(cols['n_w2'][r], cols['n_l2'][r], \
+                   cols['n2'][r] - cols['n_w2'][r] - cols['n_l2'][r], \
+                   cols['N2'][r], cols['N_w2'][r], cols['N_l2'][r], 0)
+
+    both = ~cvr_only & ~polling_only
+    if np.any(both):
+        res = maximize_fisher_combined_pvalue_batch(\
+                  *[cols[name][both] for name in _PAIR_COLUMNS], \
+                  gamma=gamma, stepsize=stepsize, alpha=risk_limit)
+        risks[both] = res['max_pvalue']
+    return risks
+
+
+def risk_table(contests, risk_limit=0.05, gamma=1.03905, stepsize=0.05):
+    """
+    Use SUITE to calculate the risk of every (winner, loser) pair of many
+    contests audited with one shared stratified sample.
+
+    Each contest has its own stratum sizes, reported votes and sample counts,
+    since contests are on different subsets of the ballots. The hypotheses
+    of all contests are pooled into one table, pairs with identical
+    parameters (in different contests, or tied candidates) are evaluated
+    once, and all the Fisher combinations are maximized together by
+    `maximize_fisher_combined_pvalue_batch`. A contest contained in a single
+    stratum is audited with that stratum's P-value alone.
+
+    Parameters
+    ----------
+    contests : dict
+        keys are contest names, values are dicts with
+
+        candidates : dict
+            keys are the candidate names, values are a list with
+            [reported votes in CVR stratum, reported votes in no-CVR stratum]
+        num_winners : int
+            number of winners in the contest
+        stratum_sizes : list
+            total number of ballots containing the contest in the CVR and
+            no-CVR strata
+        n1, n2 : int
+            sample sizes of ballots containing the contest in the CVR and
+            no-CVR strata. Optional, default 0.
+        o1, o2, u1, u2 : int
+            observed discrepancies for the contest in the CVR sample, as in
+            `suite_tools.audit_contest`. Optional, default 0.
+        observed_poll : dict
+            candidate names as keys and number of votes in the no-CVR sample
+            as values. Optional if n2 is 0.
+    risk_limit : float
+        risk limit. Default is 0.05.
+    gamma : float
+        gamma from Lindeman and Stark (2012). Default is 1.03905.
+    stepsize : float
+        stepsize for the discrete bounds on Fisher's combining function.
+        Default is 0.05.
+    Returns
+    -------
+    OrderedDict : for each contest, a dict with the attained risk of each
+    (winner, loser) pair, as returned by `suite_tools.audit_contest`
+    """
+    contest_pairs = OrderedDict()
+    rows = []
+    for name, contest in contests.items():
+        (pairs, pair_rows) = _contest_pair_rows(contest)
+        contest_pairs[name] = (len(rows), pairs)
+        rows.extend(pair_rows)
+    table = np.array(rows, dtype=float).reshape(-1, len(_PAIR_COLUMNS))
+
+    (distinct, index) = unique_rows(table)
+    risks = _pair_risks(distinct, risk_limit, gamma, stepsize)[index]
+
+    results = OrderedDict()
+    for name, (start, pairs) in contest_pairs.items():
+        results[name] = OrderedDict((k, risks[start + i]) for i, k in \
+                                    enumerate(pairs))
+    return results
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_risk_table():
+    from suite_tools import audit_contest
+    contests = OrderedDict()
+    contests['governor'] = {'candidates' : {'a' : [5000, 600], \
+                                            'b' : [3500, 500], \
+                                            'c' : [500, 100]},
+                            'num_winners' : 1,
+                            'stratum_sizes' : [10000, 1300],
+                            'n1' : 400, 'n2' : 150,
+                            'o1' : 1, 'u1' : 1,
+                            'observed_poll' : {'a' : 70, 'b' : 60, 'c' : 10}}
+    # same votes and sample as the governor's race: evaluated once
+    contests['treasurer'] = dict(contests['governor'])
+    contests['county'] = {'candidates' : {'x' : [2000, 0], 'y' : [1500, 0]},
+                          'num_winners' : 1,
+                          'stratum_sizes' : [4000, 0],
+                          'n1' : 100}
+    contests['district'] = {'candidates' : {'x' : [0, 500], 'y' : [0, 300]},
+                            'num_winners' : 1,
+                            'stratum_sizes' : [0, 900],
+                            'n2' : 100,
+                            'observed_poll' : {'x' : 60, 'y' : 35}}
+    res = risk_table(contests)
+    assert list(res.keys()) == list(contests.keys())
+
+    g = contests['governor']
+    (candidates, margins, winners, losers) = \
+        find_winners_losers(dict((k, list(v)) for k, v in \
+                                 g['candidates'].items()), 1)
+    expected = audit_contest(candidates, winners, losers, g['stratum_sizes'], \
+                             g['n1'], g['n2'], 1, 0, 1, 0, \
+                             g['observed_poll'], 0.05, 1.03905, 0.05)
+    for k in expected.keys():
+        np.testing.assert_allclose(res['governor'][k], expected[k], rtol=1e-8)
+        assert res['treasurer'][k] == res['governor'][k]
+
+    np.testing.assert_almost_equal(res['county'][('x', 'y')], \
+        ballot_comparison_pvalue(100, 1.03905, 0, 0, 0, 0, 500, 4000))
+    sample = np.array([1]*60 + [0]*35 + [np.nan]*5)
+    from sprt import ballot_polling_sprt
+    np.testing.assert_almost_equal(res['district'][('x', 'y')], \
+        ballot_polling_sprt(sample, 900, 0.05, 500, 300)['pvalue'])
+
+
+if __name__ == "__main__":
+    test_risk_table()
@@ -3,12 +3,23 @@ from __future__ import print_function, division
 from collections import OrderedDict
 from itertools import product
 import math
+import multiprocessing
 import numpy as np
 import json
 
-from ballot_comparison import ballot_comparison_pvalue
-from fishers_combination import  maximize_fisher_combined_pvalue, create_modulus
+import scipy as sp
+
+from ballot_comparison import ballot_comparison_pvalue, \
+    findNmin_ballot_comparison_rates
+from fishers_combination import  maximize_fisher_combined_pvalue, \
+    maximize_fisher_combined_pvalue_batch, create_modulus, \
+    calculate_lambda_range, _chi2_ppf
 from sprt import ballot_polling_sprt
+import instrumentation
+import logfactorial
+import plan_cache
+import pvalue_cache
+from pvalue_cache import sample_counts, ballot_polling_sprt_pvalue
 
 
 ################################################################################
@@ -159,6 +170,52 @@ def find_winners_losers(candidates, num_winners):
     return (candidates, margins, winners, losers)
 
 
+def find_dominating_pair(pair, candidates, evaluated, observed_poll=None):
+    """
+    Find a pair whose risk is provably at least as large as the risk of `pair`.
+
+    Write e for the overstatement (in votes) allocated to the CVR stratum
+    and V1 for the reported margin of a pair in the CVR stratum.
+    The CVR stratum P-value depends on the pair only through e, and it is
+    nonincreasing in e. The no-CVR stratum P-value depends on the pair
+    through the reported and sampled no-CVR votes of w and l and the null
+    margin e - V1. The feasible range of e - V1 does not depend on the pair.
+    Hence if pairs P and Q have identical reported and sampled no-CVR votes
+    and V1(Q) >= V1(P), the maximum combined P-value for Q is at most the
+    maximum for P, for every sample size and every value of the CVR stratum
+    discrepancy counts.
+
+    Parameters
+    ----------
+    pair : tuple
+        (winner, loser) pair to bound
+    candidates : dict
+        OrderedDict with candidate names as keys and
+        [CVR votes, no-CVR votes, total votes] as values
+    evaluated : list
+        (winner, loser) pairs that may be used to bound `pair`
+    observed_poll : dict
+        Optional, number of votes for each candidate in the no-CVR
+        stratum sample. If None, only the reported votes are compared,
+        as when planning the sample size.
+    Returns
+    -------
+    tuple : the first pair in `evaluated` that dominates `pair`, or None
+    """
+    def poll_data(k):
+        data = (candidates[k[0]][1], candidates[k[1]][1])
+        if observed_poll is not None:
+            data += (observed_poll[k[0]], observed_poll[k[1]])
+        return data
+
+    margin1 = candidates[pair[0]][0] - candidates[pair[1]][0]
+    for k in evaluated:
+        if poll_data(k) == poll_data(pair) and \
+           candidates[k[0]][0] - candidates[k[1]][0] <= margin1:
+            return k
+    return None
+
+
 def print_reported_votes(candidates, winners, losers, margins, stratum_sizes,
                          print_alphabetical=False):
     """
@@ -230,6 +287,8 @@ def print_reported_votes(candidates, winners, losers, margins, stratum_sizes,
 ################################################################################
 
 
+@instrumentation.timed('estimate_n')
+@plan_cache.cached_plan('estimate_n')
 def estimate_n(N_w1, N_w2, N_l1, N_l2, N1, N2,\
                o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0,\
                n_ratio=None,
@@ -238,7 +297,9 @@ def estimate_n(N_w1, N_w2, N_l1, N_l2, N1, N2,\
                stepsize=0.05,\
                min_n=5,\
                risk_limit_tol=0.8,
-               verbose=False):
+               verbose=False,
+               method='bisection',
+               cache=None):
     """
     Estimate the initial sample sizes for the audit.
 
@@ -286,6 +347,16 @@ def estimate_n(N_w1, N_w2, N_l1, N_l2, N1, N2,\
     verbose : bool
         If True, print the sample size and expected p-value at each search step.
         Defaults to False.
+    method : str
+        'bisection' (default) doubles n from min_n until the expected P-value
+        is below the risk limit, then bisects. 'secant' starts from the guess
+        of `guess_initial_n` and uses secant steps on the log of the expected
+        P-value, which decreases in n; it usually needs far fewer
+        maximizations of the combined P-value.
+    cache : plan_cache.PlanCache
+        persistent cache of sample sizes and expected P-values. If given,
+        the sample sizes are looked up there first, and the expected
+        P-values of the search are reused and stored. Default None.
     Returns
     -------
     tuple : estimated initial sample sizes in the CVR stratum and no-CVR stratum
@@ -295,85 +366,255 @@ def estimate_n(N_w1, N_w2, N_l1, N_l2, N1, N2,\
     assert n > 0, "minimum sample size must be positive"
     assert risk_limit_tol < 1 and risk_limit_tol > 0, "bad risk limit tolerance"
 
-    reported_margin = (N_w1+N_w2)-(N_l1+N_l2)
     expected_pvalue = 1
 
     def try_n(n):
         """
         Find expected combined P-value for a total sample size n.
         """
-        n1 = math.ceil(n_ratio * n)
-        n2 = int(n - n1)
-
-        # Set up the p-value function for the CVR stratum
-        if n1 == 0:
-            cvr_pvalue = lambda alloc: 1
-        else:
-            o1 = math.ceil(o1_rate*n1)
-            o2 = math.ceil(o2_rate*n1)
-            u1 = math.floor(u1_rate*n1)
-            u2 = math.floor(u2_rate*n1)
-            cvr_pvalue = lambda alloc: ballot_comparison_pvalue(n=n1, \
-                            gamma=gamma, o1=o1, u1=u1, o2=o2, u2=u2, \
-                            reported_margin=reported_margin, N=N1, \
-                            null_lambda=alloc)
-
-        # Set up the p-value function for the no-CVR stratum
-        if n2 == 0:
-            nocvr_pvalue = lambda alloc: 1
+        compute = lambda: expected_initial_pvalue(n, N_w1, N_w2, N_l1, N_l2, \
+                              N1, N2, o1_rate, o2_rate, u1_rate, u2_rate, \
+                              n_ratio, risk_limit, gamma, stepsize)
+        if cache is None:
+            expected_pvalue = compute()
         else:
-            sample = [0]*int(n2*N_l2/N2)+[1]*int(n2*N_w2/N2)+ \
-                        [np.nan]*int(n2*(N2-N_l2-N_w2)/N2)
-            if len(sample) < n2:
-                sample += [np.nan]*(n2 - len(sample))
-            nocvr_pvalue = lambda alloc: ballot_polling_sprt(sample=np.array(sample), \
-                            popsize=N2, \
-                            alpha=risk_limit,\
-                            Vw=N_w2, Vl=N_l2, \
-                            null_margin=(N_w2-N_l2) - \
-                             alloc*reported_margin)['pvalue']
-
-        bounding_fun = create_modulus(n1=n1, n2=n2,
-                                      n_w2=int(n2*N_w2/N2), \
-                                      n_l2=int(n2*N_l2/N2), \
-                                      N1=N1, V_wl=reported_margin, gamma=gamma)
-        res = maximize_fisher_combined_pvalue(N_w1=N_w1, N_l1=N_l1, N1=N1, \
-                                              N_w2=N_w2, N_l2=N_l2, N2=N2, \
-                                              pvalue_funs=(cvr_pvalue, \
-                                               nocvr_pvalue), \
-                                              stepsize=stepsize, \
-                                              modulus=bounding_fun, \
-                                              alpha=risk_limit)
-        expected_pvalue = res['max_pvalue']
+            inputs = dict(n=int(n), N_w1=N_w1, N_w2=N_w2, N_l1=N_l1, N_l2=N_l2, \
+                          N1=N1, N2=N2, o1_rate=o1_rate, o2_rate=o2_rate, \
+                          u1_rate=u1_rate, u2_rate=u2_rate, n_ratio=n_ratio, \
+                          risk_limit=risk_limit, gamma=gamma, \
+                          stepsize=stepsize)
+            expected_pvalue = cache.memoize('estimate_n.try_n', inputs, compute)
         if verbose:
             print('...trying...', n, expected_pvalue)
         return expected_pvalue
 
+    if method == 'secant':
+        n_guess = guess_initial_n(N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                                  o1_rate, o2_rate, u1_rate, u2_rate, \
+                                  n_ratio, risk_limit, gamma)
+        with instrumentation.stage('estimate_n.secant'):
+            high_n = _secant_search_n(try_n, max(n_guess, 2*min_n), \
+                                      risk_limit, risk_limit_tol, max_n=N1+N2)
+        n1 = math.ceil(n_ratio * high_n)
+        n2 = math.ceil(high_n - n1)
+        return (n1, n2)
+    assert method == 'bisection', "unknown search method"
+
     # step 1: linear search, doubling n each time
-    while (expected_pvalue > risk_limit) or (expected_pvalue is np.nan):
-        n = 2*n
-        expected_pvalue = try_n(n)
+    with instrumentation.stage('estimate_n.doubling'):
+        while (expected_pvalue > risk_limit) or (expected_pvalue is np.nan):
+            n = 2*n
+            expected_pvalue = try_n(n)
 
     # step 2: bisection between n/2 and n
-    low_n = n/2
-    high_n = n
-    mid_pvalue = 1
-    while  (mid_pvalue > risk_limit) or (mid_pvalue < risk_limit_tol*risk_limit) or \
-        (expected_pvalue is np.nan):
-        mid_n = np.floor((low_n+high_n)/2)
-        if (low_n == mid_n) or (high_n == mid_n):
-            break
-        mid_pvalue = try_n(mid_n)
-        if mid_pvalue <= risk_limit:
-            high_n = mid_n
-        else:
-            low_n = mid_n
+    with instrumentation.stage('estimate_n.bisection'):
+        low_n = n/2
+        high_n = n
+        mid_pvalue = 1
+        while  (mid_pvalue > risk_limit) or (mid_pvalue < risk_limit_tol*risk_limit) or \
+            (expected_pvalue is np.nan):
+            mid_n = np.floor((low_n+high_n)/2)
+            if (low_n == mid_n) or (high_n == mid_n):
+                break
+            mid_pvalue = try_n(mid_n)
+            if mid_pvalue <= risk_limit:
+                high_n = mid_n
+            else:
+                low_n = mid_n
     
     n1 = math.ceil(n_ratio * high_n)
     n2 = math.ceil(high_n - n1)
     return (n1, n2)
 
 
+def expected_initial_pvalue(n, N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                            o1_rate, o2_rate, u1_rate, u2_rate, n_ratio, \
+                            risk_limit, gamma, stepsize):
+    """
+    Find the expected combined P-value for a total sample size n, if the
+    discrepancy rates in the CVR stratum are as given and the no-CVR sample
+    has the reported vote shares. This is the objective of `estimate_n`;
+    `n_ratio` must not be None.
+    """
+    reported_margin = (N_w1+N_w2)-(N_l1+N_l2)
+    n1 = math.ceil(n_ratio * n)
+    n2 = int(n - n1)
+
+    # Set up the p-value function for the CVR stratum
+    if n1 == 0:
+        cvr_pvalue = lambda alloc: 1
+    else:
+        o1 = math.ceil(o1_rate*n1)
+        o2 = math.ceil(o2_rate*n1)
+        u1 = math.floor(u1_rate*n1)
+        u2 = math.floor(u2_rate*n1)
+        cvr_pvalue = lambda alloc: pvalue_cache.ballot_comparison_pvalue(\
+                        n=n1, gamma=gamma, o1=o1, u1=u1, o2=o2, u2=u2, \
+                        reported_margin=reported_margin, N=N1, \
+                        null_lambda=alloc)
+
+    # Set up the p-value function for the no-CVR stratum
+    if n2 == 0:
+        nocvr_pvalue = lambda alloc: 1
+    else:
+        sample = [0]*int(n2*N_l2/N2)+[1]*int(n2*N_w2/N2)+ \
+                    [np.nan]*int(n2*(N2-N_l2-N_w2)/N2)
+        if len(sample) < n2:
+            sample += [np.nan]*(n2 - len(sample))
+        counts = sample_counts(sample)
+        nocvr_pvalue = lambda alloc: ballot_polling_sprt_pvalue(*counts, \
+                        popsize=N2, \
+                        Vw=N_w2, Vl=N_l2, \
+                        null_margin=(N_w2-N_l2) - \
+                         alloc*reported_margin)
+
+    bounding_fun = create_modulus(n1=n1, n2=n2,
+                                  n_w2=int(n2*N_w2/N2), \
+                                  n_l2=int(n2*N_l2/N2), \
+                                  N1=N1, V_wl=reported_margin, gamma=gamma)
+    res = maximize_fisher_combined_pvalue(N_w1=N_w1, N_l1=N_l1, N1=N1, \
+                                          N_w2=N_w2, N_l2=N_l2, N2=N2, \
+                                          pvalue_funs=(cvr_pvalue, \
+                                           nocvr_pvalue), \
+                                          stepsize=stepsize, \
+                                          modulus=bounding_fun, \
+                                          alpha=risk_limit)
+    return res['max_pvalue']
+
+
+def guess_initial_n(N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                    o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0, \
+                    n_ratio=None, risk_limit=0.05, gamma=1.03905):
+    """
+    Closed-form guess of the total sample size `estimate_n` will find.
+
+    For each allocation lambda of the overstatement, the evidence per
+    ballot against the null is log(1/risk_limit) over the sample size from
+    `findNmin_ballot_comparison_rates` in the CVR stratum, and the expected
+    log likelihood ratio of one draw in the no-CVR stratum (the SPRT
+    analogue). Fisher's combination needs a total log evidence of half the
+    1-risk_limit quantile of chi-squared with 4 degrees of freedom, at
+    the least favorable lambda.
+
+    Parameters
+    ----------
+    as in `estimate_n`
+    Returns
+    -------
+    int : guessed total sample size, or 0 if the expected evidence does not
+    grow with the sample size
+    """
+    n_ratio = n_ratio if n_ratio else N1/(N1+N2)
+    reported_margin = (N_w1+N_w2)-(N_l1+N_l2)
+    (lambda_lower, lambda_upper) = calculate_lambda_range(N_w1, N_l1, N1, \
+                                                          N_w2, N_l2, N2)
+    evidence = []
+    for lam in np.linspace(lambda_lower, lambda_upper, 21):
+        rate1 = 0
+        if n_ratio > 0 and N1 > 0 and lam > 0:
+            cvr_n = findNmin_ballot_comparison_rates(alpha=risk_limit, \
+                        gamma=gamma, r1=o1_rate, s1=u1_rate, r2=o2_rate, \
+                        s2=u2_rate, reported_margin=reported_margin, N=N1, \
+                        null_lambda=lam)
+            rate1 = 0 if np.isnan(cvr_n) else -np.log(risk_limit)/cvr_n
+        rate2 = 0
+        if n_ratio < 1 and N2 > 0 and lam < 1:
+            # reported shares, and the shares under the null with
+            # (1-lambda)*margin overstated in the no-CVR stratum
+            p_w = N_w2/N2
+            p_l = N_l2/N2
+            shift = (1-lam)*reported_margin/(2*N2)
+            if p_w - shift <= 0 or p_l + shift >= 1:
+                rate2 = np.inf
+            else:
+                if p_w > 0:
+                    rate2 += p_w*np.log(p_w/(p_w - shift))
+                if p_l > 0:
+                    rate2 += p_l*np.log(p_l/(p_l + shift))
+        evidence.append(n_ratio*rate1 + (1-n_ratio)*rate2)
+    min_evidence = np.min(evidence)
+    if not min_evidence > 0:
+        return 0
+    return int(math.ceil(_chi2_ppf(1-risk_limit, df=4)/2/min_evidence))
+
+
+def _secant_search_n(try_n, n, risk_limit, risk_limit_tol, max_n):
+    """
+    Find a total sample size with expected P-value between
+    risk_limit_tol*risk_limit and risk_limit, starting from n.
+
+    The expected P-value decreases in n, and its log is close to linear in
+    n, so the search takes secant steps on log P-value towards the middle
+    of the acceptable band. Once sizes above and below the risk limit are
+    known, steps are kept inside that bracket (falling back to bisection),
+    so the search ends with the smallest size found whose P-value is at
+    most the risk limit. P-values are memoized by n.
+    """
+    pvalues = {}
+    def log_pvalue(n):
+        if n not in pvalues:
+            pvalue = try_n(n)
+            pvalues[n] = 1 if np.isnan(pvalue) else pvalue
+        else:
+            instrumentation.count('cache_hits:secant_pvalues')
+        return np.log(max(pvalues[n], 1e-300))
+
+    target = np.log(risk_limit) + np.log(risk_limit_tol)/2
+    low_n = None  # largest n with P-value above the risk limit
+    high_n = None # smallest n with P-value at most the risk limit
+    prev_n = None
+    n = int(min(n, max_n))
+    while True:
+        current = log_pvalue(n)
+        if pvalues[n] <= risk_limit:
+            high_n = n if high_n is None else min(high_n, n)
+            if pvalues[n] >= risk_limit_tol*risk_limit:
+                return n
+        else:
+            low_n = n if low_n is None else max(low_n, n)
+            if n >= max_n:
+                return max_n
+        if low_n is not None and high_n is not None and high_n - low_n <= 1:
+            return high_n
+
+        # secant step through the bracket, the last two sizes, or (0, log 1)
+        if low_n is not None and high_n is not None:
+            (n, current) = (high_n, log_pvalue(high_n))
+            slope = (current - log_pvalue(low_n))/(high_n - low_n)
+        elif prev_n is not None and log_pvalue(prev_n) != current:
+            slope = (current - log_pvalue(prev_n))/(n - prev_n)
+        else:
+            slope = current/n
+        if slope < 0 and np.isfinite(slope):
+            new_n = int(round(n + (target - current)/slope))
+        elif pvalues[n] > risk_limit:
+            new_n = 2*n
+        else:
+            new_n = n//2
+
+        # keep the step inside the bracket, and grow/shrink by at most 4x
+        new_n = min(max(new_n, n//4, 1), 4*n, max_n)
+        lower = low_n if low_n is not None else 0
+        upper = high_n if high_n is not None else max_n + 1
+        if low_n is not None and high_n is not None:
+            # safeguard: shrink the bracket by at least a quarter
+            width = high_n - low_n
+            new_n = min(max(new_n, low_n + width//4), high_n - width//4)
+        if not lower < new_n < upper or new_n in pvalues:
+            if high_n is None:
+                new_n = min(max(2*n, lower + 1), max_n)
+            elif low_n is None:
+                new_n = max(high_n//2, 1)
+            else:
+                new_n = (low_n + high_n)//2
+        if new_n in pvalues:
+            return high_n if high_n is not None else max_n
+        prev_n = n
+        n = new_n
+
+
+@instrumentation.timed('estimate_escalation_n')
+@plan_cache.cached_plan('estimate_escalation_n')
 def estimate_escalation_n(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
                           o1_obs, o2_obs, u1_obs, u2_obs, \
                           n2l_obs, n2w_obs, \
@@ -383,7 +624,9 @@ def estimate_escalation_n(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
                           gamma=1.03905,\
                           stepsize=0.05,\
                           risk_limit_tol=0.8,
-                          verbose=False):
+                          verbose=False,
+                          method='bisection',
+                          cache=None):
     """
     Estimate the initial sample sizes for the audit.
 
@@ -435,10 +678,24 @@ def estimate_escalation_n(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
     verbose : bool
         If True, print the sample size and expected p-value at each search step.
         Defaults to False.
+    method : str
+        'bisection' (default) grows n by a factor of 1.1 until the expected
+        P-value is below the risk limit, then bisects. 'curve' returns the
+        smallest size found by `escalation_risk_curve`.
+    cache : plan_cache.PlanCache
+        persistent cache of sample sizes and expected P-values, as in
+        `estimate_n`. Default None.
     Returns
     -------
     tuple : estimated initial sample sizes in the CVR stratum and no-CVR stratum
     """
+    if method == 'curve':
+        return escalation_risk_curve(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
+                   o1_obs, o2_obs, u1_obs, u2_obs, n2l_obs, n2w_obs, \
+                   n_ratio=n_ratio, risk_limit=risk_limit, gamma=gamma, \
+                   stepsize=stepsize)['sample_size']
+    assert method == 'bisection', "unknown search method"
+
     n_ratio = n_ratio if n_ratio else N1/(N1+N2)
     n = n1+n2
     reported_margin = (N_w1+N_w2)-(N_l1+N_l2)
@@ -455,7 +712,7 @@ def estimate_escalation_n(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
     u1_rate = u1_obs/n1_original
     u2_rate = u2_obs/n1_original
 
-    def try_n(n):
+    def compute_pvalue(n):
         n1 = math.ceil(n_ratio * n)
         n2 = int(n - n1)
         
@@ -470,8 +727,8 @@ def estimate_escalation_n(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
             o2 = math.ceil(o2_rate*(n1-n1_original)) + o2_obs
             u1 = math.floor(u1_rate*(n1-n1_original)) + u1_obs
             u2 = math.floor(u2_rate*(n1-n1_original)) + u2_obs
-            cvr_pvalue = lambda alloc: ballot_comparison_pvalue(n=n1,\
-                                gamma=1.03905, o1=o1, \
+            cvr_pvalue = lambda alloc: pvalue_cache.ballot_comparison_pvalue(\
+                                n=n1, gamma=1.03905, o1=o1, \
                                 u1=u1, o2=o2, u2=u2, \
                                 reported_margin=reported_margin, N=N1, \
                                 null_lambda=alloc)
@@ -492,13 +749,12 @@ def estimate_escalation_n(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
             n_w2 = np.sum(totsample == 1)
             n_l2 = np.sum(totsample == 0)
 
-            nocvr_pvalue = lambda alloc: ballot_polling_sprt( \
-                            sample=totsample,\
+            counts = sample_counts(totsample)
+            nocvr_pvalue = lambda alloc: ballot_polling_sprt_pvalue(*counts, \
                             popsize=N2, \
-                            alpha=risk_limit,\
                             Vw=N_w2, Vl=N_l2, \
                             null_margin=(N_w2-N_l2) - \
-                             alloc*reported_margin)['pvalue']
+                             alloc*reported_margin)
 
         # Compute combined p-value
         bounding_fun = create_modulus(n1=n1, n2=n2,
@@ -512,36 +768,272 @@ def estimate_escalation_n(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
                                               stepsize=stepsize, \
                                               modulus=bounding_fun, \
                                               alpha=risk_limit)
-        expected_pvalue = res['max_pvalue']
+        return res['max_pvalue']
+
+    def try_n(n):
+        if cache is None:
+            expected_pvalue = compute_pvalue(n)
+        else:
+            inputs = dict(n=int(n), N_w1=N_w1, N_w2=N_w2, N_l1=N_l1, N_l2=N_l2, \
+                          N1=N1, N2=N2, n1=n1_original, n2=n2_original, \
+                          o1_obs=o1_obs, o2_obs=o2_obs, u1_obs=u1_obs, \
+                          u2_obs=u2_obs, n2l_obs=n2l_obs, n2w_obs=n2w_obs, \
+                          n_ratio=n_ratio, risk_limit=risk_limit, \
+                          gamma=gamma, stepsize=stepsize)
+            expected_pvalue = cache.memoize('estimate_escalation_n.try_n', \
+                                            inputs, lambda: compute_pvalue(n))
         if verbose:
             print('...trying...', n, expected_pvalue)
         return expected_pvalue
 
     # step 1: linear search, increasing n by a factor of 1.1 each time
-    while (expected_pvalue > risk_limit) or (expected_pvalue is np.nan):
-        n = np.ceil(1.1*n)
-        expected_pvalue = try_n(n)
+    with instrumentation.stage('estimate_escalation_n.growth'):
+        while (expected_pvalue > risk_limit) or (expected_pvalue is np.nan):
+            n = np.ceil(1.1*n)
+            expected_pvalue = try_n(n)
 
     # step 2: bisection between n/1.1 and n
-    low_n = n/1.1
-    high_n = n
-    mid_pvalue = 1
-    while  (mid_pvalue > risk_limit) or (mid_pvalue < risk_limit_tol*risk_limit) or \
-        (expected_pvalue is np.nan):
-        mid_n = np.floor((low_n+high_n)/2)
-        if (low_n == mid_n) or (high_n == mid_n):
-            break
-        mid_pvalue = try_n(mid_n)
-        if mid_pvalue <= risk_limit:
-            high_n = mid_n
-        else:
-            low_n = mid_n
+    with instrumentation.stage('estimate_escalation_n.bisection'):
+        low_n = n/1.1
+        high_n = n
+        mid_pvalue = 1
+        while  (mid_pvalue > risk_limit) or (mid_pvalue < risk_limit_tol*risk_limit) or \
+            (expected_pvalue is np.nan):
+            mid_n = np.floor((low_n+high_n)/2)
+            if (low_n == mid_n) or (high_n == mid_n):
+                break
+            mid_pvalue = try_n(mid_n)
+            if mid_pvalue <= risk_limit:
+                high_n = mid_n
+            else:
+                low_n = mid_n
 
     n1 = math.ceil(n_ratio * high_n)
     n2 = math.ceil(high_n - n1)
     return (n1, n2)
 
 
+def expected_escalation_pvalues(n, N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
+                                o1_obs, o2_obs, u1_obs, u2_obs, \
+                                n2l_obs, n2w_obs, n_ratio, \
+                                risk_limit=0.05, gamma=1.03905, stepsize=0.05):
+    """
+    Expected combined P-values after escalating to total sample sizes n,
+    projecting the sample as in `estimate_escalation_n`: discrepancies
+    continue at the observed rates and new no-CVR ballots have the
+    reported vote shares. All arguments except risk_limit, gamma and
+    stepsize are broadcast against each other, so many sizes, pairs or
+    samples are evaluated at once by `maximize_fisher_combined_pvalue_batch`.
+
+    Returns
+    -------
+    array of expected P-values; 1 where n is smaller than the sample already
+    drawn in either stratum, or where the projected no-CVR sample has more
+    votes for a candidate than reported
+    """
+    arrays = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in \
+        (n, N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, o1_obs, o2_obs, u1_obs, \
+         u2_obs, n2l_obs, n2w_obs, n_ratio)])
+    (n, N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, o1_obs, o2_obs, u1_obs, \
+     u2_obs, n2l_obs, n2w_obs, n_ratio) = arrays
+    size1 = np.ceil(n_ratio * n)
+    size2 = np.trunc(n - size1)
+    extra1 = size1 - n1
+    extra2 = size2 - n2
+    # Assume o1, o2, u1, u2 rates will be the same as what we observed in sample
+    rate = lambda obs: np.where(n1 > 0, obs/np.maximum(n1, 1), 0)
+    o1 = np.ceil(rate(o1_obs)*extra1) + o1_obs
+    o2 = np.ceil(rate(o2_obs)*extra1) + o2_obs
+    u1 = np.floor(rate(u1_obs)*extra1) + u1_obs
+    u2 = np.floor(rate(u2_obs)*extra1) + u2_obs
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_l2 = np.where(N2 > 0, np.trunc(extra2*N_l2/N2), 0) + n2l_obs
+        n_w2 = np.where(N2 > 0, np.trunc(extra2*N_w2/N2), 0) + n2w_obs
+    # the SPRT is undefined if the sample has more votes than reported
+    feasible = (extra1 >= 0) & (extra2 >= 0) & (n_w2 <= N_w2) & \
+               (n_l2 <= N_l2) & (size2 - n_w2 - n_l2 <= N2 - N_w2 - N_l2)
+    pvalues = np.ones(n.shape)
+    if np.any(feasible):
+        f = lambda a: a[feasible]
+        pvalues[feasible] = maximize_fisher_combined_pvalue_batch(\
+            f(N_w1), f(N_l1), f(N1), f(N_w2), f(N_l2), f(N2), \
+            f(size1), f(o1), f(o2), f(u1), f(u2), f(size2), f(n_w2), f(n_l2), \
+            gamma=gamma, stepsize=stepsize, alpha=risk_limit)['max_pvalue']
+    return pvalues
+
+
+def escalation_risk_curve(N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, \
+                          o1_obs, o2_obs, u1_obs, u2_obs, \
+                          n2l_obs, n2w_obs, \
+                          n_ratio=None, \
+                          risk_limit=0.05,\
+                          gamma=1.03905,\
+                          stepsize=0.05,\
+                          num=40,\
+                          n_values=None):
+    """
+    Expected risk of the audit as a function of the total sample size
+    after escalation, and the smallest size meeting the risk limit.
+
+    The sample is projected as in `estimate_escalation_n`: discrepancies
+    continue at the observed rates and new no-CVR ballots have the reported
+    vote shares. Only the projected counts are formed, and the expected
+    P-values of all sizes are computed together by
+    `maximize_fisher_combined_pvalue_batch`.
+
+    The first batch is `num` sizes spaced geometrically between the current
+    sample size and a full hand count. Each further batch places `num`
+    sizes in the bracket between the largest size above the risk limit and
+    the smallest size at or below it, until the bracket has width 1.
+
+    Parameters
+    ----------
+    N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, \
+    n2l_obs, n2w_obs, n_ratio, risk_limit, gamma, stepsize :
+        as in `estimate_escalation_n`
+    num : int
+        number of sample sizes evaluated in each batch. Default 40
+    n_values : array-like
+        total sample sizes to evaluate. Optional; if given, only these sizes
+        are evaluated and the bracket is not refined.
+    Returns
+    -------
+    dict with
+
+    n : array
+        total sample sizes evaluated, increasing
+    n1, n2 : array
+        the corresponding sample sizes in the CVR and no-CVR strata
+    expected_pvalue : array
+        expected P-value at each size; 1 for sizes smaller than the sample
+        already drawn in either stratum
+    sample_size : tuple
+        smallest (n1, n2) evaluated with expected P-value at most the risk
+        limit, or (N1, N2) if there is none
+    """
+    n_ratio = n_ratio if n_ratio else N1/(N1+N2)
+    expected_pvalues = lambda n: expected_escalation_pvalues(n, \
+        N_w1, N_w2, N_l1, N_l2, N1, N2, n1, n2, o1_obs, o2_obs, u1_obs, \
+        u2_obs, n2l_obs, n2w_obs, n_ratio, risk_limit, gamma, stepsize)
+
+    max_n = N1 + N2
+    if n_values is None:
+        batch = np.unique(np.round(np.geomspace(max(n1 + n2, 1), max_n, num)))
+    else:
+        batch = np.unique(np.asarray(n_values, dtype=float))
+    curve = {}
+    while len(batch) > 0:
+        curve.update(zip(batch, expected_pvalues(batch)))
+        if n_values is not None:
+            break
+        n = np.array(sorted(curve.keys()))
+        pvalues = np.array([curve[k] for k in n])
+        below = np.flatnonzero(pvalues <= risk_limit)
+        if len(below) == 0 or below[0] == 0:
+            break
+        (low_n, high_n) = (n[below[0]-1], n[below[0]])
+        batch = np.unique(np.round(np.linspace(low_n, high_n, num + 2)))
+        batch = np.array([k for k in batch if k not in curve])
+
+    n = np.array(sorted(curve.keys()))
+    pvalues = np.array([curve[k] for k in n])
+    below = np.flatnonzero(pvalues <= risk_limit)
+    if len(below) > 0:
+        sample_size = (math.ceil(n_ratio * n[below[0]]), \
+                       math.ceil(n[below[0]] - math.ceil(n_ratio * n[below[0]])))
+    else:
+        sample_size = (N1, N2)
+    n1_values = np.ceil(n_ratio * n)
+    return {'n' : n,
+            'n1' : n1_values,
+            'n2' : np.trunc(n - n1_values),
+            'expected_pvalue' : pvalues,
+            'sample_size' : sample_size
+            }
+
+
+def estimate_n_pairs(candidates, margins, stratum_sizes,\
+                     o1_rate=0, o2_rate=0, u1_rate=0, u2_rate=0,\
+                     n_ratio=None,
+                     risk_limit=0.05,\
+                     gamma=1.03905,\
+                     stepsize=0.05,\
+                     min_n=5,\
+                     risk_limit_tol=0.8,
+                     prune=True,
+                     verbose=False,
+                     method='bisection',
+                     cache=None):
+    """
+    Estimate the initial sample sizes for every (winner, loser) pair
+    in a contest, from the smallest margin to the largest.
+
+    With `prune`, a pair is not searched if a pair already searched
+    dominates it (see `find_dominating_pair`): the sample size found
+    for the dominating pair is sufficient for the dominated pair too.
+    Dominated pairs never increase the largest sample size over pairs.
+
+    Parameters
+    ----------
+    candidates : dict
+        OrderedDict with candidate names as keys and
+        [CVR votes, no-CVR votes, total votes] as values
+    margins : dict
+        keys are (reported winner, reported loser), values are the margin
+        in votes between the pair, as returned by `find_winners_losers`
+    stratum_sizes : list
+        list with total number of votes in the CVR and no-CVR strata
+    o1_rate, o2_rate, u1_rate, u2_rate, n_ratio, risk_limit, gamma, \
+    stepsize, min_n, risk_limit_tol, verbose, method, cache :
+        as in `estimate_n`
+    prune : bool
+        skip pairs dominated by a pair already searched? Default True
+    Returns
+    -------
+    dict with
+
+    sample_sizes : dict
+        (n1, n2) for each (winner, loser) pair. For pruned pairs this is
+        the sample size of the dominating pair.
+    computed : list
+        pairs for which `estimate_n` was run, in the order run
+    certified : dict
+        pruned pairs, with the pair that dominates each of them
+    """
+    sample_sizes = {}
+    computed = []
+    certified = OrderedDict()
+    for k in sorted(margins.keys(), key=lambda t: margins[t]):
+        if prune:
+            dominating = find_dominating_pair(k, candidates, computed)
+            if dominating is not None:
+                certified[k] = dominating
+                sample_sizes[k] = sample_sizes[dominating]
+                continue
+        sample_sizes[k] = estimate_n(N_w1=candidates[k[0]][0], \
+                                     N_w2=candidates[k[0]][1], \
+                                     N_l1=candidates[k[1]][0], \
+                                     N_l2=candidates[k[1]][1], \
+                                     N1=stratum_sizes[0], \
+                                     N2=stratum_sizes[1], \
+                                     o1_rate=o1_rate, o2_rate=o2_rate, \
+                                     u1_rate=u1_rate, u2_rate=u2_rate, \
+                                     n_ratio=n_ratio, \
+                                     risk_limit=risk_limit, \
+                                     gamma=gamma, \
+                                     stepsize=stepsize, \
+                                     min_n=min_n, \
+                                     risk_limit_tol=risk_limit_tol, \
+                                     verbose=verbose, \
+                                     method=method, \
+                                     cache=cache)
+        computed.append(k)
+    return {'sample_sizes' : sample_sizes,
+            'computed' : computed,
+            'certified' : certified
+            }
+
+
 ################################################################################
 ########################## Ballot manifest tools ###############################
 ################################################################################
@@ -636,9 +1128,116 @@ def find_ballot(ballot_num, unique_ballot_manifest, parsed_ballot_manifest):
 ############################## Do the audit! ###################################
 ################################################################################
 
+def audit_pair(candidates, winner, loser, stratum_sizes,\
+               n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, observed_poll, \
+               risk_limit, gamma, stepsize, feasible_lambda_range=None, \
+               refine=True, lambda_guess=None):
+    """
+    Use SUITE to calculate the risk for a single (winner, loser) pair
+    given the observed samples in the CVR and no-CVR strata.
+
+    Parameters
+    ----------
+    candidates : dict
+        OrderedDict with candidate names as keys and 
+        [CVR votes, no-CVR votes, total votes] as values
+    winner : str
+        name of the reported winner
+    loser : str
+        name of the reported loser
+    stratum_sizes, n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, observed_poll, \
+    risk_limit, gamma, stepsize :
+        as in `audit_contest`
+    feasible_lambda_range : array-like
+        lower and upper limits to search over lambda. Optional; default is
+        the full range from `calculate_lambda_range`.
+    refine : bool
+        Refine the grid search using the modulus of continuity? Default True.
+        If False, the result is a lower bound on the maximum P-value.
+    lambda_guess : float
+        Optional, a lambda near which the maximum is expected, e.g. the
+        maximizer of the previous round. It saves SPRT evaluations, without
+        changing the result; see `maximize_fisher_combined_pvalue`.
+    Returns
+    -------
+    dict : output of `maximize_fisher_combined_pvalue`
+    """
+    N_w1 = candidates[winner][0]
+    N_w2 = candidates[winner][1]
+    N_l1 = candidates[loser][0]
+    N_l2 = candidates[loser][1]
+    reported_margin = (N_w1+N_w2)-(N_l1+N_l2)
+    if n1 == 0:
+        cvr_pvalue = lambda alloc: 1
+    else:
+        cvr_pvalue = lambda alloc: pvalue_cache.ballot_comparison_pvalue(\
+                    n=n1, gamma=gamma, \
+                    o1=o1_obs, u1=u1_obs, o2=o2_obs, u2=u2_obs, \
+                    reported_margin=reported_margin, \
+                    N=stratum_sizes[0], \
+                    null_lambda=alloc)
+
+    n2w = observed_poll[winner]
+    n2l = observed_poll[loser]
+    if n2 == 0:
+        nocvr_pvalue = lambda alloc: 1
+    else:
+        nocvr_pvalue = lambda alloc: ballot_polling_sprt_pvalue(\
+                            n2w, n2l, n2-n2w-n2l, \
+                            popsize=stratum_sizes[1], \
+                            Vw=N_w2, Vl=N_l2, \
+                            null_margin=(N_w2-N_l2) - \
+                              alloc*reported_margin)
+    if refine:
+        bounding_fun = create_modulus(n1=n1, n2=n2, \
+                                      n_w2=n2w, \
+                                      n_l2=n2l, \
+                                      N1=stratum_sizes[0], \
+                                      V_wl=reported_margin, gamma=gamma)
+    else:
+        bounding_fun = None
+    return maximize_fisher_combined_pvalue(N_w1=N_w1, N_l1=N_l1,\
+                     N1=stratum_sizes[0], \
+                     N_w2=N_w2, N_l2=N_l2, \
+                     N2=stratum_sizes[1], \
+                     pvalue_funs=(cvr_pvalue, nocvr_pvalue), \
+                     stepsize=stepsize, \
+                     modulus=bounding_fun, \
+                     alpha=risk_limit, \
+                     feasible_lambda_range=feasible_lambda_range, \
+                     lambda_guess=lambda_guess)
+
+
+# Contest-level inputs shared by every pair, set once in each worker process
+# by `_init_audit_worker`.
+_audit_worker_context = None
+
+
+def _init_audit_worker(context):
+    global _audit_worker_context
+    _audit_worker_context = context
+    logfactorial.attach(context['logfactorial'])
+
+
+def _audit_pair_worker(pair):
+    """
+    Evaluate one (winner, loser) pair in a worker process of `audit_contest`.
+    """
+    context = _audit_worker_context
+    res = audit_pair(context['candidates'], pair[0], pair[1], \
+                     context['stratum_sizes'], context['n1'], context['n2'], \
+                     context['o1_obs'], context['o2_obs'], \
+                     context['u1_obs'], context['u2_obs'], \
+                     context['observed_poll'], context['risk_limit'], \
+                     context['gamma'], context['stepsize'])
+    return res['max_pvalue']
+
+
+@instrumentation.timed('audit_contest')
 def audit_contest(candidates, winners, losers, stratum_sizes,\
                   n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, observed_poll, \
-                  risk_limit, gamma, stepsize):
+                  risk_limit, gamma, stepsize, processes=1, \
+                  logfactorial_size=None):
     """
     Use SUITE to calculate risk of each (winner, loser) pair
     given the observed samples in the CVR and no-CVR strata.
@@ -677,59 +1276,120 @@ def audit_contest(candidates, winners, losers, stratum_sizes,\
         gamma from Lindeman and Stark (2012)
     stepsize : float
         stepsize for the discrete bounds on Fisher's combining function
+    processes : int
+        number of worker processes to evaluate the pairs. Default 1 evaluates
+        the pairs serially; None uses all available CPUs.
+    logfactorial_size : int
+        if given and processes > 1, `logfactorial.create(logfactorial_size)`
+        is called before the workers start, so that they share one table of
+        log factorials; e.g. sum(stratum_sizes). The table stays attached.
+        Optional.
     Returns
     -------
     dict : attained risk for each (winner, loser) pair in the contest
     """
     audit_pvalues = {}
-
-    for k in product(winners, losers):
-        N_w1 = candidates[k[0]][0]
-        N_w2 = candidates[k[0]][1]
-        N_l1 = candidates[k[1]][0]
-        N_l2 = candidates[k[1]][1]
-        reported_margin = (N_w1+N_w2)-(N_l1+N_l2)
-        if n1 == 0:
-            cvr_pvalue = lambda alloc: 1
-        else:
-            cvr_pvalue = lambda alloc: ballot_comparison_pvalue(n=n1, \
-                        gamma=gamma, \
-                        o1=o1_obs, u1=u1_obs, o2=o2_obs, u2=u2_obs, \
-                        reported_margin=reported_margin, \
-                        N=stratum_sizes[0], \
-                        null_lambda=alloc)
-
-        n2w = observed_poll[k[0]]
-        n2l = observed_poll[k[1]]
-        if n2 == 0:
-            nocvr_pvalue = lambda alloc: 1
-        else:
-            sam = np.array([0]*n2l+[1]*n2w+[np.nan]*(n2-n2w-n2l))
-            nocvr_pvalue = lambda alloc: ballot_polling_sprt(\
-                                sample=sam, \
-                                popsize=stratum_sizes[1], \
-                                alpha=risk_limit, \
-                                Vw=N_w2, Vl=N_l2, \
-                                null_margin=(N_w2-N_l2) - \
-                                  alloc*reported_margin)['pvalue']
-        bounding_fun = create_modulus(n1=n1, n2=n2, \
-                                      n_w2=n2w, \
-                                      n_l2=n2l, \
-                                      N1=stratum_sizes[0], \
-                                      V_wl=reported_margin, gamma=gamma)
-        res = maximize_fisher_combined_pvalue(N_w1=N_w1, N_l1=N_l1,\
-                         N1=stratum_sizes[0], \
-                         N_w2=N_w2, N_l2=N_l2, \
-                         N2=stratum_sizes[1], \
-                         pvalue_funs=(cvr_pvalue, nocvr_pvalue), \
-                         stepsize=stepsize, \
-                         modulus=bounding_fun, \
-                         alpha=risk_limit)
+    pairs = list(product(winners, losers))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(pairs))
+
+    if processes > 1:
+        if logfactorial_size is not None:
+            logfactorial.create(logfactorial_size)
+        # Everything except the pair names is the same for every pair, so
+        # it is sent to each worker once rather than with every task.
+        context = {'candidates' : OrderedDict((k, candidates[k]) \
+                                              for k in set(winners + losers)),
+                   'stratum_sizes' : stratum_sizes,
+                   'n1' : n1, 'n2' : n2,
+                   'o1_obs' : o1_obs, 'o2_obs' : o2_obs,
+                   'u1_obs' : u1_obs, 'u2_obs' : u2_obs,
+                   'observed_poll' : observed_poll,
+                   'risk_limit' : risk_limit, 'gamma' : gamma,
+                   'stepsize' : stepsize,
+                   'logfactorial' : logfactorial.FILENAME}
+        pool = multiprocessing.Pool(processes, initializer=_init_audit_worker,
+                                    initargs=(context,))
+        try:
+            pvalues = pool.map(_audit_pair_worker, pairs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for k, pvalue in zip(pairs, pvalues):
+            audit_pvalues[k] = pvalue
+        return audit_pvalues
+
+    for k in pairs:
+        with instrumentation.stage('audit_contest.pair'):
+            res = audit_pair(candidates, k[0], k[1], stratum_sizes, \
+                             n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, \
+                             observed_poll, risk_limit, gamma, stepsize)
         audit_pvalues[k] = res['max_pvalue']
 
     return audit_pvalues
 
 
+def audit_contest_pruned(candidates, margins, stratum_sizes,\
+                         n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, \
+                         observed_poll, risk_limit, gamma, stepsize):
+    """
+    Use SUITE to calculate risk of each (winner, loser) pair, from the
+    smallest margin to the largest, skipping pairs whose risk is bounded
+    by a pair already confirmed.
+
+    If a confirmed pair P dominates a pair Q (see `find_dominating_pair`),
+    the risk of Q is at most the risk of P, so Q is confirmed too and is
+    not evaluated. Its reported risk is the risk of P, an upper bound.
+    Pairs dominated only by pairs that are not confirmed are evaluated.
+
+    Parameters
+    ----------
+    candidates : dict
+        OrderedDict with candidate names as keys and
+        [CVR votes, no-CVR votes, total votes] as values
+    margins : dict
+        keys are (reported winner, reported loser), values are the margin
+        in votes between the pair, as returned by `find_winners_losers`
+    stratum_sizes, n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, observed_poll, \
+    risk_limit, gamma, stepsize :
+        as in `audit_contest`
+    Returns
+    -------
+    dict with
+
+    audit_pvalues : dict
+        attained risk, or an upper bound on it, for each (winner, loser) pair
+    computed : list
+        pairs that were evaluated, in the order evaluated
+    certified : dict
+        pairs that were not evaluated, with the confirmed pair that bounds
+        each of them
+    """
+    audit_pvalues = {}
+    computed = []
+    confirmed = []
+    certified = OrderedDict()
+    for k in sorted(margins.keys(), key=lambda t: margins[t]):
+        dominating = find_dominating_pair(k, candidates, confirmed, \
+                                          observed_poll)
+        if dominating is not None:
+            certified[k] = dominating
+            audit_pvalues[k] = audit_pvalues[dominating]
+            continue
+        res = audit_pair(candidates, k[0], k[1], stratum_sizes, \
+                         n1, n2, o1_obs, o2_obs, u1_obs, u2_obs, observed_poll, \
+                         risk_limit, gamma, stepsize)
+        audit_pvalues[k] = res['max_pvalue']
+        computed.append(k)
+        if res['max_pvalue'] <= risk_limit:
+            confirmed.append(k)
+    return {'audit_pvalues' : audit_pvalues,
+            'computed' : computed,
+            'certified' : certified
+            }
+
+
 ################################################################################
 ############################## Unit testing ####################################
 ################################################################################
@@ -755,8 +1415,8 @@ def test_initial_n():
             + n\log( 1 - \frac{\lambda}{5\gamma} )\] $$
     """
 
-    chi_5percent = scipy.stats.chi2.ppf(1-0.05, df=4)
-    chi_10percent = scipy.stats.chi2.ppf(1-0.10, df=4)
+    chi_5percent = _chi2_ppf(1-0.05, df=4)
+    chi_10percent = _chi2_ppf(1-0.10, df=4)
 
     # sample sizes: n = 50 in each stratum. Not sufficient.
     chi50 = lambda lam: -2*( np.sum(np.log(200 + 100*lam - np.arange(30))) - \
@@ -797,5 +1457,112 @@ def test_initial_n():
     np.testing.assert_array_less(chi_5percent, approx_chisq_min)
 
 
+def test_estimate_n_secant():
+    N_w1, N_w2, N_l1, N_l2, N1, N2 = 5300, 510, 4700, 490, 11000, 1100
+    n_guess = guess_initial_n(N_w1, N_w2, N_l1, N_l2, N1, N2)
+    (n1, n2) = estimate_n(N_w1, N_w2, N_l1, N_l2, N1, N2, method='secant')
+    np.testing.assert_array_less(n_guess/2, n1+n2)
+    np.testing.assert_array_less(n1+n2, 2*n_guess)
+    pvalue = expected_initial_pvalue(n1+n2, N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                                     0, 0, 0, 0, N1/(N1+N2), 0.05, 1.03905, 0.05)
+    assert 0.8*0.05 <= pvalue <= 0.05
+    # the sample size is not much larger than needed
+    pvalue = expected_initial_pvalue(n1+n2-1, N_w1, N_w2, N_l1, N_l2, N1, N2, \
+                                     0, 0, 0, 0, N1/(N1+N2), 0.05, 1.03905, 0.05)
+    assert pvalue > 0.8*0.05
+
+
+def test_escalation_risk_curve():
+    args = (5300, 510, 4700, 490, 11000, 1100, 200, 20, 1, 0, 0, 0, 9, 10)
+    res = escalation_risk_curve(*args)
+    assert np.all(np.diff(res['n']) > 0)
+    n_low = sum(res['sample_size'])
+    i = list(res['n']).index(n_low)
+    assert res['expected_pvalue'][i] <= 0.05 < res['expected_pvalue'][i-1]
+    assert res['n'][i] - res['n'][i-1] == 1
+
+    # agrees with the observed and projected sample audited directly
+    (n1, n2) = (int(res['n1'][i]), int(res['n2'][i]))
+    candidates = OrderedDict([("w", [5300, 510]), ("l", [4700, 490])])
+    poll = {"w" : 10 + int((n2 - 20)*510/1100), \
+            "l" : 9 + int((n2 - 20)*490/1100)}
+    o1 = 1 + math.ceil((n1 - 200)/200)
+    direct = audit_pair(candidates, "w", "l", [11000, 1100], n1, n2, \
+                        o1, 0, 0, 0, poll, 0.05, 1.03905, 0.05)
+    np.testing.assert_allclose(res['expected_pvalue'][i], \
+                               direct['max_pvalue'], rtol=1e-8)
+    assert estimate_escalation_n(*args, method='curve') == res['sample_size']
+
+
+def test_audit_contest_parallel():
+    candidates = {"a" : [5300, 510], "b" : [4700, 490],
+                  "c" : [4650, 480], "d" : [1000, 100]}
+    stratum_sizes = [16000, 1600]
+    (candidates, margins, winners, losers) = find_winners_losers(candidates, 2)
+    observed_poll = {"a" : 26, "b" : 22, "c" : 20, "d" : 2}
+    serial = audit_contest(candidates, winners, losers, stratum_sizes, \
+                           200, 80, 1, 0, 0, 0, observed_poll, \
+                           risk_limit=0.1, gamma=1.03905, stepsize=0.05)
+    parallel = audit_contest(candidates, winners, losers, stratum_sizes, \
+                             200, 80, 1, 0, 0, 0, observed_poll, \
+                             risk_limit=0.1, gamma=1.03905, stepsize=0.05, \
+                             processes=2)
+    assert list(serial.keys()) == list(parallel.keys())
+    assert serial == parallel
+
+
+def test_pruned_pairs():
+    # "d" and "e" have no votes in the no-CVR stratum, so the pairs (a, d)
+    # and (a, e) have the same no-CVR data; (a, e) has the larger CVR margin.
+    candidates = {"a" : [5300, 510], "b" : [4700, 490],
+                  "d" : [1000, 0], "e" : [400, 0]}
+    stratum_sizes = [16000, 1600]
+    (candidates, margins, winners, losers) = find_winners_losers(candidates, 1)
+    assert find_dominating_pair(("a", "e"), candidates, [("a", "d")]) == \
+        ("a", "d")
+    assert find_dominating_pair(("a", "d"), candidates, [("a", "e")]) is None
+    assert find_dominating_pair(("a", "d"), candidates, [("a", "b")]) is None
+
+    observed_poll = {"a" : 30, "b" : 28, "d" : 0, "e" : 0}
+    full = audit_contest(candidates, winners, losers, stratum_sizes, \
+                         200, 60, 0, 0, 0, 0, observed_poll, \
+                         risk_limit=0.1, gamma=1.03905, stepsize=0.05)
+    pruned = audit_contest_pruned(candidates, margins, stratum_sizes, \
+                         200, 60, 0, 0, 0, 0, observed_poll, \
+                         risk_limit=0.1, gamma=1.03905, stepsize=0.05)
+    assert pruned['computed'] == [("a", "b"), ("a", "d")]
+    assert pruned['certified'] == {("a", "e") : ("a", "d")}
+    for k in full:
+        assert full[k] <= pruned['audit_pvalues'][k]
+    assert pruned['audit_pvalues'][("a", "b")] == full[("a", "b")]
+
+    res = estimate_n_pairs(candidates, margins, stratum_sizes, \
+                           n_ratio=0.9, risk_limit=0.1)
+    assert res['certified'] == {("a", "e") : ("a", "d")}
+    n_ae = estimate_n(N_w1=5300, N_w2=510, N_l1=400, N_l2=0, \
+                      N1=16000, N2=1600, n_ratio=0.9, risk_limit=0.1)
+    assert sum(n_ae) <= sum(res['sample_sizes'][("a", "e")])
+
+
+def test_import_budget():
+    # the audit tools import neither matplotlib nor the slow scipy modules,
+    # so that worker processes start quickly
+    import os
+    import subprocess
+    import sys
+    code = "import sys; import suite_tools, planning; " \
+           "print([m for m in ('matplotlib', 'scipy.stats', 'scipy.optimize') " \
+           "if m in sys.modules])"
+    out = subprocess.check_output([sys.executable, '-c', code], \
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    loaded = out.decode().strip()
+    assert loaded == '[]', loaded
+
+
 if __name__ == "__main__":
     test_initial_n()
+    test_estimate_n_secant()
+    test_escalation_risk_curve()
+    test_audit_contest_parallel()
+    test_pruned_pairs()
+    test_import_budget()
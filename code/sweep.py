@@ -0,0 +1,400 @@
+"""
+Parallel, resumable parameter sweeps for the power and type I error studies
+of the ballot polling tests, as in `power.ipynb` and `type1-error.ipynb`.
+
+A sweep is a list of cells, each a dict of parameters. Every cell gets its
+own seed, derived from the sweep seed and the cell's position in the list,
+so results do not depend on the number of processes or on the order in
+which cells finish. Finished cells are appended to a checkpoint file, one
+JSON line per cell with its parameters and the sweep seed, and a sweep that
+is run again with the same checkpoint only computes the missing cells. The results are written as a CSV file
+with the columns of the notebooks' tables.
+"""
+
+from __future__ import division, print_function
+import csv
+import json
+import multiprocessing
+import os
+import numpy as np
+
+from hypergeometric import trihypergeometric_optim, hypergeometric_optim
+import logfactorial
+from montecarlo import adaptive_rejection_rate
+
+
+POWER_COLUMNS = ('vote margin', 'null margin', 'sample size', 'popsize', \
+                 'invalid_rate', \
+                 '1% rejection rate - tri', '5% rejection rate - tri', \
+                 '10% rejection rate - tri', \
+                 '1% rejection rate - hyp', '5% rejection rate - hyp', \
+                 '10% rejection rate - hyp')
+
+TYPE1_COLUMNS = ('vote margin', 'null margin', 'null_is_true', \
+                 'invalid_rate', '1% rejection rate', '5% rejection rate', \
+                 '10% rejection rate')
+
+ALPHAS = (0.01, 0.05, 0.1)
+
+
+################################################################################
+############################### Grids ##########################################
+################################################################################
+
+def _population(popsize, invalid_rate, vote_margin):
+    """
+    Ballots for l (0), w (1) and neither (np.nan), as in the notebooks.
+    """
+    r = invalid_rate
+    return np.array([0]*(int((1-r)/2*popsize - vote_margin)) + \
+                    [1]*(int((1-r)/2*popsize + vote_margin)) + \
+                    [np.nan]*int(r*popsize))
+
+
+def power_grid(margins=(0.01, 0.05, 0.1), invalid_rates=(0.1, 0.25, 0.5), \
+               sample_rates=(0.01, 0.05, 0.1, 0.2), c_values=(0, 50, 100), \
+               popsize=1000, reps=100, half_width=None):
+    """
+    Cells of the power study of `power.ipynb`, in the order of its table.
+
+    Parameters
+    ----------
+    margins : list
+        vote margins, as a fraction of the valid votes
+    invalid_rates : list
+        fractions of ballots with no vote for w or l
+    sample_rates : list
+        sample sizes, as a fraction of popsize
+    c_values : list
+        null margins, in votes
+    popsize : int
+        number of ballots
+    reps : int
+        number of samples per cell, or the most if half_width is given
+    half_width : float
+        stop sampling a cell once its rates are known to within this.
+        Optional.
+    Returns
+    -------
+    list of dicts
+    """
+    return [{'margin' : m, 'invalid_rate' : r, 'sample_rate' : s, \
+             'null_margin' : c, 'popsize' : popsize, 'reps' : reps, \
+             'half_width' : half_width} \
+            for m in margins for r in invalid_rates for s in sample_rates \
+            for c in c_values]
+
+
+def type1_grid(diluted_margins=(0.01, 0.05, 0.1, 0.2), \
+               invalid_rates=(0.1, 0.2), \
+               c_rates=(-0.2, -0.1, -0.05, -0.01, 0, 0.01, 0.05, 0.1, 0.2), \
+               popsize=1000, sample_rate=0.2, reps=1000, half_width=None):
+    """
+    Cells of the type I error study of `type1-error.ipynb`, in the order of
+    its table. Only null margins at least as large as the diluted margin,
+    for which the null is true, are included.
+
+    Parameters
+    ----------
+    diluted_margins : list
+        diluted margins of the population
+    invalid_rates : list
+        fractions of ballots with no vote for w or l
+    c_rates : list
+        null margins, as a fraction of popsize
+    popsize : int
+        number of ballots
+    sample_rate : float
+        sample size, as a fraction of popsize
+    reps : int
+        number of samples per cell, or the most if half_width is given
+    half_width : float
+        stop sampling a cell once its rates are known to within this.
+        Optional.
+    Returns
+    -------
+    list of dicts
+    """
+    return [{'margin' : m, 'invalid_rate' : r, 'null_margin' : c, \
+             'popsize' : popsize, 'sample_rate' : sample_rate, 'reps' : reps, \
+             'half_width' : half_width} \
+            for m in diluted_margins for r in invalid_rates for c in c_rates \
+            if m <= c]
+
+
+################################################################################
+############################### Cells ##########################################
+################################################################################
+
+def power_cell(cell, seed_sequence):
+    """
+    Rejection rates of the tri-hypergeometric and hypergeometric tests for
+    one cell of `power_grid`. Samples are drawn with replacement, as in
+    `power.ipynb`. If the cell has a 'half_width', sampling stops early once
+    every rate is known to within it; see `adaptive_rejection_rate`.
+
+    Returns
+    -------
+    list : a row with POWER_COLUMNS
+    """
+    (m, r, c, popsize) = (cell['margin'], cell['invalid_rate'], \
+                          cell['null_margin'], cell['popsize'])
+    population = _population(popsize, r, (1-r)*popsize*(m/2))
+    size = cell['sample_rate']*popsize
+    def simulate(prng, reps):
+        rejects = np.zeros((reps, 6), dtype=bool)
+        for i in range(reps):
+            sam = prng.choice(population, int(size))
+            tri = trihypergeometric_optim(sam, popsize, null_margin=c)
+            hyp = hypergeometric_optim(sam, popsize, null_margin=c)
+            rejects[i] = [tri <= a for a in ALPHAS] + \
+                         [hyp <= a for a in ALPHAS]
+        return rejects
+    rates = _cell_rates(simulate, cell, seed_sequence)
+    return [m, c, size, popsize, r] + list(rates)
+
+
+def type1_cell(cell, seed_sequence):
+    """
+    Rejection rates of the tri-hypergeometric test for one cell of
+    `type1_grid`. Samples are drawn without replacement, as in
+    `type1-error.ipynb`. If the cell has a 'half_width', sampling stops early
+    once every rate is known to within it.
+
+    Returns
+    -------
+    list : a row with TYPE1_COLUMNS
+    """
+    (m, r, c, popsize) = (cell['margin'], cell['invalid_rate'], \
+                          cell['null_margin'], cell['popsize'])
+    population = _population(popsize, r, popsize*m/2)
+    size = int(cell['sample_rate']*popsize)
+    def simulate(prng, reps):
+        rejects = np.zeros((reps, 3), dtype=bool)
+        for i in range(reps):
+            sam = prng.choice(population, size, replace=False)
+            pvalue = trihypergeometric_optim(sam, popsize, \
+                                             null_margin=int(c*popsize))
+            rejects[i] = [pvalue <= a for a in ALPHAS]
+        return rejects
+    rates = _cell_rates(simulate, cell, seed_sequence)
+    return [m, c, m <= c, r] + list(rates)
+
+
+def _cell_rates(simulate, cell, seed_sequence):
+    """
+    Run the samples of a cell: all cell['reps'] of them, or fewer if the
+    cell has a 'half_width' that is reached first.
+    """
+    half_width = cell.get('half_width')
+    res = adaptive_rejection_rate(simulate, half_width=half_width, \
+                                  chunk=cell.get('chunk', 100) \
+                                  if half_width is not None else cell['reps'], \
+                                  max_reps=cell['reps'], seed=seed_sequence)
+    return res['rejection_rate']
+
+
+################################################################################
+############################### Runner #########################################
+################################################################################
+
+def _cell_worker(args):
+    (cell_fun, index, cell, seed_sequence) = args
+    return (index, [float(v) for v in cell_fun(cell, seed_sequence)])
+
+
+def _checkpoint_line(index, cell, seed, row):
+    return json.dumps({'index' : index, 'cell' : cell, 'seed' : seed, \
+                       'row' : row}, sort_keys=True)
+
+
+def _read_checkpoint(checkpoint, cells, seed):
+    """
+    Rows of the finished cells in a checkpoint file, by cell index. A last
+    line cut short by an interruption is ignored. Raises ValueError if an
+    entry is not for the cell at its index of this sweep, or was run with
+    another seed.
+    """
+    rows = {}
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return rows
+    with open(checkpoint) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            index = entry.get('index')
+            if not (isinstance(index, int) and 0 <= index < len(cells)) or \
+               entry.get('seed') != seed or \
+               entry.get('cell') != json.loads(json.dumps(cells[index])):
+                raise ValueError('checkpoint %s has an entry for cell %r of '
+                                 'another sweep, with seed %r: %r' % \
+                                 (checkpoint, index, entry.get('seed'), \
+                                  entry.get('cell')))
+            rows[index] = entry['row']
+    return rows
+
+
+def write_results_csv(filename, columns, rows):
+    """
+    Write rows in the layout of pandas' DataFrame.to_csv: an unnamed index
+    column, then one column per name in `columns`.
+    """
+    with open(filename, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([''] + list(columns))
+        for i, row in enumerate(rows):
+            writer.writerow([i] + [repr(float(v)) for v in row])
+
+
+def run_sweep(cell_fun, cells, columns, output=None, checkpoint=None, \
+              seed=837459382, processes=1, verbose=False, \
+              logfactorial_size=None):
+    """
+    Run `cell_fun` on every cell of a sweep, in parallel, checkpointing
+    finished cells.
+
+    Parameters
+    ----------
+    cell_fun : function
+        takes a cell and a numpy SeedSequence and returns a row of results,
+        e.g. `power_cell`. It must be importable, so that worker processes
+        can run it.
+    cells : list
+        parameter dicts, e.g. from `power_grid`
+    columns : list
+        names of the columns of the rows, e.g. POWER_COLUMNS
+    output : str
+        name of the CSV file of results. Optional.
+    checkpoint : str
+        name of the checkpoint file. Cells found in it are not run again;
+        ValueError if it holds cells of another sweep, or another seed.
+        Optional.
+    seed : int
+        seed of the sweep; cell i uses the i-th child of
+        numpy.random.SeedSequence(seed). Default is 837459382.
+    processes : int
+        number of worker processes; None for one per CPU. Default is 1.
+    verbose : bool
+        print each cell as it finishes? Default is False.
+    logfactorial_size : int
+        if given and processes > 1, `logfactorial.create(logfactorial_size)`
+        is called before the workers start, so that they share one table of
+        log factorials; e.g. the largest popsize of the cells. The table
+        stays attached. Optional.
+    Returns
+    -------
+    list : the rows of results, in the order of the cells
+    """
+    rows = _read_checkpoint(checkpoint, cells, seed)
+    seeds = np.random.SeedSequence(seed).spawn(len(cells))
+    tasks = [(cell_fun, i, cell, seeds[i]) for i, cell in enumerate(cells) \
+             if i not in rows]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+
+    if processes > 1 and logfactorial_size is not None:
+        logfactorial.create(logfactorial_size)
+    log = open(checkpoint, 'a') if checkpoint is not None else None
+    pool = multiprocessing.Pool(processes, **logfactorial.pool_arguments()) \
+           if processes > 1 else None
+    try:
+        results = pool.imap_unordered(_cell_worker, tasks) if pool else \
+                  map(_cell_worker, tasks)
+        for (index, row) in results:
+            rows[index] = row
+            if log is not None:
+                log.write(_checkpoint_line(index, cells[index], seed, row) + \
+                          '\n')
+                log.flush()
+            if verbose:
+                print(index, cells[index])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if log is not None:
+            log.close()
+
+    rows = [rows[i] for i in range(len(cells))]
+    if output is not None:
+        write_results_csv(output, columns, rows)
+    return rows
+
+
+################################################################################
+############################## Unit testing ####################################
+################################################################################
+
+def test_run_sweep():
+    import shutil
+    import tempfile
+    dirname = tempfile.mkdtemp()
+    try:
+        cells = power_grid(margins=[0.1], invalid_rates=[0.1], \
+                           sample_rates=[0.1, 0.2], c_values=[0, 50], \
+                           popsize=200, reps=5)
+        assert len(cells) == 4
+        serial = run_sweep(power_cell, cells, POWER_COLUMNS, seed=1)
+
+        # run half of the sweep, then resume with two processes
+        checkpoint = os.path.join(dirname, 'power.ckpt')
+        output = os.path.join(dirname, 'power.csv')
+        run_sweep(power_cell, cells[0:2], POWER_COLUMNS, \
+                  checkpoint=checkpoint, seed=1)
+        resumed = run_sweep(power_cell, cells, POWER_COLUMNS, output=output, \
+                            checkpoint=checkpoint, seed=1, processes=2)
+        assert resumed == serial
+        with open(checkpoint) as f:
+            assert len(f.readlines()) == 4
+
+        # workers sharing a table of log factorials give the same results
+        cache = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = dirname
+        try:
+            shared = run_sweep(power_cell, cells, POWER_COLUMNS, seed=1, \
+                               processes=2, logfactorial_size=200)
+            assert logfactorial.FILENAME.startswith(dirname)
+        finally:
+            logfactorial.detach()
+            if cache is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = cache
+        assert shared == serial
+
+        # a checkpoint of other cells, or of another seed, is not used
+        for (other, other_seed) in ((cells[::-1], 1), (cells, 2)):
+            try:
+                run_sweep(power_cell, other, POWER_COLUMNS, \
+                          checkpoint=checkpoint, seed=other_seed)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('a checkpoint of another sweep was used')
+        with open(output) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == ',' + ','.join(POWER_COLUMNS)
+        assert lines[1].startswith('0,0.1,0.0,20.0,200.0,0.1,')
+
+        cells = type1_grid(diluted_margins=[0.01], invalid_rates=[0.1], \
+                           c_rates=[0, 0.01, 0.05], popsize=200, reps=5)
+        assert [cell['null_margin'] for cell in cells] == [0.01, 0.05]
+        rows = run_sweep(type1_cell, cells, TYPE1_COLUMNS, seed=2)
+        assert rows[0][0:4] == [0.01, 0.01, 1.0, 0.1]
+
+        # with a loose half-width, a cell stops after its first chunk of 100
+        cells = power_grid(margins=[0.1], invalid_rates=[0.1], \
+                           sample_rates=[0.1], c_values=[0], popsize=200, \
+                           reps=1000, half_width=0.2)
+        rows = run_sweep(power_cell, cells, POWER_COLUMNS, seed=3)
+        cells[0].update(reps=100, half_width=None)
+        assert rows == run_sweep(power_cell, cells, POWER_COLUMNS, seed=3)
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == "__main__":
+    test_run_sweep()